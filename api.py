@@ -439,6 +439,10 @@ def cancel_task(req: TaskActionRequest, _=Depends(verify_auth)):
             resume_event = state.get("resume_event")
             if resume_event:
                 resume_event.set()
+            # Cut short any in-loop wait (rate-limit backoff, pacing sleeps)
+            cancel_event = state.get("cancel_event")
+            if cancel_event:
+                cancel_event.set()
             cancelled_mode = mode
             if _ws_broadcast_status:
                 _ws_broadcast_status(chat_id, mode, "", 0, active=False)
@@ -7,14 +7,27 @@ Supports interactive prompts, plan mode, and multiple working directories.
 import os
 import re
 import signal
+import string
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import traceback
 import json
+import hashlib
+import random
+import atexit
+import bisect
+import fnmatch
+import functools
+import itertools
 import threading
 import uuid
 import ctypes
-from collections import deque
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from pathlib import Path
 from datetime import datetime, timedelta
 
@@ -23,10 +36,44 @@ try:
     _libc = ctypes.CDLL("libc.so.6")
     def _malloc_trim():
         _libc.malloc_trim(0)
+    # Cap per-thread arenas (every session/stream thread would otherwise grow its own), and pin the
+    # mmap threshold at 128 KiB so big JSON lines are mmap'd and unmapped on free instead of fragmenting
+    # the heap. Env settings (MALLOC_ARENA_MAX / MALLOC_MMAP_THRESHOLD_) win if the service sets them.
+    if "MALLOC_ARENA_MAX" not in os.environ:
+        _libc.mallopt(-8, 2)  # M_ARENA_MAX
+    if "MALLOC_MMAP_THRESHOLD_" not in os.environ:
+        _libc.mallopt(-3, 128 * 1024)  # M_MMAP_THRESHOLD
 except Exception:
     def _malloc_trim():
         pass
 
+# orjson parses Claude's stream-json lines several times faster when installed (optional);
+# its JSONDecodeError subclasses json.JSONDecodeError, so existing handlers catch both
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Opportunistic trims after big CLI outputs are budgeted: malloc_trim walks the whole heap, so
+# calling it after every large line costs more than it returns on long tool traces
+_TRIM_BYTES = 128 * 1024 * 1024  # trim once this much parsed output has been dropped...
+_TRIM_SECS = 60  # ...or on the next drop once this long has passed since the last trim
+_trim_bytes = 0
+_trim_last = 0.0
+
+
+def _maybe_malloc_trim(nbytes):
+    """Count nbytes of discarded output and run _malloc_trim() when the byte or time budget is spent."""
+    global _trim_bytes, _trim_last
+    _trim_bytes += nbytes
+    now = time.time()
+    if _trim_bytes >= _TRIM_BYTES or now - _trim_last >= _TRIM_SECS:
+        _trim_bytes = 0
+        _trim_last = now
+        _malloc_trim()
+
+
 # Configuration
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "YOUR_BOT_TOKEN_HERE")
 ALLOWED_CHAT_IDS = os.environ.get("ALLOWED_CHAT_IDS", "").split(",")
@@ -42,6 +89,11 @@ CLAUDE_ALLOWED_TOOLS = os.environ.get(
 CODEX_MODEL = os.environ.get("CODEX_MODEL", "gpt-5.3-codex")
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-3.1-pro-preview")
 
+# Retry schedule for failed Codex calls: min(BACKOFF_BASE * 2**streak + jitter, BACKOFF_CAP) seconds
+CODEX_MAX_RETRIES = int(os.environ.get("CODEX_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.environ.get("BACKOFF_BASE", "1.0"))
+BACKOFF_CAP = float(os.environ.get("BACKOFF_CAP", "60.0"))
+
 API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 DATA_DIR = Path(__file__).parent / "data"
 SESSIONS_FILE = DATA_DIR / "sessions.json"
@@ -54,9 +106,15 @@ last_update_id = 0
 
 # In-memory state
 user_sessions = {}  # chat_id -> {sessions: [], active: session_id}
+_session_by_id = {}  # chat_key -> {session_id: session dict} (index over user_sessions, kept in sync on load/create/delete)
+_session_name_index = {}  # chat_key -> (sorted [(lower name, idx)], {lower name: first idx}); dropped on create/delete
 pending_questions = {}  # chat_id -> {questions: [], answers: {}, current_idx: 0, session}
-active_processes = {}  # session_id -> subprocess.Popen (allows parallel sessions)
-message_queue = {}  # session_id -> [queued messages]
+active_processes = {}  # session_id -> subprocess.Popen (allows parallel sessions); a _Starting placeholder while launching
+message_queue = {}  # session_id -> deque of queued messages (append right, popleft)
+_last_queue_ack = {}  # session_id -> (sent_at, message_id, queue_pos) of the latest "queued" notice
+_queue_ack_locks = {}  # session_id -> Lock serializing that session's queue notices, so a burst edits one message
+_queue_ack_lock = threading.Lock()  # guards _queue_ack_locks only; never held across Telegram calls
+_QUEUE_ACK_COALESCE_SECS = 0.5  # a queued message this soon after the last notice edits it instead
 justdoit_active = {}  # "chat_id:session_id" -> {"active": True, "task": str, "step": int, "chat_id": str}
 deepreview_active = {}  # "chat_id:session_id" -> {"active": True, "phase": str, "step": int, ...}
 session_locks = {}  # session_id -> threading.Lock (prevents race conditions)
@@ -71,39 +129,129 @@ _scheduled_tasks_lock = threading.Lock()
 _scheduler_generation = 0
 
 
+def _loop_modes():
+    """(mode, state dict) for every autonomous loop. Built per call: a hot reload rebinds the dicts."""
+    return (("justdoit", justdoit_active), ("deepreview", deepreview_active), ("omni", omni_active))
+
+
+_LOOP_LABELS = {"justdoit": "JustDoIt", "deepreview": "Deep review", "omni": "Omni"}
+
+
+def get_active_loop(jdi_key):
+    """(mode, state) of the loop running on "chat_id:session_id", or (None, None)."""
+    for mode, loops in _loop_modes():
+        state = loops.get(jdi_key)
+        if state and state.get("active"):
+            return mode, state
+    return None, None
+
+
+def _refuse_if_loop_running(chat_id, jdi_key, starting):
+    """Tell the user and return True if any autonomous loop already owns this session."""
+    running, _ = get_active_loop(jdi_key)
+    if not running:
+        return False
+    already = "already " if running == starting else ""
+    send_message(chat_id, f"⚠️ {_LOOP_LABELS[running]} is {already}running on this session. Use `/cancel` to stop it first.")
+    return True
+
+
+_active_tasks_lock = threading.Lock()  # serializes snapshot+write so a late flush can't resurrect a finished task
+_tasks_dirty = threading.Event()  # set by loops on step/phase changes; cleared by _active_tasks_flusher
+_bg_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bg")  # Short background jobs (summary merges, file-index rebuilds)
+_upload_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tg-upload")  # /file uploads, off the update loop
+_TASKS_FLUSH_SECS = 1  # coalescing window for dirty active-task writes
+
+
 def save_active_tasks():
     """Persist active justdoit/omni tasks to disk for crash recovery detection."""
     try:
-        tasks = {}
-        for state_dict, mode in [
-            (justdoit_active, "justdoit"),
-            (omni_active, "omni"),
-            (deepreview_active, "deepreview"),
-        ]:
-            for key, state in list(state_dict.items()):
-                if state.get("active"):
-                    tasks[key] = {
-                        "started": state.get("started", time.time()),
-                        "task": (state.get("task", "") or "")[:200],
-                        "step": state.get("step", 0),
-                        "phase": state.get("phase", ""),
-                        "chat_id": state.get("chat_id", ""),
-                        "session_name": state.get("session_name", ""),
-                        "type": mode,
-                        "paused": state.get("paused", False),
-                    }
-        DATA_DIR.mkdir(exist_ok=True)
-        if tasks:
-            with open(ACTIVE_TASKS_FILE, "w") as f:
-                json.dump(tasks, f)
-        else:
-            # No active tasks — remove the file
-            if ACTIVE_TASKS_FILE.exists():
-                ACTIVE_TASKS_FILE.unlink()
+        with _active_tasks_lock:
+            _tasks_dirty.clear()
+            tasks = {}
+            for mode, state_dict in _loop_modes():
+                for key, state in list(state_dict.items()):
+                    if state.get("active"):
+                        tasks[key] = {
+                            "started": state.get("started", time.time()),
+                            "task": (state.get("task", "") or "")[:200],
+                            "step": state.get("step", 0),
+                            "phase": state.get("phase", ""),
+                            "chat_id": state.get("chat_id", ""),
+                            "session_name": state.get("session_name", ""),
+                            "type": mode,
+                            "paused": state.get("paused", False),
+                        }
+            DATA_DIR.mkdir(exist_ok=True)
+            if tasks:
+                tmp = ACTIVE_TASKS_FILE.with_suffix(".tmp")
+                tmp.write_text(json.dumps(tasks, separators=(",", ":")))
+                tmp.replace(ACTIVE_TASKS_FILE)
+            else:
+                # No active tasks — remove the file
+                if ACTIVE_TASKS_FILE.exists():
+                    ACTIVE_TASKS_FILE.unlink()
     except Exception as e:
         print(f"Error saving active tasks: {e}")
 
 
+def mark_active_tasks_dirty():
+    """Request an active-tasks write without blocking the caller (coalesced by _active_tasks_flusher)."""
+    _tasks_dirty.set()
+
+
+_STALE_STATE_SECS = 3600  # how long a dead/finished entry may linger before the sweeper drops it
+_stale_since = {}  # (kind, key) -> when _sweep_stale_state first saw the entry dead
+
+
+def _sweep_stale_state():
+    """Drop process/loop/cancel entries that an abnormal exit left behind.
+
+    Normal paths pop their own entries; this only removes ones that have been dead for
+    _STALE_STATE_SECS: exited (or never-started) processes, inactive loop states, and
+    cancel flags for sessions with no process. Live loops are never touched, however long they run.
+    """
+    now = time.time()
+    seen = set()
+
+    def _expired(kind, key):
+        seen.add((kind, key))
+        return now - _stale_since.setdefault((kind, key), now) > _STALE_STATE_SECS
+
+    for sid, proc in list(active_processes.items()):
+        if (not proc or proc.poll() is not None) and _expired("proc", sid):
+            if active_processes.get(sid) is proc:
+                active_processes.pop(sid, None)
+                print(f"[Sweep] Dropped stale active_processes entry {sid}", flush=True)
+    for mode, loops in _loop_modes():
+        for key, state in list(loops.items()):
+            if not state.get("active") and _expired(mode, key):
+                if loops.get(key) is state:
+                    loops.pop(key, None)
+                    print(f"[Sweep] Dropped stale {mode} state {key}", flush=True)
+    for sid in list(cancelled_sessions):
+        if sid not in active_processes and _expired("cancel", sid):
+            cancelled_sessions.discard(sid)
+    for k in list(_stale_since):
+        if k not in seen:
+            del _stale_since[k]
+
+
+def _active_tasks_flusher():
+    """Background writer: coalesces dirty marks from the loops into at most one write per window."""
+    while True:
+        _tasks_dirty.wait()
+        time.sleep(_TASKS_FLUSH_SECS)
+        if _tasks_dirty.is_set():
+            save_active_tasks()
+
+
+def _flush_active_tasks_if_dirty():
+    """Write any pending active-tasks change now (shutdown path; the flusher thread is a daemon)."""
+    if _tasks_dirty.is_set():
+        save_active_tasks()
+
+
 def clear_active_tasks():
     """Clear the active tasks file (called when all tasks are done)."""
     try:
@@ -116,6 +264,9 @@ def clear_active_tasks():
 # --- Active sessions tracking (crash recovery for ALL sessions) ---
 
 _active_sessions_lock = threading.Lock()
+_active_sessions = {}  # session_id -> {chat_id, session_name, prompt, started}; authoritative copy of ACTIVE_SESSIONS_FILE
+_active_sessions_dirty = threading.Event()  # set by mark_session_active/done; cleared by _flush_active_sessions
+_ACTIVE_SESSIONS_FLUSH_SECS = 2.0  # coalescing window for active_sessions.json writes
 
 
 def _save_active_sessions_file(sessions_dict):
@@ -123,22 +274,39 @@ def _save_active_sessions_file(sessions_dict):
     try:
         DATA_DIR.mkdir(exist_ok=True)
         tmp_file = ACTIVE_SESSIONS_FILE.with_suffix(".tmp")
-        with open(tmp_file, "w") as f:
-            json.dump(sessions_dict, f)
+        tmp_file.write_text(json.dumps(sessions_dict, separators=(",", ":")))
         tmp_file.replace(ACTIVE_SESSIONS_FILE)  # Atomic on POSIX
     except Exception as e:
         print(f"Error saving active sessions: {e}")
 
 
+def _flush_active_sessions():
+    """Write _active_sessions to disk if it changed (the file is removed when nothing is running)."""
+    with _active_sessions_lock:
+        if not _active_sessions_dirty.is_set():
+            return
+        _active_sessions_dirty.clear()
+        if _active_sessions:
+            _save_active_sessions_file(_active_sessions)
+        else:
+            try:
+                ACTIVE_SESSIONS_FILE.unlink(missing_ok=True)
+            except Exception as e:
+                print(f"Error clearing active sessions file: {e}")
+
+
+def _active_sessions_flusher():
+    """Background writer: a burst of session starts/finishes costs one write per window."""
+    while True:
+        _active_sessions_dirty.wait()
+        time.sleep(_ACTIVE_SESSIONS_FLUSH_SECS)
+        _flush_active_sessions()
+
+
 def get_active_sessions_data():
-    """Return data from active_sessions.json (for API use)."""
+    """Return the running Claude sessions recorded for crash recovery (for API use)."""
     with _active_sessions_lock:
-        try:
-            with open(ACTIVE_SESSIONS_FILE) as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            pass
-    return {}
+        return {sid: dict(info) for sid, info in _active_sessions.items()}
 
 
 def mark_session_active(chat_id, session_name, session_id, prompt):
@@ -149,36 +317,20 @@ def mark_session_active(chat_id, session_name, session_id, prompt):
     elif "[NEW TASK]\n" in prompt:
         prompt = prompt.split("[NEW TASK]\n", 1)[1]
     with _active_sessions_lock:
-        try:
-            with open(ACTIVE_SESSIONS_FILE) as f:
-                data = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            data = {}
-        data[session_id] = {
+        _active_sessions[session_id] = {
             "chat_id": str(chat_id),
             "session_name": session_name,
             "prompt": prompt[:200],
             "started": time.time(),
         }
-        _save_active_sessions_file(data)
+        _active_sessions_dirty.set()
 
 
 def mark_session_done(session_id):
-    """Remove a session from the active tracking file."""
+    """Remove a session from active tracking."""
     with _active_sessions_lock:
-        try:
-            with open(ACTIVE_SESSIONS_FILE) as f:
-                data = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return
-        try:
-            data.pop(session_id, None)
-            if data:
-                _save_active_sessions_file(data)
-            else:
-                ACTIVE_SESSIONS_FILE.unlink(missing_ok=True)
-        except Exception as e:
-            print(f"Error clearing active session {session_id}: {e}")
+        if _active_sessions.pop(session_id, None) is not None:
+            _active_sessions_dirty.set()
 
 
 def check_interrupted_sessions():
@@ -228,10 +380,12 @@ def check_interrupted_sessions():
 def get_available_memory_mb():
     """Get available system memory in MB from /proc/meminfo."""
     try:
-        with open("/proc/meminfo") as f:
-            for line in f:
-                if line.startswith("MemAvailable:"):
-                    return int(line.split()[1]) / 1024
+        # One unbuffered read of the whole file, then parse just the MemAvailable field
+        with open("/proc/meminfo", "rb", buffering=0) as f:
+            buf = f.read(4096)
+        i = buf.find(b"MemAvailable:")
+        if i >= 0:
+            return int(buf[i + 13:buf.find(b"\n", i)].split()[0]) / 1024
     except Exception:
         pass
     return 99999  # assume plenty if we can't read
@@ -292,6 +446,45 @@ def check_interrupted_tasks():
         clear_active_tasks()
 
 
+class _Starting:
+    """Placeholder in active_processes until the real Popen is stored. Falsy, so readers that
+    test `if process:` treat it as "no process yet"."""
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "<starting>"
+
+
+def _claim_session(session_id):
+    """Mark session_id busy unless something already holds it; True if this call claimed it.
+    dict.setdefault is a single atomic step under the GIL, so no per-session lock is taken. Each
+    claim uses its own placeholder: a shared one would let a second claim "win" while the first
+    is still starting."""
+    token = _Starting()
+    return active_processes.setdefault(session_id, token) is token
+
+
+def _claim_or_queue(session_id, text):
+    """Claim session_id to run `text`, or queue it behind the running task.
+
+    Returns (text_to_run, queue_pos); text_to_run is None when the text was queued. The queue
+    append still takes the session lock, and the claim is retried afterwards so a task that
+    finished in between can't leave the message stranded in the queue.
+    """
+    if _claim_session(session_id):
+        return text, 0
+    with get_session_lock(session_id):
+        queue = message_queue.setdefault(session_id, deque())
+        queue.append(text)
+        if not _claim_session(session_id):
+            return None, len(queue)
+        # The session went idle while we queued — run the oldest queued message now
+        return queue.popleft(), 0
+
+
 def get_session_lock(session_id):
     """Get or create a threading.Lock for a given session_id."""
     with session_locks_lock:
@@ -306,7 +499,7 @@ def download_telegram_file(file_id, filename=None):
 
     try:
         # Get file path from Telegram
-        resp = requests.get(f"{API_URL}/getFile", params={"file_id": file_id}, timeout=30)
+        resp = _tg_session.get(f"{API_URL}/getFile", params={"file_id": file_id}, timeout=30)
         file_info = resp.json().get("result", {})
         file_path = file_info.get("file_path")
 
@@ -315,7 +508,7 @@ def download_telegram_file(file_id, filename=None):
 
         # Download the file
         download_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
-        resp = requests.get(download_url, timeout=60)
+        resp = _tg_session.get(download_url, timeout=60)
 
         if resp.status_code != 200:
             return None
@@ -349,23 +542,45 @@ def load_sessions():
             except Exception as e:
                 print(f"Error loading sessions: {e}")
                 user_sessions = {}
+        _rebuild_session_index()
+
+
+def _rebuild_session_index():
+    """Rebuild the per-chat session_id -> session index from user_sessions."""
+    index = {}
+    for chat_key, user_data in user_sessions.items():
+        by_id = index[chat_key] = {}
+        for s in user_data.get("sessions", []):
+            by_id.setdefault(get_session_id(s), s)  # first wins, as the old list scan did
+    _session_by_id.clear()
+    _session_by_id.update(index)
+    _session_name_index.clear()
 
 
 _save_sessions_last = 0  # Timestamp of last actual save
 _save_sessions_dirty = False  # Whether there are unsaved changes
 _SAVE_DEBOUNCE_SECS = 5  # Minimum seconds between disk writes
+_sessions_save_due = threading.Event()  # set by save_sessions(soon=True); cleared by _sessions_flusher
+_SESSIONS_FLUSH_SECS = 0.2  # coalescing window for soon=True session writes
 
 
-def save_sessions(force=False):
+def save_sessions(force=False, soon=False):
     """Save sessions to disk atomically. Debounced to avoid excessive I/O.
 
     Args:
         force: If True, write immediately regardless of debounce timer.
                Use for important state changes (session creation, session ID updates).
+        soon: If True, don't write here; _sessions_flusher writes within _SESSIONS_FLUSH_SECS,
+              so a burst of user commands (/delete all then /new) costs one write.
     """
     global _save_sessions_last, _save_sessions_dirty
     now = time.time()
 
+    if soon:
+        _save_sessions_dirty = True
+        _sessions_save_due.set()
+        return
+
     if not force and (now - _save_sessions_last) < _SAVE_DEBOUNCE_SECS:
         _save_sessions_dirty = True
         return
@@ -393,13 +608,41 @@ def _flush_sessions_if_dirty():
         save_sessions(force=True)
 
 
+def _sessions_flusher():
+    """Background writer for save_sessions(soon=True): one write per short coalescing window."""
+    while True:
+        _sessions_save_due.wait()
+        time.sleep(_SESSIONS_FLUSH_SECS)
+        _sessions_save_due.clear()
+        _flush_sessions_if_dirty()
+
+
+# Shared keep-alive connection pool for Telegram Bot API calls (saves a TLS handshake per request)
+_tg_session = requests.Session()
+_tg_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))  # every Telegram call shares these sockets
+# sendMessage must get through: let urllib3 wait out Telegram's 429 Retry-After. Network errors are
+# retried by send_message itself; 5xx is not retried since the message may already have been delivered.
+_tg_session.mount(f"{API_URL}/sendMessage", HTTPAdapter(pool_maxsize=8, max_retries=Retry(
+    total=3, connect=0, read=0, status=3, status_forcelist=(429,), allowed_methods=None,
+    backoff_factor=0.5, respect_retry_after_header=True, raise_on_status=False)))
+
+# Characters legacy Telegram Markdown treats as entity markers (escaped with a backslash outside entities)
+_MD_ESCAPE = re.compile(r"([_*`\[])")
+
+
+def md_escape(text):
+    """Escape free text (errors, Codex reasoning) for parse_mode="Markdown" so it can't break the message
+    and force send_message's plain-text resend."""
+    return _MD_ESCAPE.sub(r"\\\1", text)
+
+
 _tg_poll_failures = 0
 
 def get_updates(offset=0):
     """Poll for new messages and callback queries with timeout backoff."""
     global _tg_poll_failures
     try:
-        resp = requests.get(
+        resp = _tg_session.get(
             f"{API_URL}/getUpdates",
             params={"offset": offset, "timeout": 30},
             timeout=(10, 40)  # connect/read
@@ -778,6 +1021,34 @@ def _check_pause(state_dict, chat_key, chat_id, mode, phase, step):
     return True
 
 
+def _new_loop_state(chat_id, session_name, task, phase):
+    """Build the state dict for an omni/justdoit/deepreview loop.
+
+    Stays a plain dict: api.py, save_active_tasks and /cancel all read it by key.
+    """
+    state = {
+        "active": True,
+        "paused": False,
+        "resume_event": threading.Event(),
+        "cancel_event": threading.Event(),  # Set by /cancel to cut short in-loop waits
+        "task": task,
+        "step": 0,
+        "phase": phase,
+        "chat_id": str(chat_id),
+        "session_name": session_name,
+        "started": time.time(),
+    }
+    state["resume_event"].set()  # Not paused initially
+    return state
+
+
+def _wake_loop(state):
+    """Wake a loop thread blocked in a cancellable wait after its state was marked inactive."""
+    cancel_event = state.get("cancel_event")
+    if cancel_event:
+        cancel_event.set()
+
+
 def _ws_stream(chat_id, op, message_id, session="", **kwargs):
     """Send a WS-native stream event for the app.
     Unlike TG edits (full text, 1/sec), these carry lightweight deltas.
@@ -793,8 +1064,13 @@ def send_message(chat_id, text, reply_markup=None, parse_mode="Markdown", retrie
     Also broadcasts via WebSocket unless _ws_suppress is set (stream events replace it).
     session_name: if provided, use this as the WS session label instead of get_active_session().
     """
+    # Anything queued via send_message_nowait for this chat goes out first, so order is preserved
+    if _outbox_pending.get(str(chat_id)) and threading.current_thread() is not _outbox_thread:
+        flush_pending_outbox(chat_id)
     max_len = 4000
-    chunks = [text[i:i + max_len] for i in range(0, len(text), max_len)]
+    # Break long replies at a newline where possible so a Markdown entity isn't cut in half
+    # (a broken entity costs the plain-text resend round trip below)
+    chunks = [text] if len(text) <= max_len else list(_iter_split(text, max_len))
     message_id = None
 
     for i, chunk in enumerate(chunks):
@@ -809,12 +1085,12 @@ def send_message(chat_id, text, reply_markup=None, parse_mode="Markdown", retrie
         for attempt in range(retries):
             try:
                 # Use shorter timeout (3s connect, 7s read) to prevent blocking the app during network drops
-                resp = requests.post(f"{API_URL}/sendMessage", json=payload, timeout=(3.0, 7.0))
+                resp = _tg_session.post(f"{API_URL}/sendMessage", json=payload, timeout=(3.0, 7.0))
                 result = resp.json()
                 if not result.get("ok") and parse_mode:
                     # Retry without markdown
                     payload.pop("parse_mode", None)
-                    resp = requests.post(f"{API_URL}/sendMessage", json=payload, timeout=(3.0, 7.0))
+                    resp = _tg_session.post(f"{API_URL}/sendMessage", json=payload, timeout=(3.0, 7.0))
                     result = resp.json()
                 if result.get("ok"):
                     chunk_msg_id = result.get("result", {}).get("message_id")
@@ -837,6 +1113,7 @@ def send_message(chat_id, text, reply_markup=None, parse_mode="Markdown", retrie
             chunk_msg_id = -int(time.time() * 1000) % 1000000000
             if i == 0:
                 message_id = chunk_msg_id
+        _last_sent_id[str(chat_id)] = chunk_msg_id
 
         # Broadcast via WebSocket (independent of TG success/failure)
         # Suppressed when streaming — stream events replace legacy message/edit broadcasts
@@ -869,17 +1146,92 @@ def send_message_no_ws(chat_id, text, reply_markup=None, parse_mode="Markdown"):
     if reply_markup:
         payload["reply_markup"] = reply_markup
     try:
-        resp = requests.post(f"{API_URL}/sendMessage", json=payload, timeout=30)
+        resp = _tg_session.post(f"{API_URL}/sendMessage", json=payload, timeout=30)
         result = resp.json()
         if not result.get("ok") and parse_mode:
             payload.pop("parse_mode", None)
-            resp = requests.post(f"{API_URL}/sendMessage", json=payload, timeout=30)
+            resp = _tg_session.post(f"{API_URL}/sendMessage", json=payload, timeout=30)
     except Exception as e:
         print(f"send_message_no_ws error: {e}", flush=True)
 
 
-_last_edit_time = {}  # message_id -> timestamp
-_last_edit_cleanup = 0  # timestamp of last cleanup
+_outbox = deque()  # (chat_id, text, session_name) queued by send_message_nowait
+_outbox_cond = threading.Condition()  # guards _outbox/_outbox_pending; notified on enqueue and after each send
+_outbox_pending = {}  # str(chat_id) -> queued-but-unsent count
+_outbox_thread = None  # the single sender thread (started lazily)
+_OUTBOX_COALESCE_SECS = 0.2  # how long the sender waits for more lines before posting
+_outbox_flush_now = threading.Event()  # set by flush_pending_outbox to cut the coalescing wait short
+
+
+def _outbox_worker():
+    """Drain _outbox in order, joining adjacent same-chat lines (under 4000 chars) into one sendMessage."""
+    while True:
+        with _outbox_cond:
+            while not _outbox:
+                _outbox_cond.wait()
+        _outbox_flush_now.wait(_OUTBOX_COALESCE_SECS)  # let a burst of status lines pile up
+        _outbox_flush_now.clear()
+        with _outbox_cond:
+            items = list(_outbox)
+            _outbox.clear()
+        batches = []  # [chat_id, text, session_name, count]
+        for chat_id, text, session_name in items:
+            last = batches[-1] if batches else None
+            if last and last[0] == chat_id and last[2] == session_name and len(last[1]) + len(text) < 4000:
+                last[1] += "\n\n" + text
+                last[3] += 1
+            else:
+                batches.append([chat_id, text, session_name, 1])
+        for chat_id, text, session_name, count in batches:
+            try:
+                send_message(chat_id, text, session_name=session_name)
+            except Exception as e:
+                print(f"outbox send error: {e}", flush=True)
+            with _outbox_cond:
+                key = str(chat_id)
+                _outbox_pending[key] -= count
+                if _outbox_pending[key] <= 0:
+                    del _outbox_pending[key]
+                _outbox_cond.notify_all()
+
+
+def send_message_nowait(chat_id, text):
+    """Queue a fire-and-forget notice so a long-running loop doesn't block on the Telegram round trip.
+
+    Lines queued close together are coalesced into one message. Use send_message when the
+    message_id is needed; it flushes this chat's queue first so ordering is kept.
+    """
+    global _outbox_thread
+    # Capture the WS label now — the sender thread doesn't carry this thread's override
+    session_name = getattr(_ws_session_override, 'name', None)
+    with _outbox_cond:
+        if _outbox_thread is None or not _outbox_thread.is_alive():
+            _outbox_thread = threading.Thread(target=_outbox_worker, daemon=True)
+            _outbox_thread.start()
+        _outbox.append((chat_id, text, session_name))
+        key = str(chat_id)
+        _outbox_pending[key] = _outbox_pending.get(key, 0) + 1
+        _outbox_cond.notify_all()
+
+
+def flush_pending_outbox(chat_id=None, timeout=30):
+    """Send everything queued by send_message_nowait for chat_id (or every chat) now, and block until it's out."""
+    if chat_id is None:
+        done = lambda: not _outbox_pending
+    else:
+        key = str(chat_id)
+        done = lambda: not _outbox_pending.get(key)
+    with _outbox_cond:
+        if done():
+            return
+        _outbox_flush_now.set()
+        _outbox_cond.wait_for(done, timeout=timeout)
+
+
+_last_sent_id = {}  # chat_id -> message_id of the newest message we sent (lets StatusThrottler edit safely)
+_last_edit_time = OrderedDict()  # message_id -> timestamp of last edit, least recently edited first
+_last_edit_lock = threading.Lock()  # guards _last_edit_time's move/evict across streaming threads
+_EDIT_TIMES_MAX = 10000  # least recently edited entries are evicted beyond this
 EDIT_MIN_INTERVAL = 1.0  # Minimum seconds between edits to the same message
 
 
@@ -887,8 +1239,6 @@ def edit_message(chat_id, message_id, text, parse_mode="Markdown", force=False):
     """Edit an existing message. Rate-limited to 1 edit/sec per message.
     Also broadcasts via WebSocket unless _ws_suppress is set (stream events replace it).
     """
-    global _last_edit_cleanup
-
     if not message_id:
         if force:
             # No message_id but forced — send as new message instead
@@ -897,19 +1247,14 @@ def edit_message(chat_id, message_id, text, parse_mode="Markdown", force=False):
 
     # Rate-limit edits per message (skip unless forced, e.g. final update)
     now = time.time()
-    if not force and message_id in _last_edit_time:
-        elapsed = now - _last_edit_time[message_id]
-        if elapsed < EDIT_MIN_INTERVAL:
+    with _last_edit_lock:
+        last = _last_edit_time.get(message_id)
+        if not force and last is not None and now - last < EDIT_MIN_INTERVAL:
             return
-    _last_edit_time[message_id] = now
-
-    # Periodically purge stale entries (older than 10 minutes)
-    if now - _last_edit_cleanup > 300:
-        _last_edit_cleanup = now
-        cutoff = now - 600
-        stale = [k for k, v in _last_edit_time.items() if v < cutoff]
-        for k in stale:
-            del _last_edit_time[k]
+        _last_edit_time[message_id] = now
+        _last_edit_time.move_to_end(message_id)
+        if len(_last_edit_time) > _EDIT_TIMES_MAX:
+            _last_edit_time.popitem(last=False)
 
     # Truncate if too long
     if len(text) > 4000:
@@ -942,7 +1287,7 @@ def edit_message(chat_id, message_id, text, parse_mode="Markdown", force=False):
 
     for attempt in range(max_attempts):
         try:
-            resp = requests.post(f"{API_URL}/editMessageText", json=payload, timeout=timeout)
+            resp = _tg_session.post(f"{API_URL}/editMessageText", json=payload, timeout=timeout)
             result = resp.json()
             if not result.get("ok"):
                 error_desc = result.get("description", "")
@@ -951,7 +1296,7 @@ def edit_message(chat_id, message_id, text, parse_mode="Markdown", force=False):
                 elif parse_mode:
                     # Retry without markdown if parsing fails
                     payload.pop("parse_mode", None)
-                    resp2 = requests.post(f"{API_URL}/editMessageText", json=payload, timeout=(3.0, 7.0))
+                    resp2 = _tg_session.post(f"{API_URL}/editMessageText", json=payload, timeout=(3.0, 7.0))
                     result2 = resp2.json()
                     if not result2.get("ok") and force:
                         print(f"edit_message failed even without markdown (msg_id={message_id}): {result2.get('description')}", flush=True)
@@ -971,6 +1316,42 @@ def edit_message(chat_id, message_id, text, parse_mode="Markdown", force=False):
         print(f"edit_message: all retries failed for msg_id={message_id}, giving up", flush=True)
 
 
+class StatusThrottler:
+    """Fold short bursts of loop status lines into one Telegram message.
+
+    push() edits the previous status message (appending a line) when it was sent less than
+    `window` seconds ago AND is still the newest message in the chat; otherwise sends a new one.
+    Long-form output (review bodies, audit results) should keep using send_message directly.
+    If `state` (a loop state dict) is given, pushes are dropped once /cancel has cleared its
+    "active" flag — the user already got the cancellation notice.
+    """
+
+    def __init__(self, chat_id, window=5.0, state=None):
+        self.chat_id = chat_id
+        self.window = window
+        self.state = state
+        self._last_id = None
+        self._last_text = ""
+        self._last_send = 0
+
+    def push(self, text):
+        if self.state is not None and not self.state.get("active", False):
+            return None
+        if _outbox_pending.get(str(self.chat_id)):
+            flush_pending_outbox(self.chat_id)  # queued notices must land before we decide whether to edit
+        now = time.time()
+        if (self._last_id and now - self._last_send < self.window
+                and _last_sent_id.get(str(self.chat_id)) == self._last_id
+                and len(self._last_text) + len(text) < 3900):
+            self._last_text += "\n\n" + text
+            edit_message(self.chat_id, self._last_id, self._last_text, force=True)
+        else:
+            self._last_id = send_message(self.chat_id, text)
+            self._last_text = text
+        self._last_send = now
+        return self._last_id
+
+
 def send_document(chat_id, file_path, caption=None):
     """Send a file to the user via Telegram."""
     try:
@@ -978,7 +1359,7 @@ def send_document(chat_id, file_path, caption=None):
             payload = {"chat_id": chat_id}
             if caption:
                 payload["caption"] = caption[:1024]
-            resp = requests.post(
+            resp = _tg_session.post(
                 f"{API_URL}/sendDocument",
                 data=payload,
                 files={"document": (os.path.basename(file_path), f)},
@@ -1000,7 +1381,7 @@ def send_photo(chat_id, file_path, caption=None):
             payload = {"chat_id": chat_id}
             if caption:
                 payload["caption"] = caption[:1024]
-            resp = requests.post(
+            resp = _tg_session.post(
                 f"{API_URL}/sendPhoto",
                 data=payload,
                 files={"photo": (os.path.basename(file_path), f)},
@@ -1020,7 +1401,7 @@ def send_photo(chat_id, file_path, caption=None):
 def send_typing(chat_id):
     """Send typing indicator."""
     try:
-        requests.post(f"{API_URL}/sendChatAction",
+        _tg_session.post(f"{API_URL}/sendChatAction",
                      json={"chat_id": chat_id, "action": "typing"}, timeout=10)
     except Exception:
         pass
@@ -1032,7 +1413,7 @@ def answer_callback_query(callback_query_id, text=None):
         payload = {"callback_query_id": callback_query_id}
         if text:
             payload["text"] = text
-        requests.post(f"{API_URL}/answerCallbackQuery", json=payload, timeout=10)
+        _tg_session.post(f"{API_URL}/answerCallbackQuery", json=payload, timeout=10)
     except Exception as e:
         print(f"Error answering callback: {e}")
 
@@ -1040,7 +1421,7 @@ def answer_callback_query(callback_query_id, text=None):
 def edit_message_reply_markup(chat_id, message_id, reply_markup=None):
     """Remove inline keyboard after selection."""
     try:
-        requests.post(f"{API_URL}/editMessageReplyMarkup",
+        _tg_session.post(f"{API_URL}/editMessageReplyMarkup",
                      json={"chat_id": chat_id, "message_id": message_id,
                            "reply_markup": reply_markup}, timeout=10)
     except Exception:
@@ -1093,6 +1474,7 @@ def set_pending_questions(chat_id, questions, session):
     chat_key = str(chat_id)
     pending_questions[chat_key] = {
         "questions": questions,
+        "headers": [q.get("header", f"Q{i+1}") for i, q in enumerate(questions)],
         "answers": {},
         "current_idx": 0,
         "session": session,
@@ -1100,6 +1482,104 @@ def set_pending_questions(chat_id, questions, session):
     send_pending_question(chat_id, pending_questions[chat_key])
 
 
+def _join_pending_answers(pending):
+    """Combined reply for a finished question set: the lone answer, or `header: answer` lines."""
+    answers = pending["answers"]
+    if len(answers) == 1:
+        return answers[0]
+    headers = pending.get("headers")
+    if headers is None:  # set before a hot reload added precomputed headers
+        headers = [q.get("header", f"Q{i+1}") for i, q in enumerate(pending.get("questions", []))]
+    return "\n".join(f"{headers[i] if i < len(headers) else f'Q{i+1}'}: {answers[i]}"
+                     for i in range(len(answers)))
+
+
+def _finalize_pending_answers(chat_id, pending, session):
+    """Clear a finished question set and send the combined answer to Claude (streaming, non-blocking).
+
+    The answer claims the session like any message, so it queues if something else started meanwhile.
+    """
+    pending_questions.pop(str(chat_id), None)
+    if not session:
+        return
+    session_id = get_session_id(session)
+    text, queue_pos = _claim_or_queue(session_id, _join_pending_answers(pending))
+    if text is None:
+        threading.Thread(target=_send_queue_ack, args=(chat_id, session_id, session.get("name", "default"), queue_pos),
+                         daemon=True).start()
+        return
+    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
+    run_claude_in_thread(chat_id, text, session)
+
+
+# parse_claude_output's per-tool handlers: (tool_input, tool_id, file_changes, questions, messages)
+def _tool_ask_user(tool_input, tool_id, file_changes, questions, messages):
+    questions.extend(tool_input.get("questions", []))
+
+
+def _tool_exit_plan(tool_input, tool_id, file_changes, questions, messages):
+    print(f"[DEBUG] parse_claude_output ExitPlanMode tool_id={tool_id}, current questions={len(questions)}", flush=True)
+    questions.append({
+        "question": "Plan is ready. Do you approve this plan?",
+        "header": "Plan Approval",
+        "options": [
+            {"label": "✅ Approve", "description": "Proceed with implementation"},
+            {"label": "❌ Reject", "description": "Revise the plan"},
+        ]
+    })
+
+
+def _tool_enter_plan(tool_input, tool_id, file_changes, questions, messages):
+    messages.append("📋 Entering plan mode...")
+
+
+def _tool_write(tool_input, tool_id, file_changes, questions, messages):
+    file_changes.append({
+        "type": "create",
+        "path": tool_input.get("file_path", "unknown"),
+        "tool_id": tool_id
+    })
+
+
+def _tool_edit(tool_input, tool_id, file_changes, questions, messages):
+    file_changes.append({
+        "type": "edit",
+        "path": tool_input.get("file_path", "unknown"),
+        "old": tool_input.get("old_string", "")[:50],
+        "new": tool_input.get("new_string", "")[:50],
+        "tool_id": tool_id
+    })
+
+
+def _tool_bash(tool_input, tool_id, file_changes, questions, messages):
+    cmd = tool_input.get("command", "")
+    if cmd and len(cmd) < 100:
+        file_changes.append({
+            "type": "bash",
+            "command": cmd,
+            "tool_id": tool_id
+        })
+
+
+def _tool_read(tool_input, tool_id, file_changes, questions, messages):
+    file_changes.append({
+        "type": "read",
+        "path": tool_input.get("file_path", "unknown"),
+        "tool_id": tool_id
+    })
+
+
+_TOOL_HANDLERS = {
+    "AskUserQuestion": _tool_ask_user,
+    "ExitPlanMode": _tool_exit_plan,
+    "EnterPlanMode": _tool_enter_plan,
+    "Write": _tool_write,
+    "Edit": _tool_edit,
+    "Bash": _tool_bash,
+    "Read": _tool_read,
+}
+
+
 def parse_claude_output(output):
     """Parse Claude's JSON stream output for interactive elements."""
     messages = []
@@ -1108,20 +1588,22 @@ def parse_claude_output(output):
     tool_results = {}  # Track tool results by id
     processed_tool_ids = set()  # Track processed tool_use IDs to avoid duplicates
 
-    for line in output.strip().split("\n"):
-        if not line.strip():
+    # split("\n") rather than splitlines(): JSON strings may hold a raw U+2028, which splitlines breaks on
+    for line in output.split("\n"):
+        if not line or line.isspace():
             continue
         try:
-            data = json.loads(line)
+            data = _json_loads(line)
             msg_type = data.get("type")
 
             if msg_type == "assistant":
                 # Regular text response
                 content = data.get("message", {}).get("content", [])
                 for block in content:
-                    if block.get("type") == "text":
+                    block_type = block.get("type")
+                    if block_type == "text":
                         messages.append(block.get("text", ""))
-                    elif block.get("type") == "tool_use":
+                    elif block_type == "tool_use":
                         tool_name = block.get("name")
                         tool_input = block.get("input", {})
                         tool_id = block.get("id")
@@ -1132,53 +1614,9 @@ def parse_claude_output(output):
                         if tool_id:
                             processed_tool_ids.add(tool_id)
 
-                        if tool_name == "AskUserQuestion":
-                            questions.extend(tool_input.get("questions", []))
-                        elif tool_name == "ExitPlanMode":
-                            print(f"[DEBUG] parse_claude_output ExitPlanMode tool_id={tool_id}, current questions={len(questions)}", flush=True)
-                            questions.append({
-                                "question": "Plan is ready. Do you approve this plan?",
-                                "header": "Plan Approval",
-                                "options": [
-                                    {"label": "✅ Approve", "description": "Proceed with implementation"},
-                                    {"label": "❌ Reject", "description": "Revise the plan"},
-                                ]
-                            })
-                        elif tool_name == "EnterPlanMode":
-                            messages.append("📋 Entering plan mode...")
-                        elif tool_name == "Write":
-                            file_path = tool_input.get("file_path", "unknown")
-                            file_changes.append({
-                                "type": "create",
-                                "path": file_path,
-                                "tool_id": tool_id
-                            })
-                        elif tool_name == "Edit":
-                            file_path = tool_input.get("file_path", "unknown")
-                            old_str = tool_input.get("old_string", "")[:50]
-                            new_str = tool_input.get("new_string", "")[:50]
-                            file_changes.append({
-                                "type": "edit",
-                                "path": file_path,
-                                "old": old_str,
-                                "new": new_str,
-                                "tool_id": tool_id
-                            })
-                        elif tool_name == "Bash":
-                            cmd = tool_input.get("command", "")
-                            if cmd and len(cmd) < 100:
-                                file_changes.append({
-                                    "type": "bash",
-                                    "command": cmd,
-                                    "tool_id": tool_id
-                                })
-                        elif tool_name == "Read":
-                            file_path = tool_input.get("file_path", "unknown")
-                            file_changes.append({
-                                "type": "read",
-                                "path": file_path,
-                                "tool_id": tool_id
-                            })
+                        handler = _TOOL_HANDLERS.get(tool_name)
+                        if handler:
+                            handler(tool_input, tool_id, file_changes, questions, messages)
 
             elif msg_type == "user":
                 # Tool results
@@ -1225,6 +1663,25 @@ def parse_claude_output(output):
     return "\n".join(messages), questions
 
 
+def _iter_split(text, max_len):
+    """Yield slices of text no longer than max_len, preferring to break after a newline."""
+    i = 0
+    n = len(text)
+    while i < n:
+        end = min(i + max_len, n)
+        if end < n:
+            nl = text.rfind("\n", i, end)
+            if nl > i + max_len // 2:
+                end = nl + 1
+        yield text[i:end]
+        i = end
+
+
+def _trunc(s, n):
+    """Truncate s to at most n characters, marking the cut with an ellipsis."""
+    return s if len(s) <= n else s[:n - 1] + "…"
+
+
 def shorten_path(path):
     """Shorten a file path for display."""
     if len(path) <= 50:
@@ -1235,12 +1692,15 @@ def shorten_path(path):
     return f".../{'/'.join(parts[-2:])}"
 
 
+# Gemini tool_use parameter keys that carry the displayable target, in priority order
+_PATH_KEYS = ("file_path", "command", "pattern", "dir_path")
+
+
 def format_tool_status(tool_name, path=""):
     """Format a tool-use status line matching Claude-level detail."""
     name = tool_name.lower()
     if name in ("bash", "run_shell_command", "shell", "command_execution") and path:
-        preview = path[:60] + "..." if len(path) > 60 else path
-        return f"\n\n🔧 _Running:_ `{preview}`"
+        return f"\n\n🔧 _Running:_ `{_trunc(path, 60)}`"
     elif name in ("write", "write_file", "create_file") and path:
         return f"\n\n🔧 _Writing:_ `{shorten_path(path)}`"
     elif name in ("edit", "replace", "edit_file") and path:
@@ -1248,8 +1708,7 @@ def format_tool_status(tool_name, path=""):
     elif name in ("read", "read_file") and path:
         return f"\n\n🔧 _Reading:_ `{shorten_path(path)}`"
     elif name in ("glob", "grep", "grep_search", "find_files") and path:
-        preview = path[:50] + "..." if len(path) > 50 else path
-        return f"\n\n🔧 _Searching:_ `{preview}`"
+        return f"\n\n🔧 _Searching:_ `{_trunc(path, 50)}`"
     elif path:
         return f"\n\n🔧 _{tool_name}:_ `{shorten_path(path)}`"
     else:
@@ -1269,15 +1728,12 @@ PERMISSION_PATTERNS = [
     "grant me permission",
     "allow me to",
 ]
+_PERMISSION_RE = re.compile("|".join(map(re.escape, PERMISSION_PATTERNS)), re.IGNORECASE)  # one pass, no lowered copy
 
 
 def detect_permission_request(text):
     """Check if Claude's output indicates it needs permission."""
-    text_lower = text.lower()
-    for pattern in PERMISSION_PATTERNS:
-        if pattern in text_lower:
-            return True
-    return False
+    return _PERMISSION_RE.search(text) is not None
 
 
 def create_permission_question():
@@ -1292,6 +1748,37 @@ def create_permission_question():
     }
 
 
+def kill_process_group(process, sig=signal.SIGKILL):
+    """Signal a CLI child and everything it spawned.
+
+    Every CLI is started with start_new_session=True, so the child leads its own process group and
+    pgid == pid. Using the pid directly skips os.getpgid(), which raises once the leader has exited
+    even while its children are still running.
+    """
+    os.killpg(process.pid, sig)
+
+
+def _kill_on_cancel(process, cancel_event):
+    """Kill `process` within ~1s of `cancel_event` being set. Returns an Event that stops the watcher."""
+    stop = threading.Event()
+    if cancel_event is None:
+        return stop
+
+    def _watch():
+        while not stop.is_set() and process.poll() is None:
+            if cancel_event.wait(1):
+                if not stop.is_set() and process.poll() is None:
+                    print(f"Cancelled, killing pid {process.pid}", flush=True)
+                    try:
+                        kill_process_group(process)
+                    except Exception:
+                        process.kill()
+                break
+
+    threading.Thread(target=_watch, daemon=True).start()
+    return stop
+
+
 def run_claude(prompt, cwd=None, continue_session=False, extra_args=None):
     """Run Claude CLI with session support (non-streaming)."""
     cmd = ["claude", "-p", "--verbose", "--output-format", "stream-json", "--model", "opus"]
@@ -1328,6 +1815,7 @@ def run_claude(prompt, cwd=None, continue_session=False, extra_args=None):
         # Try to parse as JSON stream
         if output.strip():
             text, questions = parse_claude_output(output)
+            _maybe_malloc_trim(len(output))
             # Option B: Detect permission requests and create a question
             if text and detect_permission_request(text) and not questions:
                 questions.append(create_permission_question())
@@ -1347,6 +1835,49 @@ def run_claude(prompt, cwd=None, continue_session=False, extra_args=None):
         return f"Error running Claude: {e}", []
 
 
+def run_claude_oneshot(prompt, timeout=120, cancel_event=None):
+    """Tool-less Claude call for internal text jobs (summaries). Returns the reply text, or None.
+
+    Runs with no tools in a throwaway cwd so it can't touch the project, is killed on timeout or
+    when `cancel_event` is set, and is skipped while a Claude rate limit is in force.
+    """
+    if _quota_until.get("claude", 0) > time.time():
+        return None
+    cmd = ["claude", "-p", "--output-format", "text", "--model", "opus", "--tools", ""]
+    process = None
+    cancel_watch = None
+    try:
+        with tempfile.TemporaryDirectory(prefix="claude-oneshot-") as work_dir:
+            process = subprocess.Popen(
+                cmd, cwd=work_dir,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                start_new_session=True
+            )
+            cancel_watch = _kill_on_cancel(process, cancel_event)
+            stdout, _ = process.communicate(prompt, timeout=timeout)
+        if process.returncode != 0:
+            return None
+        return stdout.strip() or None
+    except subprocess.TimeoutExpired:
+        print(f"[Claude] One-shot call timed out after {timeout}s", flush=True)
+        return None
+    except Exception as e:
+        print(f"[Claude] One-shot call failed: {e}", flush=True)
+        return None
+    finally:
+        if cancel_watch:
+            cancel_watch.set()
+        if process and process.poll() is None:
+            try:
+                kill_process_group(process)
+            except Exception:
+                process.kill()
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                pass
+
+
 def run_claude_streaming(prompt, chat_id, cwd=None, continue_session=False, session_id=None, session=None):
     """Run Claude CLI with streaming output to Telegram."""
     cmd = ["claude", "-p", "--verbose", "--output-format", "stream-json", "--model", "opus"]
@@ -1570,7 +2101,7 @@ def run_claude_streaming(prompt, chat_id, cwd=None, continue_session=False, sess
                     # We don't need anything from them — skip entirely.
                     print(f"[STREAM] Skipping large user line #{line_count}: {line_len} bytes", flush=True)
                     line = None
-                    _malloc_trim()
+                    _maybe_malloc_trim(line_len)
                     continue
 
                 if line_len > LARGE_LINE_THRESHOLD and '"type":"assistant"' in line[:200]:
@@ -1657,13 +2188,13 @@ def run_claude_streaming(prompt, chat_id, cwd=None, continue_session=False, sess
                     head = None
                     tail = None
                     line = None
-                    _malloc_trim()
+                    _maybe_malloc_trim(line_len)
                     continue
 
                 # ── Normal-sized lines: full JSON parsing ──
                 if line_len > LARGE_LINE_THRESHOLD:
                     print(f"[STREAM] Large line #{line_count} ({line_len} bytes) fell through to json.loads! type_hint={line[:50]}", flush=True)
-                data = json.loads(line)
+                data = _json_loads(line)
                 msg_type = data.get("type")
 
                 # Capture Claude's session_id from init message
@@ -1698,7 +2229,7 @@ def run_claude_streaming(prompt, chat_id, cwd=None, continue_session=False, sess
             if line_len > LARGE_LINE_THRESHOLD:
                 data = None
                 line = None
-                _malloc_trim()
+                _maybe_malloc_trim(line_len)
 
         stdout_reader.close()
         process.wait()
@@ -1733,11 +2264,11 @@ def run_claude_streaming(prompt, chat_id, cwd=None, continue_session=False, sess
                 elif change["type"] == "edit":
                     final_chunk += f"\n  ✅ Edited: `{shorten_path(change['path'])}`"
                 elif change["type"] == "bash":
-                    final_chunk += f"\n  ✅ Ran: `{change['path'][:80]}{'...' if len(change['path']) > 80 else ''}`"
+                    final_chunk += f"\n  ✅ Ran: `{_trunc(change['path'], 80)}`"
                 elif change["type"] == "read":
                     final_chunk += f"\n  📖 Read: `{shorten_path(change['path'])}`"
                 elif change["type"] in ["glob", "grep"]:
-                    final_chunk += f"\n  🔍 Search: `{change['path'][:60]}{'...' if len(change['path']) > 60 else ''}`"
+                    final_chunk += f"\n  🔍 Search: `{_trunc(change['path'], 60)}`"
 
         # Wait for stderr drain
         try:
@@ -1775,14 +2306,13 @@ def run_claude_streaming(prompt, chat_id, cwd=None, continue_session=False, sess
             # Final chunk is too long, need to split it
             if message_id:
                 try:
-                    requests.post(f"{API_URL}/deleteMessage",
+                    _tg_session.post(f"{API_URL}/deleteMessage",
                                 json={"chat_id": chat_id, "message_id": message_id}, timeout=5)
                 except Exception:
                     pass
             # Send remaining chunks as new messages
             max_len = 3900
-            chunks = [final_chunk[i:i + max_len] for i in range(0, len(final_chunk), max_len)]
-            for chunk in chunks:
+            for chunk in _iter_split(final_chunk, max_len):
                 send_message(chat_id, chunk)
                 time.sleep(0.2)  # Small delay to maintain order
 
@@ -1795,6 +2325,8 @@ def run_claude_streaming(prompt, chat_id, cwd=None, continue_session=False, sess
         active_processes.pop(process_key, None)
         _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
         mark_session_done(process_key)
+        if file_changes and cwd:
+            invalidate_project_file_index(cwd)
 
         _ws_suppress.active = False
         return accumulated_text, questions, message_id, new_claude_session_id, context_overflow
@@ -1869,6 +2401,8 @@ def create_session(chat_id, project_name, cwd):
 
     user_sessions[chat_key]["sessions"].append(session)
     user_sessions[chat_key]["active"] = session_id  # Use session_id as identifier
+    _session_by_id.setdefault(chat_key, {})[session_id] = session
+    _session_name_index.pop(chat_key, None)
     save_sessions(force=True)
 
     return session
@@ -1902,15 +2436,49 @@ def set_active_session(chat_id, session_id):
         save_sessions(force=True)
 
 
+def _chat_session_by_id(chat_id, session_id):
+    """The session `session_id` in this chat, or None. Keyed per chat: legacy ids are cwds two chats can share."""
+    return _session_by_id.get(str(chat_id), {}).get(session_id)
+
+
 def get_session_by_id(chat_id, session_id):
     """Get a specific session by its ID (not the active one)."""
+    s = _chat_session_by_id(chat_id, session_id)
+    if s is not None:
+        return s
+    # Rare miss path: legacy callers may look a session up by cwd while it is indexed under its id
     chat_key = str(chat_id)
     for s in user_sessions.get(chat_key, {}).get("sessions", []):
-        if s.get("id") == session_id or s.get("cwd") == session_id:
+        if s.get("cwd") == session_id:
             return s
     return None
 
 
+def find_session_index_by_name(chat_id, target):
+    """Index of the session named `target` (case-insensitive), else of the earliest one starting with it, else None."""
+    chat_key = str(chat_id)
+    sessions = user_sessions.get(chat_key, {}).get("sessions", [])
+    cached = _session_name_index.get(chat_key)
+    if cached is None or cached[2] is not sessions or cached[3] != len(sessions):
+        names = sorted((s["name"].lower(), i) for i, s in enumerate(sessions))
+        exact = {}
+        for name, i in names:
+            exact.setdefault(name, i)
+        cached = _session_name_index[chat_key] = (names, exact, sessions, len(sessions))
+    names, exact = cached[0], cached[1]
+    target = target.lower()
+    if target in exact:
+        return exact[target]
+    # Names sharing the prefix are contiguous in sorted order; keep the old "first in list" tie-break
+    start = bisect.bisect_left(names, (target,))
+    matches = []
+    for name, i in names[start:]:
+        if not name.startswith(target):
+            break
+        matches.append(i)
+    return min(matches) if matches else None
+
+
 def get_session_id(session):
     """Get the session ID, supporting both new and legacy sessions."""
     return session.get("id") or session.get("cwd")
@@ -2046,10 +2614,13 @@ def update_session_state(chat_id, session, prompt, cli_name):
 
 
 def update_cli_session_id(chat_id, session, cli_name, new_sid):
-    """Update a specific CLI's session ID for resuming conversations."""
+    """Update a specific CLI's session ID for resuming conversations.
+
+    Returns the stored session dict that was updated, or None if not found.
+    """
     chat_key = str(chat_id)
     if chat_key not in user_sessions:
-        return
+        return None
 
     session_id = get_session_id(session)
     key_map = {
@@ -2059,18 +2630,19 @@ def update_cli_session_id(chat_id, session, cli_name, new_sid):
     }
     sid_key = key_map.get(cli_name)
     if not sid_key:
-        return
+        return None
 
-    for s in user_sessions[chat_key]["sessions"]:
-        if get_session_id(s) == session_id:
-            s[sid_key] = new_sid
-            save_sessions(force=True)
-            break
+    s = _chat_session_by_id(chat_id, session_id)
+    if s is None:
+        return None
+    s[sid_key] = new_sid
+    save_sessions(force=True)
+    return s
 
 
 def update_claude_session_id(chat_id, session, claude_session_id):
-    """Legacy wrapper for Claude session ID updates."""
-    update_cli_session_id(chat_id, session, "Claude", claude_session_id)
+    """Legacy wrapper for Claude session ID updates. Returns the updated session dict or None."""
+    return update_cli_session_id(chat_id, session, "Claude", claude_session_id)
 
 
 def save_session_summary(chat_id, session, summary):
@@ -2082,8 +2654,9 @@ def save_session_summary(chat_id, session, summary):
     session_id = get_session_id(session)
     for s in user_sessions[chat_key]["sessions"]:
         if get_session_id(s) == session_id:
-            s["last_summary"] = summary
-            save_sessions()
+            if s.get("last_summary") != summary:  # Skip the sessions.json rewrite when nothing changed
+                s["last_summary"] = summary
+                save_sessions()
             break
 
 
@@ -2091,6 +2664,15 @@ def save_session_summary(chat_id, session, summary):
 # Opus 4.6 has ~200K context window, so 30 messages keeps context focused
 # without compacting too aggressively
 COMPACTION_THRESHOLD = 30
+# Deepreview defers that proactive compaction while its own review history is below this many
+# (estimated) tokens — the summary round trip isn't worth it yet, and context_overflow recovery
+# still catches a genuinely full session
+CTX_BUDGET_SOFT = 4000
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 chars per token)."""
+    return len(text) // 4
 
 
 def increment_message_count(chat_id, session, cli_name):
@@ -2141,31 +2723,32 @@ def is_allowed(chat_id):
     return str(chat_id) in ALLOWED_CHAT_IDS
 
 
-def run_codex(prompt, cwd=None, session=None, stale_timeout=300):
+def _codex_exec_cmd(prompt, resume_id=None, json_output=False):
+    """Build the `codex exec` argv shared by every Codex call site (xhigh reasoning, no sandbox)."""
+    cmd = [
+        "codex", "exec",
+        "-m", CODEX_MODEL,
+        "-c", 'model_reasoning_effort="xhigh"',
+        "--dangerously-bypass-approvals-and-sandbox",
+    ]
+    if json_output:
+        cmd.append("--json")
+    if resume_id:
+        cmd += ["resume", resume_id]
+    cmd.append(prompt)
+    return cmd
+
+
+def run_codex(prompt, cwd=None, session=None, stale_timeout=300, cancel_event=None):
     """Run Codex synchronously and return the output text.
 
     Uses a stale-output watchdog instead of a hard wall-clock timeout:
     the process is only killed if no stdout is produced for stale_timeout seconds.
+    If cancel_event is given, the process is also killed within ~1s of it being set.
     """
     codex_sid = session.get("codex_session_id") if session else None
 
-    if codex_sid:
-        cmd = [
-            "codex", "exec",
-            "-m", CODEX_MODEL,
-            "-c", 'model_reasoning_effort="xhigh"',
-            "--dangerously-bypass-approvals-and-sandbox", "--json",
-            "resume", codex_sid,
-            prompt
-        ]
-    else:
-        cmd = [
-            "codex", "exec",
-            "-m", CODEX_MODEL,
-            "-c", 'model_reasoning_effort="xhigh"',
-            "--dangerously-bypass-approvals-and-sandbox", "--json",
-            prompt
-        ]
+    cmd = _codex_exec_cmd(prompt, resume_id=codex_sid, json_output=True)
 
     try:
         process = subprocess.Popen(
@@ -2193,16 +2776,25 @@ def run_codex(prompt, cwd=None, session=None, stale_timeout=300):
 
         def _watchdog():
             nonlocal timed_out
+            # Poll faster when a cancel_event is attached so /cancel doesn't wait out the stale timeout
+            interval = 1 if cancel_event is not None else 30
             while not watchdog_stop.is_set():
-                watchdog_stop.wait(30)
+                watchdog_stop.wait(interval)
                 if watchdog_stop.is_set():
                     break
+                if cancel_event is not None and cancel_event.is_set():
+                    print("run_codex: cancelled, killing process", flush=True)
+                    try:
+                        kill_process_group(process)
+                    except Exception:
+                        process.kill()
+                    break
                 elapsed = time.time() - last_output_time
                 if elapsed > stale_timeout:
                     print(f"run_codex: no output for {elapsed:.0f}s, killing stale process", flush=True)
                     timed_out = True
                     try:
-                        os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+                        kill_process_group(process)
                     except Exception:
                         process.kill()
                     break
@@ -2229,7 +2821,7 @@ def run_codex(prompt, cwd=None, session=None, stale_timeout=300):
             if not line:
                 continue
             try:
-                event = json.loads(line)
+                event = _json_loads(line)
                 if event.get("type") == "thread.started" and event.get("thread_id"):
                     thread_id = event["thread_id"]
                 if event.get("type") == "item.completed":
@@ -2282,7 +2874,7 @@ def run_gemini(prompt, cwd=None, session=None):
         for line in stdout.strip().split("\n"):
             if not line: continue
             try:
-                event = json.loads(line)
+                event = _json_loads(line)
                 if event.get("type") == "message" and event.get("role") == "assistant":
                     accumulated.append(event.get("content", ""))
             except json.JSONDecodeError:
@@ -2323,6 +2915,7 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
 
     accumulated_text = ""
     current_chunk_text = ""
+    chunk_has_content = False  # current_chunk_text has non-whitespace (avoids re-stripping the buffer)
     new_session_id = None
     message_id = None
     message_ids = []
@@ -2375,10 +2968,10 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
                     label = "stale" if got_any_output else "startup"
                     print(f"[Gemini-stream] Watchdog ({label}): no output for {elapsed:.0f}s, killing", flush=True)
                     try:
-                        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+                        kill_process_group(process, signal.SIGTERM)
                         time.sleep(5)
                         if process.poll() is None:
-                            os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+                            kill_process_group(process)
                     except Exception:
                         pass
                     break
@@ -2389,6 +2982,7 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
         message_ids.append(message_id)
         last_update = 0
         current_tool = None
+        tool_status = ""  # Pending tool status line, flushed by the periodic update
         gemini_errors = []
 
         stdout_reader = io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace')
@@ -2402,7 +2996,7 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
             got_any_output = True
             line_len = len(line)
             try:
-                event = json.loads(line)
+                event = _json_loads(line)
                 etype = event.get("type", "")
 
                 if etype == "init":
@@ -2435,6 +3029,7 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
                                     spacing = " "
                             accumulated_text += spacing + append_text
                             current_chunk_text += spacing + append_text
+                            chunk_has_content = chunk_has_content or bool(append_text.strip())
                             current_tool = None
 
                 elif etype == "tool_use":
@@ -2445,7 +3040,7 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
                         processed_tool_ids.add(tool_id)
                     tool_name = event.get("tool_name") or "tool"
                     params = event.get("parameters", {})
-                    path = params.get("file_path") or params.get("command") or params.get("pattern") or params.get("dir_path") or ""
+                    path = next((params[k] for k in _PATH_KEYS if params.get(k)), "")
                     change = {"type": tool_name.lower(), "path": path[:100]}
                     if tool_name.lower() in ("edit", "replace"):
                         change["old"] = (params.get("old_string") or "")[:3000]
@@ -2454,12 +3049,7 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
                         change["content"] = (params.get("content") or "")[:3000]
                     file_changes.append(change)
                     current_tool = tool_name
-                    now = time.time()
-                    if now - last_update >= update_interval:
-                        display_text = current_chunk_text if current_chunk_text.strip() else "⏳"
-                        status = format_tool_status(tool_name, path)
-                        edit_message(chat_id, message_id, display_text + status)
-                        last_update = now
+                    tool_status = format_tool_status(tool_name, path)  # Flushed by the periodic update
 
                 elif etype == "tool_result":
                     current_tool = None
@@ -2469,9 +3059,10 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
                     print(f"[Gemini-stream] result: status={event.get('status')}, tokens={stats.get('total_tokens')}, tool_calls={stats.get('tool_calls')}", flush=True)
 
                 elif etype == "error":
-                    error_msg = event.get("message") or event.get("error") or str(event)
-                    gemini_errors.append(error_msg[:300])
-                    print(f"[Gemini-stream] Error event: {error_msg[:300]}", flush=True)
+                    error_msg = event.get("message") or event.get("error")
+                    error_msg = str(error_msg)[:300] if error_msg else repr(event)[:300]
+                    gemini_errors.append(error_msg)
+                    print(f"[Gemini-stream] Error event: {error_msg}", flush=True)
 
                 # Chunk overflow
                 while len(current_chunk_text) > max_chunk_len:
@@ -2481,20 +3072,24 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
                     message_id = send_message(chat_id, "⏳ _continuing..._")
                     message_ids.append(message_id)
                     current_chunk_text = carry_over
+                    chunk_has_content = bool(carry_over.strip())
                     last_update = time.time()
 
                 # Periodic update
                 now = time.time()
                 if now - last_update >= update_interval:
-                    display_text = current_chunk_text if current_chunk_text.strip() else "⏳"
-                    suffix = f"\n\n———\n🔧 _{current_tool}_" if current_tool else ("" if not current_chunk_text.strip() else "\n\n———\n⏳ _generating..._")
+                    display_text = current_chunk_text if chunk_has_content else "⏳"
+                    if current_tool:
+                        suffix = tool_status or f"\n\n———\n🔧 _{current_tool}_"
+                    else:
+                        suffix = "" if not chunk_has_content else "\n\n———\n⏳ _generating..._"
                     edit_message(chat_id, message_id, display_text + suffix)
                     last_update = now
 
                 if line_len > 50_000:
                     event = None
                     line = None
-                    _malloc_trim()
+                    _maybe_malloc_trim(line_len)
 
             except json.JSONDecodeError:
                 pass
@@ -2508,13 +3103,10 @@ def run_gemini_streaming(prompt, chat_id, cwd=None, session=None, session_id=Non
 
         # Save gemini session ID for resume
         if new_session_id and session:
-            sid = get_session_id(session)
-            chat_key_s = str(chat_id)
-            for s in user_sessions.get(chat_key_s, {}).get("sessions", []):
-                if get_session_id(s) == sid:
-                    s["gemini_session_id"] = new_session_id
-                    save_sessions(force=True)
-                    break
+            s = _chat_session_by_id(chat_id, get_session_id(session))
+            if s is not None:
+                s["gemini_session_id"] = new_session_id
+                save_sessions(force=True)
 
         # Final message update
         final_chunk = current_chunk_text.strip()
@@ -2682,23 +3274,7 @@ def run_codex_task(chat_id, task, cwd, session=None):
             send_message(chat_id, f"🔍 *{mode} Codex*\nModel: `{CODEX_MODEL}`\nTask: _{task[:100]}_")
 
             # Build command — resume existing session or start new
-            if codex_sid:
-                cmd = [
-                    "codex", "exec",
-                    "-m", CODEX_MODEL,
-                    "-c", 'model_reasoning_effort="xhigh"',
-                    "--dangerously-bypass-approvals-and-sandbox", "--json",
-                    "resume", codex_sid,
-                    current_task
-                ]
-            else:
-                cmd = [
-                    "codex", "exec",
-                    "-m", CODEX_MODEL,
-                    "-c", 'model_reasoning_effort="xhigh"',
-                    "--dangerously-bypass-approvals-and-sandbox", "--json",
-                    current_task
-                ]
+            cmd = _codex_exec_cmd(current_task, resume_id=codex_sid, json_output=True)
 
             process = subprocess.Popen(
                 cmd, cwd=cwd,
@@ -2782,7 +3358,7 @@ def run_codex_task(chat_id, task, cwd, session=None):
 
                 line_len = len(line)
                 try:
-                    event = json.loads(line)
+                    event = _json_loads(line)
                     etype = event.get("type", "")
 
                     if etype == "thread.started":
@@ -2892,7 +3468,7 @@ def run_codex_task(chat_id, task, cwd, session=None):
                     if line_len > 50_000:
                         event = None
                         line = None
-                        _malloc_trim()
+                        _maybe_malloc_trim(line_len)
 
                 except json.JSONDecodeError:
                     pass
@@ -2959,8 +3535,7 @@ def run_codex_task(chat_id, task, cwd, session=None):
             else:
                 # Split if too long
                 max_len = 3900
-                chunks = [final_chunk[i:i + max_len] for i in range(0, len(final_chunk), max_len)]
-                for chunk in chunks:
+                for chunk in _iter_split(final_chunk, max_len):
                     send_message(chat_id, chunk)
                     time.sleep(0.2)
 
@@ -2986,11 +3561,10 @@ def run_codex_task(chat_id, task, cwd, session=None):
             _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
             process_message_queue(chat_id, session)
 
-    # Mark active under lock to prevent race with incoming messages
-    lock = get_session_lock(session_id)
-    with lock:
-        active_processes[session_id] = None
-        _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
+    # Mark active before the thread starts so incoming messages queue behind it. Callers normally
+    # hold a claim already; setdefault keeps it rather than overwriting another claim's placeholder.
+    active_processes.setdefault(session_id, _Starting())
+    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
     thread = threading.Thread(target=codex_thread, daemon=True)
     thread.start()
     return thread
@@ -3014,6 +3588,7 @@ def run_gemini_task(chat_id, task, cwd, session=None):
         accumulated_text = ""
         _ws_session_override.name = session.get("name", "") if session else ""
         current_chunk_text = ""
+        chunk_has_content = False  # current_chunk_text has non-whitespace (avoids re-stripping the buffer)
         message_ids = []
         file_changes = []
         processed_tool_ids = set()
@@ -3086,6 +3661,7 @@ def run_gemini_task(chat_id, task, cwd, session=None):
             # Force the first streaming update to be visible immediately.
             last_update = 0
             current_tool = None
+            tool_status = ""  # Pending tool status line, flushed by the periodic edit
 
             # Watchdog thread: kills Gemini if no stdout activity for gemini_stale_timeout seconds
             watchdog_stop = threading.Event()
@@ -3098,14 +3674,13 @@ def run_gemini_task(chat_id, task, cwd, session=None):
                     if elapsed > gemini_stale_timeout:
                         print(f"[Gemini] Watchdog: no output for {elapsed:.0f}s, killing process", flush=True)
                         try:
-                            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+                            kill_process_group(process, signal.SIGTERM)
                             time.sleep(5)
                             if process.poll() is None:
-                                os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+                                kill_process_group(process)
                         except Exception:
                             pass
                         break
-            import signal
             watchdog_thread = threading.Thread(target=_gemini_watchdog, daemon=True)
             watchdog_thread.start()
 
@@ -3120,7 +3695,7 @@ def run_gemini_task(chat_id, task, cwd, session=None):
                 last_output_time = time.time()
                 line_len = len(line)
                 try:
-                    event = json.loads(line)
+                    event = _json_loads(line)
                     etype = event.get("type", "")
 
                     if etype == "init":
@@ -3154,6 +3729,7 @@ def run_gemini_task(chat_id, task, cwd, session=None):
                                         spacing = " "
                                 accumulated_text += spacing + append_text
                                 current_chunk_text += spacing + append_text
+                                chunk_has_content = chunk_has_content or bool(append_text.strip())
                                 current_tool = None
 
                     elif etype == "tool_use":
@@ -3165,17 +3741,14 @@ def run_gemini_task(chat_id, task, cwd, session=None):
 
                         tool_name = event.get("tool_name") or "tool"
                         params = event.get("parameters", {})
-                        path = params.get("file_path") or params.get("command") or params.get("pattern") or params.get("dir_path") or ""
+                        path = next((params[k] for k in _PATH_KEYS if params.get(k)), "")
                         file_changes.append({"type": tool_name.lower(), "path": path[:100]})
                         current_tool = tool_name
-                        print(f"[Gemini] tool_use: {tool_name}", flush=True)
                         # Mirror Claude-style visibility: show tool activity even before text arrives.
-                        now = time.time()
-                        if now - last_update >= update_interval:
-                            display_text = current_chunk_text if current_chunk_text.strip() else "⏳"
-                            status = format_tool_status(tool_name, path)
-                            edit_message(chat_id, message_id, display_text + status)
-                            last_update = now
+                        # Only record the status here — the periodic edit below flushes it, so a
+                        # burst of tool_use events costs one edit per interval instead of one each.
+                        tool_status = format_tool_status(tool_name, path)
+                        print(f"[Gemini] tool_use: {tool_name}", flush=True)
 
                     elif etype == "tool_result":
                         print(f"[Gemini] tool_result", flush=True)
@@ -3186,9 +3759,10 @@ def run_gemini_task(chat_id, task, cwd, session=None):
                         print(f"[Gemini] result: status={event.get('status')}, tokens={stats.get('total_tokens')}, tool_calls={stats.get('tool_calls')}, accumulated_text={len(accumulated_text)}", flush=True)
 
                     elif etype == "error":
-                        error_msg = event.get("message") or event.get("error") or str(event)
-                        gemini_errors.append(error_msg[:300])
-                        print(f"[Gemini] Error event: {error_msg[:300]}", flush=True)
+                        error_msg = event.get("message") or event.get("error")
+                        error_msg = str(error_msg)[:300] if error_msg else repr(event)[:300]
+                        gemini_errors.append(error_msg)
+                        print(f"[Gemini] Error event: {error_msg}", flush=True)
 
                     else:
                         print(f"[Gemini] Unknown event type: {etype} (keys: {list(event.keys())[:8]})", flush=True)
@@ -3201,13 +3775,17 @@ def run_gemini_task(chat_id, task, cwd, session=None):
                         message_id = send_message(chat_id, "⏳ _continuing..._")
                         message_ids.append(message_id)
                         current_chunk_text = carry_over
+                        chunk_has_content = bool(carry_over.strip())
                         last_update = time.time()
 
                     # Stream update: periodic edit
                     now = time.time()
                     if now - last_update >= update_interval:
-                        display_text = current_chunk_text if current_chunk_text.strip() else "⏳"
-                        suffix = f"\n\n———\n🔧 _{current_tool}_" if current_tool else ("" if not current_chunk_text.strip() else "\n\n———\n⏳ _generating..._")
+                        display_text = current_chunk_text if chunk_has_content else "⏳"
+                        if current_tool:
+                            suffix = tool_status or f"\n\n———\n🔧 _{current_tool}_"
+                        else:
+                            suffix = "" if not chunk_has_content else "\n\n———\n⏳ _generating..._"
                         print(f"[Gemini] Streaming edit: {len(current_chunk_text)} chars, msg_id={message_id}", flush=True)
                         edit_message(chat_id, message_id, display_text + suffix)
                         last_update = now
@@ -3216,7 +3794,7 @@ def run_gemini_task(chat_id, task, cwd, session=None):
                     if line_len > 50_000:
                         event = None
                         line = None
-                        _malloc_trim()
+                        _maybe_malloc_trim(line_len)
 
                 except json.JSONDecodeError:
                     pass
@@ -3235,12 +3813,10 @@ def run_gemini_task(chat_id, task, cwd, session=None):
 
             # Save gemini session ID for resume
             if new_session_id and session:
-                chat_key = str(chat_id)
-                for s in user_sessions.get(chat_key, {}).get("sessions", []):
-                    if get_session_id(s) == session_id:
-                        s["gemini_session_id"] = new_session_id
-                        save_sessions(force=True)
-                        break
+                s = _chat_session_by_id(chat_id, session_id)
+                if s is not None:
+                    s["gemini_session_id"] = new_session_id
+                    save_sessions(force=True)
 
             # Final update
             final_chunk = current_chunk_text.strip()
@@ -3260,11 +3836,11 @@ def run_gemini_task(chat_id, task, cwd, session=None):
                     elif ctype in ["edit", "replace"]:
                         final_chunk += f"\n  ✅ Edited: `{shorten_path(path)}`"
                     elif ctype in ["bash", "run_shell_command"]:
-                        final_chunk += f"\n  ✅ Ran: `{path[:80]}{'...' if len(path) > 80 else ''}`"
+                        final_chunk += f"\n  ✅ Ran: `{_trunc(path, 80)}`"
                     elif ctype in ["read", "read_file"]:
                         final_chunk += f"\n  📖 Read: `{shorten_path(path)}`"
                     elif ctype in ["glob", "grep", "grep_search"]:
-                        final_chunk += f"\n  🔍 Search: `{path[:60]}{'...' if len(path) > 60 else ''}`"
+                        final_chunk += f"\n  🔍 Search: `{_trunc(path, 60)}`"
                     else:
                         final_chunk += f"\n  🔧 {ctype}: `{shorten_path(path)}`"
 
@@ -3298,8 +3874,7 @@ def run_gemini_task(chat_id, task, cwd, session=None):
             else:
                 # Split if too long
                 max_len = 3900
-                chunks = [final_chunk[i:i + max_len] for i in range(0, len(final_chunk), max_len)]
-                for chunk in chunks:
+                for chunk in _iter_split(final_chunk, max_len):
                     send_message(chat_id, chunk)
                     time.sleep(0.2)
 
@@ -3329,40 +3904,39 @@ def run_gemini_task(chat_id, task, cwd, session=None):
             _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
             process_message_queue(chat_id, session)
 
-    # Mark active under lock to prevent race with incoming messages
-    lock = get_session_lock(session_id)
-    with lock:
-        active_processes[session_id] = None
-        _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
+    # Mark active before the thread starts so incoming messages queue behind it. Callers normally
+    # hold a claim already; setdefault keeps it rather than overwriting another claim's placeholder.
+    active_processes.setdefault(session_id, _Starting())
+    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
     thread = threading.Thread(target=gemini_thread, daemon=True)
     thread.start()
     return thread, result
 
 
+_APPROVE_ANSWER = "Yes, approved. Please proceed with implementation."
+_DEFAULT_ANSWER = "Yes, please proceed with the most sensible approach."
+
+
+def _auto_answer(q):
+    """Pick the auto-answer for a single question."""
+    if "plan approval" in q.get("header", "").lower() or "approve" in q.get("question", "").lower():
+        return _APPROVE_ANSWER
+    options = q.get("options")
+    if options:
+        first_opt = options[0]
+        return first_opt.get("label", first_opt) if isinstance(first_opt, dict) else str(first_opt)
+    return _DEFAULT_ANSWER
+
+
 def handle_justdoit_questions(questions):
     """Auto-answer Claude's questions during justdoit mode.
 
     Returns a string answer to send back to Claude.
     """
-    answers = []
-    for q in questions:
-        header = q.get("header", "")
-        question_text = q.get("question", "")
-        options = q.get("options", [])
-
-        if "plan approval" in header.lower() or "approve" in question_text.lower():
-            answers.append("Yes, approved. Please proceed with implementation.")
-        elif options:
-            first_opt = options[0]
-            label = first_opt.get("label", first_opt) if isinstance(first_opt, dict) else str(first_opt)
-            answers.append(label)
-        else:
-            answers.append("Yes, please proceed with the most sensible approach.")
-
-    if len(answers) == 1:
-        return answers[0]
+    if len(questions) == 1:
+        return _auto_answer(questions[0])
 
-    return "\n".join(f"{i+1}. {a}" for i, a in enumerate(answers))
+    return "\n".join(f"{i+1}. {_auto_answer(q)}" for i, q in enumerate(questions))
 
 
 # Strict regex for detecting quota/rate-limit errors everywhere (stderr, response, exceptions).
@@ -3378,6 +3952,7 @@ QUOTA_REGEX = re.compile(
 )
 
 QUOTA_WAIT_SECONDS = 3600  # 1 hour fallback
+_quota_until = {}  # "claude"/"codex" -> time.time() when the last reported rate limit lifts (shared by all loops)
 
 # Regex to extract reset time from quota error messages.
 # Covers Codex ("Try again at 3:45 PM"), Claude ("resets at 3:45 PM"), etc.
@@ -3393,6 +3968,10 @@ def _parse_reset_wait(error_msg):
     Works for both Codex ("Try again at 3:45 PM") and Claude ("resets at 3:45 PM") messages.
     Returns (wait_seconds, reset_time_str) or (QUOTA_WAIT_SECONDS, None) if unparseable.
     """
+    # Cheap substring gate — most error messages carry no reset time at all
+    low = error_msg.lower()
+    if "try again" not in low and "reset" not in low:
+        return QUOTA_WAIT_SECONDS, None
     m = _RESET_TIME_RE.search(error_msg)
     if not m:
         return QUOTA_WAIT_SECONDS, None
@@ -3433,7 +4012,7 @@ def drain_user_feedback(chat_key):
     return formatted
 
 
-def run_codex_review(original_task, claude_output, step, history_summary, cwd, phase="implementing", pending_transition=None, stale_warning=None, claude_plan=None, user_feedback=""):
+def run_codex_review(original_task, claude_output, step, history_summary, cwd, phase="implementing", pending_transition=None, stale_warning=None, claude_plan=None, user_feedback="", cancel_event=None):
     """Call Codex to review Claude's output and determine next action.
 
     Returns: (next_prompt: str or None, is_done: bool, reasoning: str)
@@ -3444,6 +4023,7 @@ def run_codex_review(original_task, claude_output, step, history_summary, cwd, p
     Claude's current output is a verification response and Codex may now transition.
     stale_warning: if set, a warning string appended to the prompt telling Codex that
     progress has stalled and it must try a fundamentally different approach.
+    cancel_event: if set by /cancel, the Codex process is killed instead of running to the timeout.
     """
     max_output_len = 6000
     if len(claude_output) > max_output_len:
@@ -3615,22 +4195,22 @@ RESPOND WITH ONE OF:
     print(f"[Codex] Calling Codex. Step: {step}, phase: {phase}, pending_transition: {pending_transition}", flush=True)
     print(f"[Codex] Prompt length: {len(codex_prompt)}, Claude output length: {len(claude_output)}", flush=True)
 
+    process = None
+    cancel_watch = None
     try:
         process = subprocess.Popen(
-            [
-                "codex", "exec",
-                "-m", CODEX_MODEL,
-                "-c", 'model_reasoning_effort="xhigh"',
-                "--dangerously-bypass-approvals-and-sandbox",
-                codex_prompt
-            ],
+            _codex_exec_cmd(codex_prompt),
             cwd=cwd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True
+            text=True,
+            start_new_session=True
         )
+        cancel_watch = _kill_on_cancel(process, cancel_event)
 
         stdout, stderr = process.communicate(timeout=300)
+        if cancel_event is not None and cancel_event.is_set():
+            return None, False, "Cancelled"
 
         output = (stdout or "").strip()
         error_output = (stderr or "").strip()
@@ -3659,15 +4239,9 @@ RESPOND WITH ONE OF:
         # Check if Codex detected Claude hit a quota/rate-limit
         # Format: "QUOTA:<wait_minutes>\n<details>"
         if output.startswith("QUOTA:"):
-            first_line, _, rest = output.partition("\n")
-            wait_str = first_line[6:].strip()
-            details = rest.strip() or "no details"
-            try:
-                wait_min = max(1, int(wait_str))
-            except (ValueError, TypeError):
-                wait_min = 60
-            print(f"[Codex] Decision: Claude quota detected. Wait: {wait_min}min. Details: {details[:200]}", flush=True)
-            return None, False, f"QUOTA:{wait_min} {details[:200]}"
+            reasoning = _quota_reasoning(output)
+            print(f"[Codex] Decision: Claude quota detected. {reasoning}", flush=True)
+            return None, False, reasoning
 
         # Check for phase transition
         if output.startswith("PHASE:"):
@@ -3697,7 +4271,6 @@ RESPOND WITH ONE OF:
         return output, False, ""
 
     except subprocess.TimeoutExpired:
-        process.kill()
         print(f"[Codex] TIMEOUT after 300s (phase: {phase})", flush=True)
         # Phase-aware fallback prompts so we don't send nonsensical "continue implementing" during review/test
         timeout_fallbacks = {
@@ -3716,23 +4289,116 @@ RESPOND WITH ONE OF:
         if QUOTA_REGEX.search(err_str):
             return None, False, f"QUOTA:60 Codex exception — {err_str[:200]}"
         return None, False, f"Codex error: {e}"
+    finally:
+        if cancel_watch:
+            cancel_watch.set()
+        # Kill and reap on every exit path (timeout, parse error) so no codex process is left behind
+        if process and process.poll() is None:
+            try:
+                kill_process_group(process)
+            except Exception:
+                process.kill()
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                pass
+
+
+def _auto_answer_questions(chat_id, questions, cwd, session_id, session, log_prefix):
+    """Auto-answer Claude's questions and resume the session once with the answer.
+
+    Claude runs in print mode (-p), so the answer can't be written to the live
+    process — the follow-up is a resumed turn. Returns (response, session).
+    """
+    auto_answer = handle_justdoit_questions(questions)
+    print(f"{log_prefix} Auto-answering {len(questions)} questions. Answer: {auto_answer[:200]}", flush=True)
+    send_message(chat_id, f"🤖 *Auto-answering:* _{auto_answer[:100]}_")
+    response, _, _, claude_sid, _ = run_claude_streaming(
+        auto_answer, chat_id, cwd=cwd, continue_session=True,
+        session_id=session_id, session=session
+    )
+    if claude_sid:
+        session = update_claude_session_id(chat_id, session, claude_sid) or session
+    return response, session
+
+
+# justdoit phase markers (built once, not per step)
+_PHASE_EMOJI = {"implementing": "🔨", "reviewing": "🔍", "testing": "🧪"}
+_PHASE_LABELS = {p: f"{e} {p.capitalize()}" for p, e in _PHASE_EMOJI.items()}
+
+
+# Codex verdict line: SIGN-OFF at the start of any line (Codex often adds preamble first)
+_SIGNOFF_RE = re.compile(r"(?im)^[ \t]*SIGN-OFF")
+# Tagged Codex review reasoning: "QUOTA:<minutes> <details>", "PHASE:<phase>" or "VERIFY:<target>"
+_TAG_RE = re.compile(r"^(QUOTA|PHASE|VERIFY):\s*(\S*)\s*(.*)$", re.DOTALL)
+
+
+def _quota_reasoning(output):
+    """Turn a Codex "QUOTA:<minutes>\\n<details>" reply into "QUOTA:<minutes> <details>" reasoning."""
+    first_line, _, rest = output.partition("\n")
+    try:
+        wait_min = max(1, int(first_line[6:].strip()))
+    except ValueError:
+        wait_min = 60
+    return f"QUOTA:{wait_min} {(rest.strip() or 'no details')[:200]}"
+
+
+def _handle_quota_wait(reasoning, chat_id, chat_key, wait_fn, label):
+    """Announce a "QUOTA:<minutes> <details>" rate limit and block on wait_fn(chat_key, secs).
+
+    Returns True if the loop is still active afterwards; False if it was cancelled (user already told).
+    """
+    tag = _TAG_RE.match(reasoning)
+    try:
+        wait_min = max(1, int(tag.group(2)))
+    except ValueError:
+        wait_min = 60
+    details = tag.group(3)
+    wait_secs = wait_min * 60
+    # Remember the deadline so other loops skip calls that would just hit the same limit
+    provider = "codex" if details.startswith(("Codex error", "Codex exception")) else "claude"
+    _quota_until[provider] = max(_quota_until.get(provider, 0), time.time() + wait_secs)
+    resume_time = (datetime.now() + timedelta(seconds=wait_secs)).strftime('%H:%M')
+    print(f"[{label} {chat_key}] Rate limited. Wait: {wait_min}min. {details[:200]}", flush=True)
+    send_message(chat_id,
+        f"⏳ *Rate limited.* {md_escape(details[:200])}\n"
+        f"_Waiting ~{wait_min}min... (resume ~{resume_time})_\n"
+        f"_Use /cancel to abort._")
+    if not wait_fn(chat_key, wait_secs):
+        send_message(chat_id, f"⚠️ *{label} cancelled* during rate-limit wait.")
+        return False
+    return True
+
+
+def _quota_gate(provider, chat_id, chat_key, wait_fn, label):
+    """Before calling `provider`, wait out a rate limit any loop has already reported for it.
+
+    Returns True when it's clear to call; False if the loop was cancelled while waiting (user already told).
+    """
+    remaining = int(_quota_until.get(provider, 0) - time.time())
+    if remaining <= 0:
+        return True
+    resume_time = (datetime.now() + timedelta(seconds=remaining)).strftime('%H:%M')
+    print(f"[{label} {chat_key}] {provider} still rate limited, holding {remaining}s", flush=True)
+    send_message(chat_id,
+        f"⏳ *{provider.capitalize()} is rate limited.* _Holding until ~{resume_time}..._\n"
+        f"_Use /cancel to abort._")
+    if not wait_fn(chat_key, remaining):
+        send_message(chat_id, f"⚠️ *{label} cancelled* during rate-limit wait.")
+        return False
+    return True
 
 
 def _justdoit_wait(chat_key, seconds):
-    """Sleep for `seconds` while checking cancellation every 30s.
+    """Wait up to `seconds`, returning early as soon as /cancel sets the loop's cancel_event.
 
     Returns True if wait completed, False if cancelled.
     """
-    elapsed = 0
-    interval = 30
-    while elapsed < seconds:
-        state = justdoit_active.get(chat_key, {})
-        if not state.get("active", False):
-            return False
-        chunk = min(interval, seconds - elapsed)
-        time.sleep(chunk)
-        elapsed += chunk
-    return justdoit_active.get(chat_key, {}).get("active", False)
+    state = justdoit_active.get(chat_key, {})
+    if not state.get("active", False):
+        return False
+    state["cancel_event"].wait(seconds)
+    return state.get("active", False)
 
 
 def run_omni_loop(chat_id, task, session):
@@ -3740,26 +4406,17 @@ def run_omni_loop(chat_id, task, session):
     session_id = get_session_id(session)
     chat_key = f"{chat_id}:{session_id}"
     cwd = session["cwd"]
-    log_prefix = f"[Omni {chat_id}:{session.get('name', 'unknown')}]"
+    session_name = session.get("name", "unknown")
+    log_prefix = f"[Omni {chat_id}:{session_name}]"
     original_task = task  # Preserve original task — don't mutate
     _ws_session_override.name = session.get("name", "")
 
     print(f"{log_prefix} Starting. Task: {task[:200]}", flush=True)
     print(f"{log_prefix} Session ID: {session_id}, CWD: {cwd}", flush=True)
 
-    omni_active[chat_key] = {
-        "active": True,
-        "paused": False,
-        "resume_event": threading.Event(),
-        "task": task,
-        "step": 0,
-        "phase": "architecting",
-        "chat_id": str(chat_id),
-        "session_name": session.get("name", "unknown"),
-        "started": time.time(),
-    }
-    omni_active[chat_key]["resume_event"].set()  # Not paused initially
-    save_active_tasks()
+    omni_active[chat_key] = _new_loop_state(chat_id, session_name, task, "architecting")
+    cancel_event = omni_active[chat_key]["cancel_event"]
+    mark_active_tasks_dirty()
     _ws_broadcast_status(chat_id, "omni", "starting", 0, active=True, task=task, started=omni_active[chat_key]["started"])
 
     step = 0
@@ -3776,6 +4433,8 @@ def run_omni_loop(chat_id, task, session):
     STALE_REJECT_LIMIT = 4
     # Feedback history so architect/executor can see they're cycling
     audit_feedback_history = []
+    empty_audit_streak = 0  # Consecutive audit steps where Codex returned nothing (even after retry)
+    status = StatusThrottler(chat_id, state=omni_active[chat_key])  # Phase headers/verdicts that land back-to-back share one message
 
     def _feedback_signature(text):
         """Normalize model feedback to detect semantic repeats across timestamps/IDs."""
@@ -3813,478 +4472,482 @@ def run_omni_loop(chat_id, task, session):
             print(f"[Omni] Error checking plan items: {e}", flush=True)
             return 0, 0
 
-    try:
-        send_message(chat_id, f"""🚀 *Omni Task Started* on `{session.get('name', 'unknown')}`
-
-Task: _{task[:200]}_
-
-_Claude (Architect) → Gemini (Execute) → Codex (Audit)_
-_Claude as fallback if Gemini fails._
-_Use /cancel to stop at any time._""")
-
-        while omni_active.get(chat_key, {}).get("active"):
-            step += 1
-            omni_active[chat_key]["step"] = step
-            omni_active[chat_key]["phase"] = phase
-            save_active_tasks()
-            _ws_broadcast_status(chat_id, "omni", phase, step)
-
-            # Stop if we hit a runaway limit
-            if step > 200:
-                send_message(chat_id, "⚠️ *Omni limit reached* (200 steps). Stopping to prevent loop.")
-                break
-
-            print(f"{log_prefix} === Step {step} === Phase: {phase}", flush=True)
-
-            # --- Phase 1: Architect (Claude) ---
-            if phase == "architecting":
-                send_message(chat_id, f"🏛️ *Step {step}: Architecting* (Claude)\nUpdating PLAN.md...")
+    def _architect_phase(phase):
+        """Claude updates PLAN.md, Codex reviews it. Returns the next phase, or None to stop."""
+        nonlocal session, audit_feedback, preferred_executor, notified_exit
+        status.push(f"🏛️ *Step {step}: Architecting* (Claude)\nUpdating PLAN.md...")
 
-                # Snapshot dirty files before architect runs (for phase enforcement)
-                try:
-                    _pre = subprocess.run(
-                        ["git", "diff", "--name-only"], capture_output=True, text=True, cwd=cwd, timeout=10
-                    ).stdout.strip()
-                    pre_arch_dirty = set(_pre.split('\n')) if _pre else set()
-                except Exception:
-                    pre_arch_dirty = set()
-
-                arch_prompt = (
-                    f"Update PLAN.md in the root directory to reflect the implementation plan for the following task:\n\n"
-                    f"{original_task}\n\n"
-                    f"Use markdown checkboxes: - [ ] for pending, - [x] for done.\n"
-                    f"Ensure architecture is solid and testing is planned.\n"
-                    f"IMPORTANT: Do NOT enter plan mode (EnterPlanMode). Write PLAN.md directly.\n"
-                    f"IMPORTANT: Do NOT modify any code files — only PLAN.md. You are the architect, not the executor.\n"
-                    f"IMPORTANT: If PLAN.md has a '## Blockers' section, preserve it exactly. Do not remove or uncheck blocker lines."
+        # Snapshot dirty files before architect runs (for phase enforcement)
+        try:
+            _pre = subprocess.run(
+                ["git", "diff", "--name-only"], capture_output=True, text=True, cwd=cwd, timeout=10
+            ).stdout.strip()
+            pre_arch_dirty = set(_pre.split('\n')) if _pre else set()
+        except Exception:
+            pre_arch_dirty = set()
+
+        arch_prompt = (
+            f"Update PLAN.md in the root directory to reflect the implementation plan for the following task:\n\n"
+            f"{original_task}\n\n"
+            f"Use markdown checkboxes: - [ ] for pending, - [x] for done.\n"
+            f"Ensure architecture is solid and testing is planned.\n"
+            f"IMPORTANT: Do NOT enter plan mode (EnterPlanMode). Write PLAN.md directly.\n"
+            f"IMPORTANT: Do NOT modify any code files — only PLAN.md. You are the architect, not the executor.\n"
+            f"IMPORTANT: If PLAN.md has a '## Blockers' section, preserve it exactly. Do not remove or uncheck blocker lines."
+        )
+        if audit_feedback:
+            if len(audit_feedback_history) > 1:
+                # Show history so architect can see cycling patterns and break them
+                history_lines = []
+                for i, prev in enumerate(audit_feedback_history[:-1], 1):
+                    history_lines.append(f"--- Round {i} feedback ---\n{prev}")
+                history_block = "\n\n".join(history_lines)
+                arch_prompt += (
+                    f"\n\n⚠️ FEEDBACK HISTORY (previous rounds — watch for cycling patterns):\n"
+                    f"{history_block}\n\n"
+                    f"--- LATEST feedback to address NOW ---\n{audit_feedback}\n\n"
+                    f"IMPORTANT: If you see the same issues recurring across rounds, you are in a cycle. "
+                    f"Do NOT simply fix the latest issue — find a solution that addresses ALL recurring feedback simultaneously."
                 )
-                if audit_feedback:
-                    if len(audit_feedback_history) > 1:
-                        # Show history so architect can see cycling patterns and break them
-                        history_lines = []
-                        for i, prev in enumerate(audit_feedback_history[:-1], 1):
-                            history_lines.append(f"--- Round {i} feedback ---\n{prev}")
-                        history_block = "\n\n".join(history_lines)
-                        arch_prompt += (
-                            f"\n\n⚠️ FEEDBACK HISTORY (previous rounds — watch for cycling patterns):\n"
-                            f"{history_block}\n\n"
-                            f"--- LATEST feedback to address NOW ---\n{audit_feedback}\n\n"
-                            f"IMPORTANT: If you see the same issues recurring across rounds, you are in a cycle. "
-                            f"Do NOT simply fix the latest issue — find a solution that addresses ALL recurring feedback simultaneously."
-                        )
-                    else:
-                        arch_prompt += f"\n\nPrevious audit feedback to incorporate:\n{audit_feedback}"
+            else:
+                arch_prompt += f"\n\nPrevious audit feedback to incorporate:\n{audit_feedback}"
 
-                response, questions, _, claude_sid, context_overflow = run_claude_streaming(
-                    arch_prompt, chat_id, cwd=cwd, continue_session=True,
-                    session_id=session_id, session=session
-                )
-                _ws_broadcast_status(chat_id, "omni", phase, step)  # Re-assert after Claude exits
-                if not _check_pause(omni_active, chat_key, chat_id, "omni", phase, step):
-                    break
+        response, questions, _, claude_sid, context_overflow = run_claude_streaming(
+            arch_prompt, chat_id, cwd=cwd, continue_session=True,
+            session_id=session_id, session=session
+        )
+        _ws_broadcast_status(chat_id, "omni", phase, step)  # Re-assert after Claude exits
+        if not _check_pause(omni_active, chat_key, chat_id, "omni", phase, step):
+            return None
 
-                # Persist Claude session ID
-                if claude_sid:
-                    update_claude_session_id(chat_id, session, claude_sid)
-                    session = get_session_by_id(chat_id, session_id) or session
+        # Persist Claude session ID
+        if claude_sid:
+            session = update_claude_session_id(chat_id, session, claude_sid) or session
 
-                # Handle context overflow
-                if context_overflow:
-                    print(f"{log_prefix} Step {step}: Context overflow, resetting Claude session", flush=True)
-                    send_message(chat_id, "⚠️ Context overflow — resetting Claude session...")
-                    update_claude_session_id(chat_id, session, None)
-                    reset_message_count(chat_id, session, "Claude")
+        # Handle context overflow
+        if context_overflow:
+            print(f"{log_prefix} Step {step}: Context overflow, resetting Claude session", flush=True)
+            send_message(chat_id, "⚠️ Context overflow — resetting Claude session...")
+            update_claude_session_id(chat_id, session, None)
+            reset_message_count(chat_id, session, "Claude")
 
-                # Auto-answer any questions
-                if questions:
-                    auto_answer = handle_justdoit_questions(questions)
-                    print(f"{log_prefix} Step {step}: Auto-answering {len(questions)} questions", flush=True)
-                    send_message(chat_id, f"🤖 *Auto-answering:* _{auto_answer[:100]}_")
-                    _, _, _, claude_sid2, _ = run_claude_streaming(
-                        auto_answer, chat_id, cwd=cwd, continue_session=True,
-                        session_id=session_id, session=session
-                    )
-                    if not omni_active.get(chat_key, {}).get("active"):
-                        break
-                    if claude_sid2:
-                        update_claude_session_id(chat_id, session, claude_sid2)
-                        session = get_session_by_id(chat_id, session_id) or session
+        # Auto-answer any questions
+        if questions:
+            _, session = _auto_answer_questions(chat_id, questions, cwd, session_id, session, f"{log_prefix} Step {step}:")
+            if not omni_active.get(chat_key, {}).get("active"):
+                return None
 
-                if response:
-                    print(f"{log_prefix} Step {step}: Claude architect response: {response[:300]}...", flush=True)
+        if response:
+            print(f"{log_prefix} Step {step}: Claude architect response: {response[:300]}...", flush=True)
 
-                # Phase enforcement: revert any code changes made during architecting
-                # Compare current dirty files against pre-architect snapshot to find new changes
-                try:
-                    diff_out = subprocess.run(
-                        ["git", "diff", "--name-only"], capture_output=True, text=True, cwd=cwd, timeout=10
-                    ).stdout.strip()
-                    current_dirty = set(diff_out.split('\n')) if diff_out else set()
-                    new_changes = current_dirty - pre_arch_dirty
-                    non_plan = [f for f in new_changes if f and f != 'PLAN.md']
-                    if non_plan:
-                        print(f"{log_prefix} Step {step}: Architect modified non-plan files: {non_plan}", flush=True)
-                        subprocess.run(["git", "checkout", "--"] + non_plan, cwd=cwd, timeout=10)
-                        short_list = ", ".join(non_plan[:5])
-                        if len(non_plan) > 5:
-                            short_list += f" (+{len(non_plan) - 5} more)"
-                        send_message(chat_id, f"⚠️ Architect touched code files (reverted): {short_list}")
-                except Exception as e:
-                    print(f"{log_prefix} Step {step}: Phase enforcement error: {e}", flush=True)
-
-                # Drain any user feedback sent during architecting
-                feedback = drain_user_feedback(chat_key)
-                if feedback:
-                    print(f"{log_prefix} Step {step}: Including user feedback in plan review", flush=True)
-
-                # Codex reviews the plan before execution
-                omni_active[chat_key]["phase"] = "reviewing"
-                _ws_broadcast_status(chat_id, "omni", "reviewing", step)
-                send_message(chat_id, f"📋 *Step {step}: Plan Review* (Codex)\nReviewing PLAN.md...")
-                plan_review_prompt = (
-                    f"Review PLAN.md against the original task:\n\n{original_task}\n\n"
-                    f"Check that the plan is complete, feasible, well-structured, and covers testing.\n\n"
-                    f"BLOCKER LEDGER: Check PLAN.md for a '## Blockers' section. If it exists:\n"
-                    f"- If a blocker is already resolved in the code, mark it [x].\n"
-                    f"- Do NOT remove blocker lines — only check/uncheck them.\n"
-                    f"- IMPORTANT: Open blockers about MISSING CODE or MISSING IMPLEMENTATION should NOT prevent plan sign-off.\n"
-                    f"  Those blockers exist to track work for the EXECUTION phase. Your job is to evaluate the PLAN's quality,\n"
-                    f"  not whether code has been written yet. Only reject the plan if the plan itself is flawed\n"
-                    f"  (incomplete strategy, missing steps, bad architecture, untestable approach).\n\n"
-                    f"If the plan is solid and ready for execution, respond with:\n"
-                    f"SIGN-OFF\n"
-                    f"- Blockers resolved: <count or 'N/A — implementation blockers for execution phase'>\n"
-                    f"- Key files: <main files the plan targets>\n"
-                    f"EXECUTOR: GEMINI or EXECUTOR: CLAUDE\n\n"
-                    f"Choose CLAUDE for complex multi-file refactors, subtle bug fixes, or tasks requiring deep reasoning.\n"
-                    f"Choose GEMINI for straightforward implementation, file creation, running tests, or mechanical changes.\n"
-                    f"Otherwise, provide specific feedback on what needs to change IN THE PLAN (not in the code)."
-                )
-                if feedback:
-                    plan_review_prompt += feedback
-                if session:
-                    bridge = get_context_bridge(session, "Codex")
-                    if bridge:
-                        plan_review_prompt = bridge + "[NEW TASK]\n" + plan_review_prompt
+        # Phase enforcement: revert any code changes made during architecting
+        # Compare current dirty files against pre-architect snapshot to find new changes
+        try:
+            diff_out = subprocess.run(
+                ["git", "diff", "--name-only"], capture_output=True, text=True, cwd=cwd, timeout=10
+            ).stdout.strip()
+            current_dirty = set(diff_out.split('\n')) if diff_out else set()
+            new_changes = current_dirty - pre_arch_dirty
+            non_plan = [f for f in new_changes if f and f != 'PLAN.md']
+            if non_plan:
+                print(f"{log_prefix} Step {step}: Architect modified non-plan files: {non_plan}", flush=True)
+                subprocess.run(["git", "checkout", "--"] + non_plan, cwd=cwd, timeout=10)
+                short_list = ", ".join(non_plan[:5])
+                if len(non_plan) > 5:
+                    short_list += f" (+{len(non_plan) - 5} more)"
+                send_message(chat_id, f"⚠️ Architect touched code files (reverted): {short_list}")
+        except Exception as e:
+            print(f"{log_prefix} Step {step}: Phase enforcement error: {e}", flush=True)
+
+        # Drain any user feedback sent during architecting
+        feedback = drain_user_feedback(chat_key)
+        if feedback:
+            print(f"{log_prefix} Step {step}: Including user feedback in plan review", flush=True)
+
+        # Codex reviews the plan before execution
+        omni_active[chat_key]["phase"] = "reviewing"
+        _ws_broadcast_status(chat_id, "omni", "reviewing", step)
+        status.push(f"📋 *Step {step}: Plan Review* (Codex)\nReviewing PLAN.md...")
+        plan_review_prompt = (
+            f"Review PLAN.md against the original task:\n\n{original_task}\n\n"
+            f"Check that the plan is complete, feasible, well-structured, and covers testing.\n\n"
+            f"BLOCKER LEDGER: Check PLAN.md for a '## Blockers' section. If it exists:\n"
+            f"- If a blocker is already resolved in the code, mark it [x].\n"
+            f"- Do NOT remove blocker lines — only check/uncheck them.\n"
+            f"- IMPORTANT: Open blockers about MISSING CODE or MISSING IMPLEMENTATION should NOT prevent plan sign-off.\n"
+            f"  Those blockers exist to track work for the EXECUTION phase. Your job is to evaluate the PLAN's quality,\n"
+            f"  not whether code has been written yet. Only reject the plan if the plan itself is flawed\n"
+            f"  (incomplete strategy, missing steps, bad architecture, untestable approach).\n\n"
+            f"If the plan is solid and ready for execution, respond with:\n"
+            f"SIGN-OFF\n"
+            f"- Blockers resolved: <count or 'N/A — implementation blockers for execution phase'>\n"
+            f"- Key files: <main files the plan targets>\n"
+            f"EXECUTOR: GEMINI or EXECUTOR: CLAUDE\n\n"
+            f"Choose CLAUDE for complex multi-file refactors, subtle bug fixes, or tasks requiring deep reasoning.\n"
+            f"Choose GEMINI for straightforward implementation, file creation, running tests, or mechanical changes.\n"
+            f"Otherwise, provide specific feedback on what needs to change IN THE PLAN (not in the code)."
+        )
+        if feedback:
+            plan_review_prompt += feedback
+        if session:
+            bridge = get_context_bridge(session, "Codex")
+            if bridge:
+                plan_review_prompt = bridge + "[NEW TASK]\n" + plan_review_prompt
 
-                if not omni_active.get(chat_key, {}).get("active"):
-                    break
-                plan_review = run_codex(plan_review_prompt, cwd=cwd, session=session, stale_timeout=300)
-                update_session_state(chat_id, session, original_task, "Codex")
-                if not omni_active.get(chat_key, {}).get("active"):
+        if not omni_active.get(chat_key, {}).get("active"):
+            return None
+        plan_review = run_codex(plan_review_prompt, cwd=cwd, session=session, stale_timeout=300, cancel_event=cancel_event)
+        update_session_state(chat_id, session, original_task, "Codex")
+        if not omni_active.get(chat_key, {}).get("active"):
+            return None
+
+        if plan_review:
+            print(f"{log_prefix} Step {step}: Codex plan review: {plan_review[:500]}...", flush=True)
+            send_message(chat_id, f"📋 *Plan Review:*\n_{plan_review[:1000]}_")
+
+        has_signoff = bool(plan_review and _SIGNOFF_RE.search(plan_review))
+        # Parse executor recommendation from Codex (e.g. "EXECUTOR: CLAUDE")
+        if plan_review:
+            for line in plan_review.strip().split("\n"):
+                stripped = line.strip().upper()
+                if stripped.startswith("EXECUTOR:"):
+                    rec = stripped.split(":", 1)[1].strip()
+                    if "CLAUDE" in rec:
+                        preferred_executor = "claude"
+                    elif "GEMINI" in rec:
+                        preferred_executor = "gemini"
                     break
 
-                if plan_review:
-                    print(f"{log_prefix} Step {step}: Codex plan review: {plan_review[:500]}...", flush=True)
-                    send_message(chat_id, f"📋 *Plan Review:*\n_{plan_review[:1000]}_")
-
-                has_signoff = any(line.strip().upper().startswith("SIGN-OFF") for line in plan_review.strip().split("\n")) if plan_review else False
-                # Parse executor recommendation from Codex (e.g. "EXECUTOR: CLAUDE")
-                if plan_review:
-                    for line in plan_review.strip().split("\n"):
-                        stripped = line.strip().upper()
-                        if stripped.startswith("EXECUTOR:"):
-                            rec = stripped.split(":", 1)[1].strip()
-                            if "CLAUDE" in rec:
-                                preferred_executor = "claude"
-                            elif "GEMINI" in rec:
-                                preferred_executor = "gemini"
-                            break
-
-                # Note: no blocker contradiction gate here — plan review evaluates plan quality,
-                # not implementation completeness. Open code blockers are expected at this stage
-                # and will be enforced in the audit phase after execution.
-                if has_signoff:
-                    print(f"{log_prefix} Step {step}: Plan approved by Codex, executor={preferred_executor}", flush=True)
-                    send_message(chat_id, f"✅ Plan approved by Codex. Executing with *{preferred_executor.capitalize()}*.")
-                    audit_feedback = ""  # Clear so execution doesn't inherit stale plan-review feedback
-                    plan_reject_sigs.clear()
-                    phase = "executing"
-                    _ws_broadcast_status(chat_id, "omni", phase, step)
-                else:
-                    # Codex rejected the plan — feed back to Claude
-                    audit_feedback = plan_review[:6000] if plan_review else "Plan review returned no feedback."
-                    audit_feedback_history.append(f"[PLAN REJECTED] {audit_feedback[:1500]}")
-                    sig = _feedback_signature(plan_review)
-                    if sig:
-                        plan_reject_sigs.append(sig)
-                    plan_reject_count = plan_reject_sigs.count(sig) if sig else 0
-                    print(f"{log_prefix} Step {step}: Plan reject count={plan_reject_count}/{len(plan_reject_sigs)}", flush=True)
-                    if sig and plan_reject_count >= STALE_REJECT_LIMIT:
-                        send_message(chat_id, f"""🛑 *Omni stopped: stale plan-review loop detected* (step {step})
+        # Note: no blocker contradiction gate here — plan review evaluates plan quality,
+        # not implementation completeness. Open code blockers are expected at this stage
+        # and will be enforced in the audit phase after execution.
+        if has_signoff:
+            print(f"{log_prefix} Step {step}: Plan approved by Codex, executor={preferred_executor}", flush=True)
+            status.push(f"✅ Plan approved by Codex. Executing with *{preferred_executor.capitalize()}*.")
+            audit_feedback = ""  # Clear so execution doesn't inherit stale plan-review feedback
+            plan_reject_sigs.clear()
+            phase = "executing"
+            _ws_broadcast_status(chat_id, "omni", phase, step)
+        else:
+            # Codex rejected the plan — feed back to Claude
+            audit_feedback = plan_review[:6000] if plan_review else "Plan review returned no feedback."
+            audit_feedback_history.append(f"[PLAN REJECTED] {audit_feedback[:1500]}")
+            sig = _feedback_signature(plan_review)
+            if sig:
+                plan_reject_sigs.append(sig)
+            plan_reject_count = plan_reject_sigs.count(sig) if sig else 0
+            print(f"{log_prefix} Step {step}: Plan reject count={plan_reject_count}/{len(plan_reject_sigs)}", flush=True)
+            if sig and plan_reject_count >= STALE_REJECT_LIMIT:
+                send_message(chat_id, f"""🛑 *Omni stopped: stale plan-review loop detected* (step {step})
 
 Codex returned effectively the same plan rejection *{plan_reject_count}* times in the last {len(plan_reject_sigs)} rounds.
 This may indicate a back-and-forth cycle. Omni stopped to prevent churn.
 
 Use `/omni` again with an explicit human override (for example: accept current ops-blocked status, or provide one concrete code change to force).""")
-                        notified_exit = True
-                        break
-                    print(f"{log_prefix} Step {step}: Plan rejected by Codex, looping back", flush=True)
-                    phase = "architecting"
-                    _ws_broadcast_status(chat_id, "omni", phase, step)
-
-                time.sleep(2)
-                continue
+                notified_exit = True
+                return None
+            print(f"{log_prefix} Step {step}: Plan rejected by Codex, looping back", flush=True)
+            phase = "architecting"
+            _ws_broadcast_status(chat_id, "omni", phase, step)
 
-            # --- Phase 2: Execute (Codex picks executor, with fallback) ---
-            if phase == "executing":
-                # Check cancellation/pause
-                if not _check_pause(omni_active, chat_key, chat_id, "omni", phase, step):
-                    break
+        cancel_event.wait(2)
+        return phase
 
-                exec_prompt = f"Original task:\n{original_task}\n\nReview the current PLAN.md and project state. Implement the next pending step of the plan. Verify your work with tests where applicable."
-                if audit_feedback:
-                    if len(audit_feedback_history) > 1:
-                        history_lines = []
-                        for i, prev in enumerate(audit_feedback_history[:-1], 1):
-                            history_lines.append(f"--- Round {i} ---\n{prev}")
-                        history_block = "\n\n".join(history_lines)
-                        exec_prompt = (
-                            f"Original task:\n{original_task}\n\n"
-                            f"⚠️ FEEDBACK HISTORY (previous audit rounds — watch for cycling):\n"
-                            f"{history_block}\n\n"
-                            f"--- LATEST audit feedback to fix NOW ---\n{audit_feedback}\n\n"
-                            f"IMPORTANT: If you see the same issues alternating across rounds, you are in a cycle. "
-                            f"Find a solution that resolves ALL recurring issues at once, not just the latest one.\n\n"
-                            f"Then proceed with the next pending step from PLAN.md. Verify your work with tests where applicable."
-                        )
-                    else:
-                        exec_prompt = f"Original task:\n{original_task}\n\nFix the issues identified in the recent audit:\n{audit_feedback}\n\nThen proceed with the next pending step from PLAN.md. Verify your work with tests where applicable."
+    def _execute_phase(phase):
+        """Run the next plan step (Gemini, Claude fallback). Returns the next phase, or None to stop."""
+        nonlocal session
+        # Check cancellation/pause
+        if not _check_pause(omni_active, chat_key, chat_id, "omni", phase, step):
+            return None
 
-                # Use Codex's recommended executor
-                use_executor = preferred_executor
+        exec_prompt = f"Original task:\n{original_task}\n\nReview the current PLAN.md and project state. Implement the next pending step of the plan. Verify your work with tests where applicable."
+        if audit_feedback:
+            if len(audit_feedback_history) > 1:
+                history_lines = []
+                for i, prev in enumerate(audit_feedback_history[:-1], 1):
+                    history_lines.append(f"--- Round {i} ---\n{prev}")
+                history_block = "\n\n".join(history_lines)
+                exec_prompt = (
+                    f"Original task:\n{original_task}\n\n"
+                    f"⚠️ FEEDBACK HISTORY (previous audit rounds — watch for cycling):\n"
+                    f"{history_block}\n\n"
+                    f"--- LATEST audit feedback to fix NOW ---\n{audit_feedback}\n\n"
+                    f"IMPORTANT: If you see the same issues alternating across rounds, you are in a cycle. "
+                    f"Find a solution that resolves ALL recurring issues at once, not just the latest one.\n\n"
+                    f"Then proceed with the next pending step from PLAN.md. Verify your work with tests where applicable."
+                )
+            else:
+                exec_prompt = f"Original task:\n{original_task}\n\nFix the issues identified in the recent audit:\n{audit_feedback}\n\nThen proceed with the next pending step from PLAN.md. Verify your work with tests where applicable."
 
-                if use_executor == "gemini":
-                    send_message(chat_id, f"⚒️ *Step {step}: Executing* (Gemini)\n_{exec_prompt[:150]}_")
-                    exec_response, gemini_sid, gemini_error, gemini_did_work = run_gemini_streaming(
-                        exec_prompt, chat_id, cwd=cwd, session=session,
-                        session_id=session_id
-                    )
-                    session = get_session_by_id(chat_id, session_id) or session
-                    if not omni_active.get(chat_key, {}).get("active"):
-                        break
+        # Use Codex's recommended executor
+        use_executor = preferred_executor
 
-                    # Fallback to Claude if Gemini actually failed
-                    if gemini_error or (not exec_response.strip() and not gemini_did_work):
-                        print(f"{log_prefix} Step {step}: Gemini {'errored' if gemini_error else 'returned empty'}, falling back to Claude", flush=True)
-                        send_message(chat_id, f"🔄 *Gemini {'failed' if gemini_error else 'returned empty'}* — falling back to Claude...")
-                        use_executor = "claude"  # Fall through to Claude below
+        if use_executor == "gemini":
+            status.push(f"⚒️ *Step {step}: Executing* (Gemini)\n_{exec_prompt[:150]}_")
+            exec_response, gemini_sid, gemini_error, gemini_did_work = run_gemini_streaming(
+                exec_prompt, chat_id, cwd=cwd, session=session,
+                session_id=session_id
+            )
+            session = get_session_by_id(chat_id, session_id) or session
+            if not omni_active.get(chat_key, {}).get("active"):
+                return None
+
+            # Fallback to Claude if Gemini actually failed
+            if gemini_error or (not exec_response.strip() and not gemini_did_work):
+                print(f"{log_prefix} Step {step}: Gemini {'errored' if gemini_error else 'returned empty'}, falling back to Claude", flush=True)
+                status.push(f"🔄 *Gemini {'failed' if gemini_error else 'returned empty'}* — falling back to Claude...")
+                use_executor = "claude"  # Fall through to Claude below
+
+        if use_executor == "claude":
+            status.push(f"⚒️ *Step {step}: Executing* (Claude)\n_{exec_prompt[:150]}_")
+            exec_response, exec_questions, _, claude_sid, context_overflow = run_claude_streaming(
+                exec_prompt, chat_id, cwd=cwd, continue_session=True,
+                session_id=session_id, session=session
+            )
+            _ws_broadcast_status(chat_id, "omni", phase, step)  # Re-assert after Claude exits
+            if not omni_active.get(chat_key, {}).get("active"):
+                return None
 
-                if use_executor == "claude":
-                    send_message(chat_id, f"⚒️ *Step {step}: Executing* (Claude)\n_{exec_prompt[:150]}_")
-                    exec_response, exec_questions, _, claude_sid, context_overflow = run_claude_streaming(
-                        exec_prompt, chat_id, cwd=cwd, continue_session=True,
-                        session_id=session_id, session=session
-                    )
-                    _ws_broadcast_status(chat_id, "omni", phase, step)  # Re-assert after Claude exits
-                    if not omni_active.get(chat_key, {}).get("active"):
-                        break
+            if claude_sid:
+                session = update_claude_session_id(chat_id, session, claude_sid) or session
 
-                    if claude_sid:
-                        update_claude_session_id(chat_id, session, claude_sid)
-                        session = get_session_by_id(chat_id, session_id) or session
-
-                    if context_overflow:
-                        print(f"{log_prefix} Step {step}: Context overflow, resetting Claude session", flush=True)
-                        send_message(chat_id, "⚠️ Context overflow — resetting Claude session...")
-                        update_claude_session_id(chat_id, session, None)
-                        reset_message_count(chat_id, session, "Claude")
-
-                    if exec_questions:
-                        auto_answer = handle_justdoit_questions(exec_questions)
-                        print(f"{log_prefix} Step {step}: Auto-answering {len(exec_questions)} questions", flush=True)
-                        send_message(chat_id, f"🤖 *Auto-answering:* _{auto_answer[:100]}_")
-                        _, _, _, claude_sid2, _ = run_claude_streaming(
-                            auto_answer, chat_id, cwd=cwd, continue_session=True,
-                            session_id=session_id, session=session
-                        )
-                        if not omni_active.get(chat_key, {}).get("active"):
-                            break
-                        if claude_sid2:
-                            update_claude_session_id(chat_id, session, claude_sid2)
-                            session = get_session_by_id(chat_id, session_id) or session
+            if context_overflow:
+                print(f"{log_prefix} Step {step}: Context overflow, resetting Claude session", flush=True)
+                send_message(chat_id, "⚠️ Context overflow — resetting Claude session...")
+                update_claude_session_id(chat_id, session, None)
+                reset_message_count(chat_id, session, "Claude")
 
+            if exec_questions:
+                _, session = _auto_answer_questions(chat_id, exec_questions, cwd, session_id, session, f"{log_prefix} Step {step}:")
+                if not omni_active.get(chat_key, {}).get("active"):
+                    return None
 
-                if exec_response:
-                    print(f"{log_prefix} Step {step}: Execute response: {exec_response[:300]}...", flush=True)
 
-                phase = "auditing"
-                _ws_broadcast_status(chat_id, "omni", phase, step)
-                time.sleep(2)
-                continue
+        if exec_response:
+            print(f"{log_prefix} Step {step}: Execute response: {exec_response[:300]}...", flush=True)
 
-            # --- Phase 3: Audit (Codex) ---
-            if phase == "auditing":
-                # Check cancellation/pause
-                if not _check_pause(omni_active, chat_key, chat_id, "omni", phase, step):
-                    break
+        phase = "auditing"
+        _ws_broadcast_status(chat_id, "omni", phase, step)
+        cancel_event.wait(2)
+        return phase
 
-                send_message(chat_id, f"🕵️ *Step {step}: Auditing* (Codex)\nReviewing implementation...")
+    def _audit_phase(phase):
+        """Codex audits the changes. Returns the next phase, or None to stop (sign-off or stale loop)."""
+        nonlocal audit_feedback, preferred_executor, notified_exit, empty_audit_streak
+        # Check cancellation/pause
+        if not _check_pause(omni_active, chat_key, chat_id, "omni", phase, step):
+            return None
 
-                # Drain any user feedback sent during execution
-                feedback = drain_user_feedback(chat_key)
-                if feedback:
-                    print(f"{log_prefix} Step {step}: Including user feedback in audit", flush=True)
+        status.push(f"🕵️ *Step {step}: Auditing* (Codex)\nReviewing implementation...")
 
-                # Get git diff summary for concrete evidence of what changed
-                try:
-                    diff_stat = subprocess.run(
-                        ["git", "diff", "--stat"], capture_output=True, text=True, cwd=cwd, timeout=10
-                    ).stdout.strip()
-                except Exception:
-                    diff_stat = ""
-                diff_section = (
-                    f"\n\nFILES CHANGED SINCE LAST AUDIT:\n```\n{diff_stat[:2000]}\n```"
-                    if diff_stat else "\n\n⚠️ No files were modified during this execution step."
-                )
+        # Drain any user feedback sent during execution
+        feedback = drain_user_feedback(chat_key)
+        if feedback:
+            print(f"{log_prefix} Step {step}: Including user feedback in audit", flush=True)
 
-                codex_prompt = (
-                    f"Review the recent changes against PLAN.md and the original task:\n\n"
-                    f"{original_task}\n"
-                    f"{diff_section}\n\n"
-                    f"Check for bugs, security issues, or deviations from the plan.\n\n"
-                    f"PLAN COMPLETION CHECK: Review PLAN.md for any unchecked items (- [ ]).\n"
-                    f"- Mark items [x] ONLY if you verify the work is actually done in the code.\n"
-                    f"- If unchecked items represent work that CAN be done here, direct the executor to implement them.\n"
-                    f"- If unchecked items are INFEASIBLE in this environment (e.g. requires real hardware, manual testing,\n"
-                    f"  external deployment, third-party access), you MAY sign off with caveats noting those items.\n\n"
-                    f"BLOCKER LEDGER: Maintain a '## Blockers' section at the bottom of PLAN.md.\n"
-                    f"- For each issue you find, add: - [ ] BLOCKER: <description> (files: <relevant files>)\n"
-                    f"- For issues that are now fixed in the code, mark them: - [x] BLOCKER: <description>\n"
-                    f"- Do NOT remove blocker lines — only check/uncheck them.\n"
-                    f"- CRITICAL: If you previously raised blockers, you must verify each one is actually fixed\n"
-                    f"  in the code before marking [x]. Do not assume they are fixed without checking.\n\n"
-                    f"To sign off, these must be true:\n"
-                    f"1. All FEASIBLE plan items in PLAN.md show [x] (implementable work is complete)\n"
-                    f"2. All blocker lines show [x] (or no blockers exist)\n"
-                    f"3. No bugs or security issues found in the changes\n"
-                    f"4. Any remaining unchecked items are genuinely infeasible (hardware, manual, external)\n\n"
-                    f"Sign-off format:\n"
-                    f"SIGN-OFF\n"
-                    f"- Plan items completed: <checked>/<total>\n"
-                    f"- Blockers resolved: <count>\n"
-                    f"- Caveats: <list any unchecked items that are infeasible and why, or 'none'>\n"
-                    f"- Files verified: <list of key files checked>\n"
-                    f"- Tests: <test results or 'N/A'>\n\n"
-                    f"If FEASIBLE issues remain, provide precise, actionable feedback.\n"
-                    f"Also recommend who should fix it: 'EXECUTOR: GEMINI' or 'EXECUTOR: CLAUDE'.\n"
-                    f"Prefer CLAUDE for issues requiring careful reasoning, complex edits, or when repeated attempts have failed."
-                )
-                if feedback:
-                    codex_prompt += feedback
-                if session:
-                    bridge = get_context_bridge(session, "Codex")
-                    if bridge:
-                        codex_prompt = bridge + "[NEW TASK]\n" + codex_prompt
-
-                # Run Codex with stale-output watchdog (kills only if no output for 5 min)
-                audit_result = run_codex(codex_prompt, cwd=cwd, session=session, stale_timeout=300)
-                update_session_state(chat_id, session, original_task, "Codex")
-                if not omni_active.get(chat_key, {}).get("active"):
-                    break
+        # Get git diff summary for concrete evidence of what changed
+        try:
+            diff_stat = subprocess.run(
+                ["git", "diff", "--stat"], capture_output=True, text=True, cwd=cwd, timeout=10
+            ).stdout.strip()
+        except Exception:
+            diff_stat = ""
+        diff_section = (
+            f"\n\nFILES CHANGED SINCE LAST AUDIT:\n```\n{diff_stat[:2000]}\n```"
+            if diff_stat else "\n\n⚠️ No files were modified during this execution step."
+        )
 
-                if not audit_result:
-                    print(f"{log_prefix} Step {step}: Codex returned empty result", flush=True)
-                    send_message(chat_id, f"⚠️ *Step {step}:* Codex returned no output. Retrying...")
-                    time.sleep(5)
-                    if not omni_active.get(chat_key, {}).get("active"):
-                        break
-                    audit_result = run_codex(codex_prompt, cwd=cwd, session=session, stale_timeout=300)
-                    if not omni_active.get(chat_key, {}).get("active"):
-                        break
+        codex_prompt = (
+            f"Review the recent changes against PLAN.md and the original task:\n\n"
+            f"{original_task}\n"
+            f"{diff_section}\n\n"
+            f"Check for bugs, security issues, or deviations from the plan.\n\n"
+            f"PLAN COMPLETION CHECK: Review PLAN.md for any unchecked items (- [ ]).\n"
+            f"- Mark items [x] ONLY if you verify the work is actually done in the code.\n"
+            f"- If unchecked items represent work that CAN be done here, direct the executor to implement them.\n"
+            f"- If unchecked items are INFEASIBLE in this environment (e.g. requires real hardware, manual testing,\n"
+            f"  external deployment, third-party access), you MAY sign off with caveats noting those items.\n\n"
+            f"BLOCKER LEDGER: Maintain a '## Blockers' section at the bottom of PLAN.md.\n"
+            f"- For each issue you find, add: - [ ] BLOCKER: <description> (files: <relevant files>)\n"
+            f"- For issues that are now fixed in the code, mark them: - [x] BLOCKER: <description>\n"
+            f"- Do NOT remove blocker lines — only check/uncheck them.\n"
+            f"- CRITICAL: If you previously raised blockers, you must verify each one is actually fixed\n"
+            f"  in the code before marking [x]. Do not assume they are fixed without checking.\n\n"
+            f"To sign off, these must be true:\n"
+            f"1. All FEASIBLE plan items in PLAN.md show [x] (implementable work is complete)\n"
+            f"2. All blocker lines show [x] (or no blockers exist)\n"
+            f"3. No bugs or security issues found in the changes\n"
+            f"4. Any remaining unchecked items are genuinely infeasible (hardware, manual, external)\n\n"
+            f"Sign-off format:\n"
+            f"SIGN-OFF\n"
+            f"- Plan items completed: <checked>/<total>\n"
+            f"- Blockers resolved: <count>\n"
+            f"- Caveats: <list any unchecked items that are infeasible and why, or 'none'>\n"
+            f"- Files verified: <list of key files checked>\n"
+            f"- Tests: <test results or 'N/A'>\n\n"
+            f"If FEASIBLE issues remain, provide precise, actionable feedback.\n"
+            f"Also recommend who should fix it: 'EXECUTOR: GEMINI' or 'EXECUTOR: CLAUDE'.\n"
+            f"Prefer CLAUDE for issues requiring careful reasoning, complex edits, or when repeated attempts have failed."
+        )
+        if feedback:
+            codex_prompt += feedback
+        if session:
+            bridge = get_context_bridge(session, "Codex")
+            if bridge:
+                codex_prompt = bridge + "[NEW TASK]\n" + codex_prompt
+
+        # Run Codex with stale-output watchdog (kills only if no output for 5 min)
+        audit_result = run_codex(codex_prompt, cwd=cwd, session=session, stale_timeout=300, cancel_event=cancel_event)
+        update_session_state(chat_id, session, original_task, "Codex")
+        if not omni_active.get(chat_key, {}).get("active"):
+            return None
 
-                if audit_result:
-                    print(f"{log_prefix} Step {step}: Codex audit result: {audit_result[:500]}...", flush=True)
-                    # Show audit result to user
-                    send_message(chat_id, f"🔍 *Audit Result (Step {step}):*\n_{audit_result[:1000]}_")
-
-                # Check for sign-off: any line starting with SIGN-OFF counts
-                # (Codex often adds preamble text before the SIGN-OFF verdict)
-                has_signoff = any(line.strip().upper().startswith("SIGN-OFF") for line in audit_result.strip().split("\n")) if audit_result else False
-
-                # Contradiction gate: reject sign-off if open blockers remain in PLAN.md
-                gate_rejected = False
-                if has_signoff:
-                    # Check 1: open blockers
-                    open_blockers = _check_open_blockers(cwd)
-                    if open_blockers:
-                        has_signoff = False
-                        gate_rejected = True
-                        blocker_list = "\n".join(open_blockers[:10])
-                        print(f"{log_prefix} Step {step}: Sign-off REJECTED — {len(open_blockers)} open blocker(s)", flush=True)
-                        send_message(chat_id, f"🚫 *Sign-off rejected* — {len(open_blockers)} open blocker(s) in PLAN.md:\n```\n{blocker_list}\n```")
-                        audit_feedback = (
-                            f"SIGN-OFF REJECTED by contradiction gate: Codex said SIGN-OFF but {len(open_blockers)} "
-                            f"unchecked blocker(s) remain in PLAN.md:\n{blocker_list}\n\n"
-                            f"The auditor (Codex) did NOT update the blocker checkboxes in PLAN.md before signing off.\n"
-                            f"You must either: (1) resolve the blocker issues in code AND mark them [x] in PLAN.md, "
-                            f"or (2) if the blockers are already resolved, update PLAN.md to mark them [x].\n\n"
-                            f"Codex original verdict:\n{audit_result[:3000] if audit_result else '(empty)'}"
-                        )
+        if not audit_result:
+            # Retry once with a nudge toward a short verdict and a tighter stale timeout,
+            # so a stuck Codex costs ~7 min instead of two full 5-min timeouts.
+            print(f"{log_prefix} Step {step}: Codex returned empty result", flush=True)
+            send_message(chat_id, f"⚠️ *Step {step}:* Codex returned no output. Retrying...")
+            audit_result = run_codex(
+                codex_prompt + "\n\n(Previous attempt returned empty. Respond with SIGN-OFF or one bullet of feedback.)",
+                cwd=cwd, session=session, stale_timeout=120, cancel_event=cancel_event
+            )
+            if not omni_active.get(chat_key, {}).get("active"):
+                return None
+        if audit_result:
+            empty_audit_streak = 0
+        else:
+            empty_audit_streak += 1
+            if empty_audit_streak >= 2:
+                send_message(chat_id, f"🛑 *Omni stopped:* Codex audit returned no output {empty_audit_streak} steps in a row (step {step}).\n_Session preserved._")
+                notified_exit = True
+                return None
+
+        if audit_result:
+            print(f"{log_prefix} Step {step}: Codex audit result: {audit_result[:500]}...", flush=True)
+            # Show audit result to user
+            send_message(chat_id, f"🔍 *Audit Result (Step {step}):*\n_{audit_result[:1000]}_")
+
+        # Check for sign-off: any line starting with SIGN-OFF counts
+        # (Codex often adds preamble text before the SIGN-OFF verdict)
+        has_signoff = bool(audit_result and _SIGNOFF_RE.search(audit_result))
+
+        # Contradiction gate: reject sign-off if open blockers remain in PLAN.md
+        gate_rejected = False
+        if has_signoff:
+            # Check 1: open blockers
+            open_blockers = _check_open_blockers(cwd)
+            if open_blockers:
+                has_signoff = False
+                gate_rejected = True
+                blocker_list = "\n".join(open_blockers[:10])
+                print(f"{log_prefix} Step {step}: Sign-off REJECTED — {len(open_blockers)} open blocker(s)", flush=True)
+                send_message(chat_id, f"🚫 *Sign-off rejected* — {len(open_blockers)} open blocker(s) in PLAN.md:\n```\n{blocker_list}\n```")
+                audit_feedback = (
+                    f"SIGN-OFF REJECTED by contradiction gate: Codex said SIGN-OFF but {len(open_blockers)} "
+                    f"unchecked blocker(s) remain in PLAN.md:\n{blocker_list}\n\n"
+                    f"The auditor (Codex) did NOT update the blocker checkboxes in PLAN.md before signing off.\n"
+                    f"You must either: (1) resolve the blocker issues in code AND mark them [x] in PLAN.md, "
+                    f"or (2) if the blockers are already resolved, update PLAN.md to mark them [x].\n\n"
+                    f"Codex original verdict:\n{audit_result[:3000] if audit_result else '(empty)'}"
+                )
 
-                    # Check 2: unchecked plan items (soft check — log but don't block)
-                    # Some items may be genuinely infeasible (hardware testing, manual steps, etc.)
-                    # Trust Codex's judgment from the prompt to sign off with caveats when appropriate.
-                    if has_signoff:
-                        pending, total = _check_pending_plan_items(cwd)
-                        if pending > 0:
-                            print(f"{log_prefix} Step {step}: Sign-off with {pending}/{total} plan items still pending (caveats accepted)", flush=True)
+            # Check 2: unchecked plan items (soft check — log but don't block)
+            # Some items may be genuinely infeasible (hardware testing, manual steps, etc.)
+            # Trust Codex's judgment from the prompt to sign off with caveats when appropriate.
+            if has_signoff:
+                pending, total = _check_pending_plan_items(cwd)
+                if pending > 0:
+                    print(f"{log_prefix} Step {step}: Sign-off with {pending}/{total} plan items still pending (caveats accepted)", flush=True)
 
-                if has_signoff:
-                    caveat_note = ""
-                    if pending > 0:
-                        caveat_note = f"\n\n⚠️ *{pending}/{total} plan items still pending* (accepted with caveats — may require hardware, manual testing, or external resources)"
-                    send_message(chat_id, f"""✅ *Omni Task Complete!* (Step {step})
+        if has_signoff:
+            caveat_note = ""
+            if pending > 0:
+                caveat_note = f"\n\n⚠️ *{pending}/{total} plan items still pending* (accepted with caveats — may require hardware, manual testing, or external resources)"
+            send_message(chat_id, f"""✅ *Omni Task Complete!* (Step {step})
 
 Codex provided final sign-off.{caveat_note}
 
 _Session preserved. You can continue chatting in this session._""")
-                    notified_exit = True
-                    break
-                else:
-                    if not gate_rejected:
-                        audit_feedback = audit_result[:6000] if audit_result else "Previous audit returned no feedback."
-                    audit_feedback_history.append(audit_feedback[:1500])
-                    sig = _feedback_signature(audit_result)
-                    if sig:
-                        audit_reject_sigs.append(sig)
-                    audit_reject_count = audit_reject_sigs.count(sig) if sig else 0
-                    print(f"{log_prefix} Step {step}: Audit reject count={audit_reject_count}/{len(audit_reject_sigs)}", flush=True)
-                    if sig and audit_reject_count >= STALE_REJECT_LIMIT:
-                        send_message(chat_id, f"""🛑 *Omni stopped: stale audit loop detected* (step {step})
+            notified_exit = True
+            return None
+        else:
+            if not gate_rejected:
+                audit_feedback = audit_result[:6000] if audit_result else "Previous audit returned no feedback."
+            audit_feedback_history.append(audit_feedback[:1500])
+            sig = _feedback_signature(audit_result)
+            if sig:
+                audit_reject_sigs.append(sig)
+            audit_reject_count = audit_reject_sigs.count(sig) if sig else 0
+            print(f"{log_prefix} Step {step}: Audit reject count={audit_reject_count}/{len(audit_reject_sigs)}", flush=True)
+            if sig and audit_reject_count >= STALE_REJECT_LIMIT:
+                send_message(chat_id, f"""🛑 *Omni stopped: stale audit loop detected* (step {step})
 
 Codex audit feedback matched a previous rejection *{audit_reject_count}* times in the last {len(audit_reject_sigs)} rounds.
 This indicates a back-and-forth cycle. Omni stopped to avoid endless architect/audit cycling.
 
 Use `/omni` again with an explicit decision (accept ops-blocked state, or provide one concrete fix target).""")
-                        notified_exit = True
+                notified_exit = True
+                return None
+            # Parse executor recommendation for next cycle
+            if audit_result:
+                for line in audit_result.strip().split("\n"):
+                    stripped = line.strip().upper()
+                    if stripped.startswith("EXECUTOR:"):
+                        rec = stripped.split(":", 1)[1].strip()
+                        if "CLAUDE" in rec:
+                            preferred_executor = "claude"
+                        elif "GEMINI" in rec:
+                            preferred_executor = "gemini"
                         break
-                    # Parse executor recommendation for next cycle
-                    if audit_result:
-                        for line in audit_result.strip().split("\n"):
-                            stripped = line.strip().upper()
-                            if stripped.startswith("EXECUTOR:"):
-                                rec = stripped.split(":", 1)[1].strip()
-                                if "CLAUDE" in rec:
-                                    preferred_executor = "claude"
-                                elif "GEMINI" in rec:
-                                    preferred_executor = "gemini"
-                                break
-                    # Loop back: architect incorporates feedback, then execute fixes
-                    phase = "architecting"
-                    _ws_broadcast_status(chat_id, "omni", phase, step)
+            # Loop back: architect incorporates feedback, then execute fixes
+            phase = "architecting"
+            _ws_broadcast_status(chat_id, "omni", phase, step)
+
+        cancel_event.wait(2)
+        return phase
+
+    phase_handlers = {
+        "architecting": _architect_phase,
+        "executing": _execute_phase,
+        "auditing": _audit_phase,
+    }
+
+    try:
+        send_message(chat_id, f"""🚀 *Omni Task Started* on `{session_name}`
+
+Task: _{task[:200]}_
+
+_Claude (Architect) → Gemini (Execute) → Codex (Audit)_
+_Claude as fallback if Gemini fails._
+_Use /cancel to stop at any time._""")
+
+        while omni_active.get(chat_key, {}).get("active"):
+            step += 1
+            omni_active[chat_key]["step"] = step
+            omni_active[chat_key]["phase"] = phase
+            mark_active_tasks_dirty()
+            _ws_broadcast_status(chat_id, "omni", phase, step)
+
+            # Stop if we hit a runaway limit
+            if step > 200:
+                send_message(chat_id, "⚠️ *Omni limit reached* (200 steps). Stopping to prevent loop.")
+                break
+
+            print(f"{log_prefix} === Step {step} === Phase: {phase}", flush=True)
 
-                time.sleep(2)
+            # Each phase handler runs one step and returns the next phase (None = stop)
+            phase = phase_handlers[phase](phase)
+            if phase is None:
+                break
 
         if not notified_exit:
-            send_message(chat_id, f"🏁 *Omni process finished* for `{session.get('name', 'unknown')}`.")
+            send_message(chat_id, f"🏁 *Omni process finished* for `{session_name}`.")
 
     except Exception as e:
-        import traceback
         print(f"{log_prefix} EXCEPTION: {e}", flush=True)
         print(f"{log_prefix} Traceback:\n{traceback.format_exc()}", flush=True)
         try:
-            send_message(chat_id, f"❌ *Omni error:* {str(e)[:300]}")
+            send_message(chat_id, f"❌ *Omni error:* {md_escape(str(e)[:300])}")
         except Exception:
             pass
     finally:
@@ -4300,38 +4963,81 @@ def run_justdoit_loop(chat_id, task, session):
     session_id = get_session_id(session)
     chat_key = f"{chat_id}:{session_id}"
     cwd = session["cwd"]
-    log_prefix = f"[JustDoIt {chat_id}:{session.get('name', 'unknown')}]"
+    session_name = session.get("name", "unknown")
+    log_prefix = f"[JustDoIt {chat_id}:{session_name}]"
     # Pin WS session label to the originating session for all send_message calls on this thread
     _ws_session_override.name = session.get("name", "")
 
     print(f"{log_prefix} Starting. Task: {task[:200]}", flush=True)
     print(f"{log_prefix} Session ID: {session_id}, CWD: {cwd}", flush=True)
 
-    justdoit_active[chat_key] = {
-        "active": True,
-        "paused": False,
-        "resume_event": threading.Event(),
-        "task": task,
-        "step": 0,
-        "phase": "implementing",
-        "chat_id": str(chat_id),
-        "session_name": session.get("name", "unknown"),
-        "started": time.time(),
-    }
-    justdoit_active[chat_key]["resume_event"].set()  # Not paused initially
-    save_active_tasks()
+    justdoit_active[chat_key] = _new_loop_state(chat_id, session_name, task, "implementing")
+    cancel_event = justdoit_active[chat_key]["cancel_event"]
+    status = StatusThrottler(chat_id, state=justdoit_active[chat_key])  # Coalesces short step/phase status lines into one message
+    mark_active_tasks_dirty()
     _ws_broadcast_status(chat_id, "justdoit", "starting", 0, active=True, task=task, started=justdoit_active[chat_key]["started"])
 
     step = 0
     phase = "implementing"
-    history_summary = ""
+    history = deque(maxlen=8)  # Recent per-step summaries for Codex (bounded so prompts don't grow without limit)
     plan_file = os.path.join(cwd, "PLAN.md")
     claude_plan = ""  # Read from plan file to give Codex full plan visibility
+    plan_cache = {"mtime": 0, "text": ""}
+
+    def _read_plan():
+        """Return PLAN.md (truncated), re-reading only when its mtime changed. None if missing."""
+        try:
+            mtime = os.stat(plan_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if mtime != plan_cache["mtime"]:
+            with open(plan_file, "r") as f:
+                plan_cache["text"] = f.read()[:5000]
+            plan_cache["mtime"] = mtime
+        return plan_cache["text"]
     codex_fail_streak = 0
     pending_transition = None  # Set when Codex says VERIFY:<target>, cleared after verification
     verify_attempts = 0  # Track consecutive verification attempts to prevent loops
-    recent_codex_actions = []  # Track last N (reasoning, prompt_prefix) tuples for loop detection
+    recent_codex_actions = deque(maxlen=6)  # Track last N (reasoning, prompt_prefix) tuples for loop detection
     notified_exit = False  # Track whether we sent a final status message to the user
+    announced_step = 0  # Step whose "Sending to Claude" header already went out with the previous "Next:" line
+
+    def _on_phase(new_phase, forced=""):
+        """PHASE:<phase> — switch phase and reset verification/loop tracking."""
+        nonlocal phase, verify_attempts
+        if new_phase not in _PHASE_LABELS:
+            return False
+        print(f"{log_prefix} Step {step}: Phase transition {phase} -> {new_phase}{forced}", flush=True)
+        phase = new_phase
+        justdoit_active[chat_key]["phase"] = phase
+        _ws_broadcast_status(chat_id, "justdoit", phase, step)
+        verify_attempts = 0
+        recent_codex_actions.clear()  # Reset loop detection on phase change
+        status.push(f"{_PHASE_EMOJI.get(phase, '📋')} *Phase transition: {phase.upper()}*{forced}")
+        return False
+
+    def _on_verify(target):
+        """VERIFY:<target> — ask Claude to verify first; force the move after 3 attempts. True = loop done."""
+        nonlocal verify_attempts, pending_transition, notified_exit
+        if not target:
+            return False
+        verify_attempts += 1
+        print(f"{log_prefix} Step {step}: Verification requested -> {target} (attempt {verify_attempts})", flush=True)
+        if verify_attempts < 3:
+            pending_transition = target
+            status.push(f"🔍 *Step {step}* — Verification requested before moving to {target}")
+            return False
+        # Force transition to prevent infinite verification loops
+        forced = f" (forced after {verify_attempts} verification attempts)"
+        if target == "done":
+            send_message(chat_id, f"✅ *JustDoIt Complete!*{forced}\n\nCompleted in *{step}* steps.\n\n_Session preserved._")
+            notified_exit = True
+            return True
+        _on_phase(target, forced)
+        verify_attempts = 0
+        return False
+
+    tag_handlers = {"PHASE": _on_phase, "VERIFY": _on_verify}
 
     try:
         send_message(chat_id, f"""🚀 *JustDoIt Mode Activated*
@@ -4358,14 +5064,13 @@ _Use /cancel to stop at any time._""")
             session_id=session_id, session=session
         )
         if plan_sid:
-            update_claude_session_id(chat_id, session, plan_sid)
-            session = get_session_by_id(chat_id, session_id) or session
+            session = update_claude_session_id(chat_id, session, plan_sid) or session
 
         # Read the plan file Claude just created/updated
         try:
-            if os.path.exists(plan_file):
-                with open(plan_file, "r") as f:
-                    claude_plan = f.read()[:5000]
+            plan_text = _read_plan()
+            if plan_text is not None:
+                claude_plan = plan_text
                 print(f"{log_prefix} Step 0: PLAN.md loaded ({len(claude_plan)} chars)", flush=True)
             else:
                 print(f"{log_prefix} Step 0: PLAN.md not found after setup", flush=True)
@@ -4386,23 +5091,25 @@ _Use /cancel to stop at any time._""")
                 break
 
             step += 1
+            step_started = time.monotonic()
             justdoit_active[chat_key]["step"] = step
             justdoit_active[chat_key]["phase"] = phase
-            save_active_tasks()
+            mark_active_tasks_dirty()
             _ws_broadcast_status(chat_id, "justdoit", phase, step)
 
             print(f"{log_prefix} === Step {step} === Phase: {phase}, Pending transition: {pending_transition}", flush=True)
 
             # --- Phase 1: Send prompt to Claude ---
             print(f"{log_prefix} Step {step}: Sending to Claude. Prompt: {current_prompt[:200]}...", flush=True)
-            send_message(chat_id, f"🔄 *Step {step}* — Sending to Claude...")
+            if announced_step != step:
+                status.push(f"🔄 *Step {step}* — Sending to Claude...")
 
             # Handle compaction
             needs_compaction = increment_message_count(chat_id, session, "Claude")
 
             if needs_compaction:
                 print(f"{log_prefix} Step {step}: Auto-compaction triggered", flush=True)
-                send_message(chat_id, "📦 *Auto-compacting* session context...")
+                status.push("📦 *Auto-compacting* session context...")
 
                 summary_prompt = """Summarize this session for context continuity (max 500 words). Focus on ACTIONABLE STATE:
 1. Files being edited — exact paths and what changed
@@ -4438,7 +5145,7 @@ Format as a compact bullet list."""
 {current_prompt}"""
 
                 print(f"{log_prefix} Step {step}: Compaction done. Summary length: {len(summary) if summary else 0}", flush=True)
-                send_message(chat_id, "🔄 Context preserved. Continuing...")
+                status.push("🔄 Context preserved. Continuing...")
 
             # Check cancellation after compaction
             state = justdoit_active.get(chat_key, {})
@@ -4466,13 +5173,12 @@ Format as a compact bullet list."""
 
             # Update session ID
             if claude_sid:
-                update_claude_session_id(chat_id, session, claude_sid)
-                session = get_session_by_id(chat_id, session_id) or session
+                session = update_claude_session_id(chat_id, session, claude_sid) or session
 
             # Handle context overflow
             if context_overflow:
                 print(f"{log_prefix} Step {step}: Context overflow detected, compacting.", flush=True)
-                send_message(chat_id, "⚠️ Context overflow — compacting...")
+                status.push("⚠️ Context overflow — compacting...")
                 update_claude_session_id(chat_id, session, None)
                 reset_message_count(chat_id, session, "Claude")
 
@@ -4481,61 +5187,51 @@ Format as a compact bullet list."""
                     session_id=session_id, session=session
                 )
                 if claude_sid:
-                    update_claude_session_id(chat_id, session, claude_sid)
-                    session = get_session_by_id(chat_id, session_id) or session
+                    session = update_claude_session_id(chat_id, session, claude_sid) or session
 
             # Handle questions from Claude (auto-answer)
             if questions:
-                auto_answer = handle_justdoit_questions(questions)
-                print(f"{log_prefix} Step {step}: Auto-answering {len(questions)} questions. Answer: {auto_answer[:200]}", flush=True)
-                send_message(chat_id, f"🤖 *Auto-answering:* _{auto_answer[:100]}_")
-
-                response2, questions2, _, claude_sid2, _ = run_claude_streaming(
-                    auto_answer, chat_id, cwd=cwd, continue_session=True,
-                    session_id=session_id, session=session
-                )
-                if claude_sid2:
-                    update_claude_session_id(chat_id, session, claude_sid2)
-                    session = get_session_by_id(chat_id, session_id) or session
-
+                response2, session = _auto_answer_questions(chat_id, questions, cwd, session_id, session, f"{log_prefix} Step {step}:")
                 if response2:
                     response = (response or "") + "\n\n[After auto-answer:]\n" + response2
 
             # Clean response for review
             clean_response = response.split("———")[0].strip() if response else "No output"
 
-            # Re-read PLAN.md after each step (Claude may have updated checkboxes)
+            # Refresh PLAN.md after each step (Claude may have updated checkboxes)
             try:
-                if os.path.exists(plan_file):
-                    with open(plan_file, "r") as f:
-                        claude_plan = f.read()[:5000]
+                plan_text = _read_plan()
+                if plan_text is not None:
+                    claude_plan = plan_text
             except Exception:
                 pass
 
-            # Update rolling history — no cap, Codex models have large context windows
+            # Update rolling history — last 8 steps is plenty of context for Codex
             step_summary = clean_response[:1500]
-            history_summary += f"\n\nStep {step}: {step_summary}"
+            history.append(f"Step {step}: {step_summary}")
+            history_summary = "\n\n".join(history)
 
             # --- Phase 2: Pause (human-like pacing) ---
-            time.sleep(3)
+            cancel_event.wait(3)
 
             # Check cancellation/pause before Codex
             if not _check_pause(justdoit_active, chat_key, chat_id, "justdoit", phase, step):
                 send_message(chat_id, f"⚠️ *JustDoIt cancelled* at step {step}.")
+                notified_exit = True
                 break
 
             # --- Phase 3: Codex reviews ---
-            phase_labels = {"implementing": "🔨 Implementing", "reviewing": "🔍 Reviewing", "testing": "🧪 Testing"}
+            phase_label = _PHASE_LABELS.get(phase, phase)
             if pending_transition:
-                send_message(chat_id, f"🧠 *Step {step}* ({phase_labels.get(phase, phase)}) — Codex reviewing verification...")
+                status.push(f"🧠 *Step {step}* ({phase_label}) — Codex reviewing verification...")
             else:
-                send_message(chat_id, f"🧠 *Step {step}* ({phase_labels.get(phase, phase)}) — Codex reviewing output...")
+                status.push(f"🧠 *Step {step}* ({phase_label}) — Codex reviewing output...")
 
             # Detect stale progress: check if recent actions are repetitive
             stale_warning = None
             if len(recent_codex_actions) >= 3:
                 # Check if the last 3 actions have the same reasoning pattern (e.g. all VERIFY:reviewing)
-                last_3_reasons = [a[0] for a in recent_codex_actions[-3:]]
+                last_3_reasons = [a[0] for a in list(recent_codex_actions)[-3:]]
                 if len(set(last_3_reasons)) == 1:
                     stale_warning = (
                         f"The last {len(last_3_reasons)} steps all had the same action pattern: '{last_3_reasons[0]}'. "
@@ -4555,8 +5251,10 @@ Format as a compact bullet list."""
             next_prompt, is_done, reasoning = run_codex_review(
                 task, clean_response, step, history_summary, cwd, phase=phase,
                 pending_transition=pending_transition, stale_warning=stale_warning,
-                claude_plan=claude_plan, user_feedback=feedback
+                claude_plan=claude_plan, user_feedback=feedback, cancel_event=cancel_event
             )
+            if cancel_event.is_set():
+                continue  # /cancel killed Codex; the loop head reports the cancellation
             # Clear pending_transition after it's been used
             pending_transition = None
             print(f"{log_prefix} Step {step}: Codex result — is_done: {is_done}, reasoning: {reasoning[:200] if reasoning else 'none'}", flush=True)
@@ -4566,8 +5264,6 @@ Format as a compact bullet list."""
             # Track this action for loop detection
             action_key = reasoning[:30] if reasoning else "continue"
             recent_codex_actions.append((action_key, (next_prompt or "")[:50]))
-            if len(recent_codex_actions) > 6:
-                recent_codex_actions.pop(0)
 
             if is_done:
                 print(f"{log_prefix} Step {step}: DONE. Summary: {reasoning[:300] if reasoning else 'none'}", flush=True)
@@ -4578,72 +5274,29 @@ Completed in *{step}* steps.
 *Summary:* {reasoning[:500] if reasoning else 'Task completed successfully.'}
 
 _Session preserved. You can continue chatting with Claude in this session._""")
+                notified_exit = True
                 break
 
-            # Handle phase transitions
-            if reasoning and reasoning.startswith("PHASE:"):
-                new_phase = reasoning[6:].strip()
-                if new_phase in ("implementing", "reviewing", "testing"):
-                    print(f"{log_prefix} Step {step}: Phase transition {phase} -> {new_phase}", flush=True)
-                    phase = new_phase
-                    justdoit_active[chat_key]["phase"] = phase
-                    _ws_broadcast_status(chat_id, "justdoit", phase, step)
-                    verify_attempts = 0  # Reset on successful transition
-                    recent_codex_actions.clear()  # Reset loop detection on phase change
-                    phase_emoji = {"implementing": "🔨", "reviewing": "🔍", "testing": "🧪"}.get(phase, "📋")
-                    send_message(chat_id, f"{phase_emoji} *Phase transition: {phase.upper()}*")
-
-            # Handle verification requests (Codex wants Claude to verify before transitioning)
-            if reasoning and reasoning.startswith("VERIFY:"):
-                target = reasoning[7:].strip()
-                verify_attempts += 1
-                print(f"{log_prefix} Step {step}: Verification requested -> {target} (attempt {verify_attempts})", flush=True)
-                if verify_attempts >= 3:
-                    # Force transition to prevent infinite verification loops
-                    print(f"{log_prefix} Step {step}: Forcing transition to {target} after {verify_attempts} verify attempts", flush=True)
-                    if target in ("implementing", "reviewing", "testing"):
-                        phase = target
-                        justdoit_active[chat_key]["phase"] = phase
-                        _ws_broadcast_status(chat_id, "justdoit", phase, step)
-                        phase_emoji = {"implementing": "🔨", "reviewing": "🔍", "testing": "🧪"}.get(phase, "📋")
-                        send_message(chat_id, f"{phase_emoji} *Phase transition: {phase.upper()}* (forced after {verify_attempts} verification attempts)")
-                    elif target == "done":
-                        send_message(chat_id, f"✅ *JustDoIt Complete!* (forced after {verify_attempts} verification attempts)\n\nCompleted in *{step}* steps.\n\n_Session preserved._")
-                        notified_exit = True
-                        break
-                    verify_attempts = 0
-                else:
-                    pending_transition = target
-                    send_message(chat_id, f"🔍 *Step {step}* — Verification requested before moving to {target}")
+            # Handle phase transitions / verification requests (Codex wants Claude to verify first)
+            tag = _TAG_RE.match(reasoning or "")
+            if tag and tag.group(1) in tag_handlers and tag_handlers[tag.group(1)](tag.group(2)):
+                break
 
             # Handle quota errors — wait and retry
             # Format: "QUOTA:<minutes> <details>" from both Codex errors and Codex-detected Claude errors
-            if next_prompt is None and reasoning and reasoning.startswith("QUOTA:"):
-                # Parse "QUOTA:<minutes> <details>"
-                quota_rest = reasoning[6:].strip()
-                parts = quota_rest.split(" ", 1)
-                try:
-                    wait_min = max(1, int(parts[0]))
-                except (ValueError, IndexError):
-                    wait_min = 60
-                details = parts[1] if len(parts) > 1 else ""
-                wait_secs = wait_min * 60
-                resume_time = (datetime.now() + timedelta(seconds=wait_secs)).strftime('%H:%M')
-                print(f"{log_prefix} Step {step}: Rate limited. Wait: {wait_min}min. {details[:200]}", flush=True)
-                send_message(chat_id,
-                    f"⏳ *Rate limited* at step {step}.\n"
-                    f"{details[:200]}\n"
-                    f"_Waiting ~{wait_min}min... (resume ~{resume_time})_\n"
-                    f"_Use /cancel to abort._")
-                if not _justdoit_wait(chat_key, wait_secs):
-                    send_message(chat_id, f"⚠️ *JustDoIt cancelled* during rate-limit wait.")
+            if next_prompt is None and tag and tag.group(1) == "QUOTA":
+                if not _handle_quota_wait(reasoning, chat_id, chat_key, _justdoit_wait, "JustDoIt"):
+                    notified_exit = True
                     break
-                send_message(chat_id, "🔄 *Resuming after rate-limit wait...*")
+                status.push("🔄 *Resuming after rate-limit wait...*")
                 next_prompt, is_done, reasoning = run_codex_review(
                     task, clean_response, step, history_summary, cwd, phase=phase,
-                    pending_transition=pending_transition, claude_plan=claude_plan
+                    pending_transition=pending_transition, claude_plan=claude_plan,
+                    cancel_event=cancel_event
                 )
                 pending_transition = None
+                if cancel_event.is_set():
+                    continue
 
                 if is_done:
                     send_message(chat_id, f"""✅ *JustDoIt Complete!*
@@ -4653,33 +5306,12 @@ Completed in *{step}* steps.
 *Summary:* {reasoning[:500] if reasoning else 'Task completed successfully.'}
 
 _Session preserved. You can continue chatting with Claude in this session._""")
+                    notified_exit = True
+                    break
+                # Handle phase transition / verification request after quota retry
+                tag = _TAG_RE.match(reasoning or "")
+                if tag and tag.group(1) in tag_handlers and tag_handlers[tag.group(1)](tag.group(2)):
                     break
-                # Handle phase transition after quota retry
-                if reasoning and reasoning.startswith("PHASE:"):
-                    new_phase = reasoning[6:].strip()
-                    if new_phase in ("implementing", "reviewing", "testing"):
-                        phase = new_phase
-                        justdoit_active[chat_key]["phase"] = phase
-                        _ws_broadcast_status(chat_id, "justdoit", phase, step)
-                        verify_attempts = 0
-                        phase_emoji = {"implementing": "🔨", "reviewing": "🔍", "testing": "🧪"}.get(phase, "📋")
-                        send_message(chat_id, f"{phase_emoji} *Phase transition: {phase.upper()}*")
-                # Handle verification request after quota retry
-                if reasoning and reasoning.startswith("VERIFY:"):
-                    target = reasoning[7:].strip()
-                    verify_attempts += 1
-                    if verify_attempts >= 3:
-                        print(f"{log_prefix} Step {step}: Forcing transition to {target} after {verify_attempts} verify attempts (post-quota)", flush=True)
-                        if target in ("implementing", "reviewing", "testing"):
-                            phase = target
-                            justdoit_active[chat_key]["phase"] = phase
-                            _ws_broadcast_status(chat_id, "justdoit", phase, step)
-                            phase_emoji = {"implementing": "🔨", "reviewing": "🔍", "testing": "🧪"}.get(phase, "📋")
-                            send_message(chat_id, f"{phase_emoji} *Phase transition: {phase.upper()}* (forced)")
-                        verify_attempts = 0
-                    else:
-                        pending_transition = target
-                        send_message(chat_id, f"🔍 *Step {step}* — Verification requested before moving to {target}")
 
             if next_prompt is None:
                 codex_fail_streak += 1
@@ -4689,25 +5321,28 @@ _Session preserved. You can continue chatting with Claude in this session._""")
                 if codex_fail_streak >= 3:
                     print(f"{log_prefix} Step {step}: Codex failed 3x in a row. Stopping.", flush=True)
                     send_message(chat_id, "❌ *Codex failed 3 times in a row.* Stopping justdoit.\n_Session preserved for manual continuation._")
+                    notified_exit = True
                     break
                 next_prompt = "Continue implementing the next unfinished item from the plan."
             else:
                 codex_fail_streak = 0
 
             print(f"{log_prefix} Step {step}: Next prompt for Claude: {next_prompt[:200]}...", flush=True)
-            send_message(chat_id, f"📋 *Next:* _{next_prompt[:150]}{'...' if len(next_prompt) > 150 else ''}_")
+            # One message for "what's next" and the next step's header
+            status.push(f"📋 *Next:* _{next_prompt[:150]}{'...' if len(next_prompt) > 150 else ''}_\n\n🔄 *Step {step + 1}* — Sending to Claude...")
+            announced_step = step + 1
 
             current_prompt = next_prompt
 
-            # --- Phase 4: Pause before next iteration ---
-            time.sleep(2)
+            # --- Phase 4: Pause before next iteration (only when the step returned suspiciously fast) ---
+            if time.monotonic() - step_started < 0.5:
+                cancel_event.wait(2)
 
     except Exception as e:
-        import traceback
         print(f"{log_prefix} EXCEPTION: {e}", flush=True)
         print(f"{log_prefix} Traceback:\n{traceback.format_exc()}", flush=True)
         try:
-            send_message(chat_id, f"❌ *JustDoIt error:* {str(e)[:300]}")
+            send_message(chat_id, f"❌ *JustDoIt error:* {md_escape(str(e)[:300])}")
         except Exception:
             pass  # Don't let a send failure hide the real error
 
@@ -4716,7 +5351,7 @@ _Session preserved. You can continue chatting with Claude in this session._""")
         # Always notify the user that justdoit has stopped
         try:
             state = justdoit_active.get(chat_key, {})
-            if state.get("active", False):
+            if state.get("active", False) and not notified_exit:
                 # Loop exited without sending a completion/cancellation message
                 send_message(chat_id, f"⚠️ *JustDoIt stopped* at step {step} (phase: {phase}).\n_Session preserved._")
         except Exception:
@@ -4727,24 +5362,90 @@ _Session preserved. You can continue chatting with Claude in this session._""")
         _ws_session_override.name = None  # Clear thread-local override
 
 
-def run_codex_deepreview(claude_output, review_history, step, cwd, phase):
-    """Call Codex to review Claude's review output during deepreview.
+_CODEX_CAPTURE_MAX = 64 * 1024  # Max stdout chars kept from a deepreview Codex call
 
-    Returns: (next_prompt: str or None, is_clean: bool, reasoning: str)
-    - next_prompt: prompt to send to Claude for fixes, or None
-    - is_clean: True if Codex found no issues
-    - reasoning: explanation of Codex's decision (starts with "QUOTA:" if rate-limited)
+
+def _codex_exec_capture(prompt, cwd, timeout=600, clean_prefix=None, stop_token=None, cancel_event=None):
+    """Run `codex exec` for deepreview, streaming stdout instead of buffering via communicate().
+
+    Returns (stdout, stderr, timed_out). stdout is capped at _CODEX_CAPTURE_MAX chars (head kept,
+    since verdicts are read from the start). Reading stops early - and the process is killed - when
+    the first non-blank line starts with `clean_prefix`, or a line is exactly `stop_token` (the verdict
+    on its own line, not a mention of it in the report). Setting `cancel_event` kills the process.
     """
-    max_output_len = 8000
-    if len(claude_output) > max_output_len:
-        claude_output = claude_output[:max_output_len] + "\n\n... (output truncated)"
+    process = subprocess.Popen(
+        _codex_exec_cmd(prompt), cwd=cwd,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        start_new_session=True
+    )
+
+    stderr_lines = []
+    out = []
+    timed_out = threading.Event()
+    timer = None
+    stderr_thread = None
+    cancel_watch = None
+
+    def _drain_stderr():
+        try:
+            for line in process.stderr:
+                stderr_lines.append(line.rstrip("\n"))
+        except Exception:
+            pass
 
-    max_history_len = 6000
-    if len(review_history) > max_history_len:
-        review_history = review_history[-max_history_len:]
+    def _kill():
+        timed_out.set()
+        try:
+            kill_process_group(process)
+        except Exception:
+            process.kill()
 
-    if phase == "codex_reviews_claude":
-        codex_prompt = f"""You are a ruthless senior staff engineer doing a deep code review.
+    # Everything after Popen sits under try/finally so the process can never outlive this call
+    try:
+        stderr_thread = threading.Thread(target=_drain_stderr, daemon=True)
+        stderr_thread.start()
+        timer = threading.Timer(timeout, _kill)
+        timer.daemon = True
+        timer.start()
+        cancel_watch = _kill_on_cancel(process, cancel_event)
+
+        size = 0
+        seen_text = False
+        for line in process.stdout:
+            if size < _CODEX_CAPTURE_MAX:
+                out.append(line)
+                size += len(line)
+            if not seen_text and line.strip():
+                seen_text = True
+                if clean_prefix and line.strip().startswith(clean_prefix):
+                    break
+            if stop_token and line.strip().upper() == stop_token:
+                break
+    except Exception:
+        pass
+    finally:
+        if timer:
+            timer.cancel()
+        if cancel_watch:
+            cancel_watch.set()
+        if process.poll() is None:
+            try:
+                kill_process_group(process)
+            except Exception:
+                process.kill()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            pass
+        # stdout can hit EOF before the quota "ERROR:" line is read off stderr; callers key off that line
+        if stderr_thread:
+            stderr_thread.join(timeout=2)
+
+    return "".join(out)[:_CODEX_CAPTURE_MAX].strip(), "\n".join(stderr_lines).strip(), timed_out.is_set()
+
+
+# Deepreview Codex prompts, built once at import and filled per call with string.Template
+_DEEPREVIEW_CROSS_REVIEW_TMPL = string.Template("""You are a ruthless senior staff engineer doing a deep code review.
 
 You are reviewing Claude's detailed review output. Your job is to catch things Claude missed or got wrong:
 
@@ -4755,28 +5456,27 @@ You are reviewing Claude's detailed review output. Your job is to catch things C
 5. OVER-ENGINEERING: Unnecessary abstractions, premature optimization, gold-plating
 
 REVIEW HISTORY SO FAR:
-{review_history}
+$history
 
 CLAUDE'S LATEST REVIEW OUTPUT:
-{claude_output}
+$claude
 
 If you find ANY of the above issues, respond with a SPECIFIC prompt to give to Claude telling it exactly what to fix and why. Be direct and technical — name the exact function, file, pattern, or line that's wrong.
 
 If Claude's review and fixes are solid — no design flaws, no bandaids, no degrading fallbacks, no hacks — respond with exactly:
 CLEAN
 
-Do NOT be lenient. Do NOT say CLEAN if there are real issues. But also do NOT nitpick style or cosmetic issues — focus on correctness, design, and architecture."""
+Do NOT be lenient. Do NOT say CLEAN if there are real issues. But also do NOT nitpick style or cosmetic issues — focus on correctness, design, and architecture.""")
 
-    elif phase == "codex_final_signoff":
-        codex_prompt = f"""You are a ruthless senior staff engineer doing a FINAL review of a deep code review session.
+_DEEPREVIEW_SIGNOFF_TMPL = string.Template("""You are a ruthless senior staff engineer doing a FINAL review of a deep code review session.
 
 Throughout this session, Claude has been reviewing and fixing code. Now you must do a final comprehensive check.
 
 FULL REVIEW HISTORY:
-{review_history}
+$history
 
 CLAUDE'S LATEST OUTPUT:
-{claude_output}
+$claude
 
 Check for:
 1. Did Claude actually fix the issues it found, or just describe them?
@@ -4790,7 +5490,81 @@ If you find issues, respond with a SPECIFIC prompt to give to Claude to fix them
 If everything is solid and the code is clean, respond with exactly:
 CLEAN
 
-This is the final gate. Be thorough but fair."""
+This is the final gate. Be thorough but fair.""")
+
+_DEEPREVIEW_FIX_FOLLOWUP_TMPL = string.Template("""You are a ruthless senior staff engineer doing a deep code review AND fixing issues directly.
+
+Claude (another AI) reviewed your previous fixes and found problems. Here's Claude's critique:
+
+CLAUDE'S CRITIQUE:
+$feedback
+
+REVIEW HISTORY SO FAR:
+$history
+
+Your job:
+1. Read Claude's critique carefully
+2. Review the actual code files to verify Claude's claims
+3. If Claude is right, fix the issues directly in the files
+4. If Claude is wrong, explain why (but still check for other issues)
+5. Look for anything BOTH you and Claude may have missed
+
+After reviewing and fixing, report exactly what you found and changed.
+
+If the code is solid and you found nothing to fix, respond with exactly:
+ALL_CLEAN
+
+Focus on correctness, design, and architecture — not cosmetics.""")
+
+_DEEPREVIEW_FIX_TMPL = string.Template("""You are a ruthless senior staff engineer doing a deep code review AND fixing issues directly.
+
+Claude (another AI) has already done $step rounds of self-review and fixes. Your job is to find what Claude missed and FIX it yourself.
+
+IMPORTANT: Focus ONLY on the files and code areas mentioned in the review history below. Do NOT review the entire project — only the files that were worked on in this session.
+
+REVIEW HISTORY SO FAR:
+$history
+
+Your job:
+1. Read the actual code files mentioned in the review history
+2. Look for issues Claude missed or got wrong:
+   - BUGS: Logic errors, race conditions, null access, off-by-one
+   - DESIGN FLAWS: Poor abstractions, god functions, tight coupling
+   - BANDAIDS/HACKS: Quick fixes that don't address root causes
+   - SECURITY: Injection, XSS, auth bypasses, secret leaks
+   - OVER-ENGINEERING: Unnecessary abstractions, premature optimization
+3. FIX every issue you find directly in the code files
+4. Report what you found and fixed
+
+After reviewing and fixing, report exactly what you found and changed.
+
+If the code is solid and you found nothing to fix, respond with exactly:
+ALL_CLEAN
+
+Focus on correctness, design, and architecture — not cosmetics.""")
+
+
+def run_codex_deepreview(claude_output, review_history, step, cwd, phase, cancel_event=None):
+    """Call Codex to review Claude's review output during deepreview.
+
+    Returns: (next_prompt: str or None, is_clean: bool, reasoning: str)
+    - next_prompt: prompt to send to Claude for fixes, or None
+    - is_clean: True if Codex found no issues
+    - reasoning: explanation of Codex's decision (starts with "QUOTA:" if rate-limited)
+    """
+    max_output_len = 8000
+    if len(claude_output) > max_output_len:
+        claude_output = claude_output[:max_output_len] + "\n\n... (output truncated)"
+
+    max_history_len = 6000
+    if len(review_history) > max_history_len:
+        review_history = review_history[-max_history_len:]
+
+    if phase == "codex_reviews_claude":
+        codex_prompt = _DEEPREVIEW_CROSS_REVIEW_TMPL.substitute(history=review_history, claude=claude_output)
+
+    elif phase == "codex_final_signoff":
+        codex_prompt = _DEEPREVIEW_SIGNOFF_TMPL.substitute(history=review_history, claude=claude_output)
 
     else:
         return None, False, f"Unknown phase: {phase}"
@@ -4798,23 +5572,9 @@ This is the final gate. Be thorough but fair."""
     print(f"[DeepReview Codex] Step {step}, phase: {phase}, prompt length: {len(codex_prompt)}", flush=True)
 
     try:
-        process = subprocess.Popen(
-            [
-                "codex", "exec",
-                "-m", CODEX_MODEL,
-                "-c", 'model_reasoning_effort="xhigh"',
-                "--dangerously-bypass-approvals-and-sandbox",
-                codex_prompt
-            ],
-            cwd=cwd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-
-        stdout, stderr = process.communicate(timeout=600)
-        output = (stdout or "").strip()
-        error_output = (stderr or "").strip()
+        output, error_output, timed_out = _codex_exec_capture(codex_prompt, cwd, timeout=600, clean_prefix="CLEAN", cancel_event=cancel_event)
+        if timed_out:
+            return None, False, "Codex timed out"
 
         print(f"[DeepReview Codex] Raw output ({len(output)} chars): {output[:300]}...", flush=True)
         if error_output:
@@ -4835,21 +5595,11 @@ This is the final gate. Be thorough but fair."""
             return None, True, "No issues found"
 
         if output.startswith("QUOTA:"):
-            first_line, _, rest = output.partition("\n")
-            wait_str = first_line[6:].strip()
-            details = rest.strip() or "no details"
-            try:
-                wait_min = max(1, int(wait_str))
-            except (ValueError, TypeError):
-                wait_min = 60
-            return None, False, f"QUOTA:{wait_min} {details[:200]}"
+            return None, False, _quota_reasoning(output)
 
         # Codex found issues — output is the prompt for Claude
         return output, False, "Issues found"
 
-    except subprocess.TimeoutExpired:
-        process.kill()
-        return None, False, "Codex timed out"
     except FileNotFoundError:
         return None, False, "Codex not found"
     except Exception as e:
@@ -4859,7 +5609,7 @@ This is the final gate. Be thorough but fair."""
         return None, False, f"Codex error: {e}"
 
 
-def run_codex_deepreview_fix(review_history, step, cwd, is_followup=False, claude_feedback=None):
+def run_codex_deepreview_fix(review_history, step, cwd, is_followup=False, claude_feedback=None, cancel_event=None):
     """Call Codex to review AND fix code directly (Phase 3).
 
     Codex runs with --full-auto so it can edit files.
@@ -4873,77 +5623,16 @@ def run_codex_deepreview_fix(review_history, step, cwd, is_followup=False, claud
         review_history = review_history[-max_history_len:]
 
     if is_followup and claude_feedback:
-        codex_prompt = f"""You are a ruthless senior staff engineer doing a deep code review AND fixing issues directly.
-
-Claude (another AI) reviewed your previous fixes and found problems. Here's Claude's critique:
-
-CLAUDE'S CRITIQUE:
-{claude_feedback[:4000]}
-
-REVIEW HISTORY SO FAR:
-{review_history}
-
-Your job:
-1. Read Claude's critique carefully
-2. Review the actual code files to verify Claude's claims
-3. If Claude is right, fix the issues directly in the files
-4. If Claude is wrong, explain why (but still check for other issues)
-5. Look for anything BOTH you and Claude may have missed
-
-After reviewing and fixing, report exactly what you found and changed.
-
-If the code is solid and you found nothing to fix, respond with exactly:
-ALL_CLEAN
-
-Focus on correctness, design, and architecture — not cosmetics."""
+        codex_prompt = _DEEPREVIEW_FIX_FOLLOWUP_TMPL.substitute(feedback=claude_feedback[:4000], history=review_history)
     else:
-        codex_prompt = f"""You are a ruthless senior staff engineer doing a deep code review AND fixing issues directly.
-
-Claude (another AI) has already done {step} rounds of self-review and fixes. Your job is to find what Claude missed and FIX it yourself.
-
-IMPORTANT: Focus ONLY on the files and code areas mentioned in the review history below. Do NOT review the entire project — only the files that were worked on in this session.
-
-REVIEW HISTORY SO FAR:
-{review_history}
-
-Your job:
-1. Read the actual code files mentioned in the review history
-2. Look for issues Claude missed or got wrong:
-   - BUGS: Logic errors, race conditions, null access, off-by-one
-   - DESIGN FLAWS: Poor abstractions, god functions, tight coupling
-   - BANDAIDS/HACKS: Quick fixes that don't address root causes
-   - SECURITY: Injection, XSS, auth bypasses, secret leaks
-   - OVER-ENGINEERING: Unnecessary abstractions, premature optimization
-3. FIX every issue you find directly in the code files
-4. Report what you found and fixed
-
-After reviewing and fixing, report exactly what you found and changed.
-
-If the code is solid and you found nothing to fix, respond with exactly:
-ALL_CLEAN
-
-Focus on correctness, design, and architecture — not cosmetics."""
+        codex_prompt = _DEEPREVIEW_FIX_TMPL.substitute(step=step, history=review_history)
 
     print(f"[DeepReview Codex Fix] Step {step}, is_followup: {is_followup}, prompt length: {len(codex_prompt)}", flush=True)
 
     try:
-        process = subprocess.Popen(
-            [
-                "codex", "exec",
-                "-m", CODEX_MODEL,
-                "-c", 'model_reasoning_effort="xhigh"',
-                "--dangerously-bypass-approvals-and-sandbox",
-                codex_prompt
-            ],
-            cwd=cwd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-
-        stdout, stderr = process.communicate(timeout=600)
-        output = (stdout or "").strip()
-        error_output = (stderr or "").strip()
+        output, error_output, timed_out = _codex_exec_capture(codex_prompt, cwd, timeout=600, stop_token="ALL_CLEAN", cancel_event=cancel_event)
+        if timed_out:
+            return None, False, "Codex timed out"
 
         print(f"[DeepReview Codex Fix] Raw output ({len(output)} chars): {output[:300]}...", flush=True)
         if error_output:
@@ -4964,21 +5653,11 @@ Focus on correctness, design, and architecture — not cosmetics."""
             return output, True, "No issues found"
 
         if output.startswith("QUOTA:"):
-            first_line, _, rest = output.partition("\n")
-            wait_str = first_line[6:].strip()
-            details = rest.strip() or "no details"
-            try:
-                wait_min = max(1, int(wait_str))
-            except (ValueError, TypeError):
-                wait_min = 60
-            return None, False, f"QUOTA:{wait_min} {details[:200]}"
+            return None, False, _quota_reasoning(output)
 
         # Codex found and fixed issues — output is its report
         return output, False, "Issues found and fixed"
 
-    except subprocess.TimeoutExpired:
-        process.kill()
-        return None, False, "Codex timed out"
     except FileNotFoundError:
         return None, False, "Codex not found"
     except Exception as e:
@@ -4988,18 +5667,160 @@ Focus on correctness, design, and architecture — not cosmetics."""
         return None, False, f"Codex error: {e}"
 
 
+class ReviewLog:
+    """Deepreview history kept as (title, text) sections instead of an ever-growing string.
+
+    The rendered text, tails and "latest section with this title" lookups are memoized and
+    only recomputed after an append, so re-reading the same history every iteration is cheap.
+    """
+
+    def __init__(self, maxlen=None, max_chars=200000):
+        self._sections = deque()
+        self._maxlen = maxlen  # Oldest sections drop off beyond this many...
+        self._max_chars = max_chars  # ...or once their combined text passes this size
+        self._chars = 0
+        self._cache = {}
+
+    def __bool__(self):
+        return bool(self._sections)
+
+    def append(self, title, text):
+        self._sections.append((title, text))
+        self._chars += len(title) + len(text)
+        while len(self._sections) > 1 and (
+            (self._maxlen is not None and len(self._sections) > self._maxlen)
+            or (self._max_chars is not None and self._chars > self._max_chars)
+        ):
+            old_title, old_text = self._sections.popleft()
+            self._chars -= len(old_title) + len(old_text)
+        self._cache.clear()
+
+    def text(self):
+        if "text" not in self._cache:
+            self._cache["text"] = "".join(f"\n\n=== {t} ===\n{x}" for t, x in self._sections)
+        return self._cache["text"]
+
+    def tail(self, n):
+        """Last `n` chars of the rendered history, rendering only the newest sections needed."""
+        key = ("tail", n)
+        if key not in self._cache:
+            parts = []
+            size = 0
+            for t, x in reversed(self._sections):
+                if size >= n:
+                    break
+                part = f"\n\n=== {t} ===\n{x}"
+                parts.append(part)
+                size += len(part)
+            self._cache[key] = "".join(reversed(parts))[-n:]
+        return self._cache[key]
+
+    def last(self, prefix):
+        """Text of the newest section whose title starts with `prefix`, or None."""
+        key = ("last", prefix)
+        if key not in self._cache:
+            self._cache[key] = next((x for t, x in reversed(self._sections) if t.startswith(prefix)), None)
+        return self._cache[key]
+
+
+_SUMMARY_SECTIONS = ("FILES_CHANGED", "OPEN_ISSUES", "FIXED_ISSUES", "DECISIONS", "NEXT_STEPS")
+_SUMMARY_MERGE_WAIT = 150  # Seconds render() waits on a merge; run_claude_oneshot gives up after 120
+_SUMMARY_HEADER_RE = re.compile(r"^(" + "|".join(_SUMMARY_SECTIONS) + r"):[ \t]*$", re.MULTILINE)
+
+
+class ReviewSummary:
+    """Running deepreview summary with fixed sections, merged turn by turn instead of truncated.
+
+    New turns wait in a raw buffer; once it passes `merge_tokens` (~4 chars/token) only that new
+    span is folded into the existing sections with a one-shot Claude call. The merge runs on
+    _bg_pool so the loop carries on meanwhile; render() waits for one still in flight. The last
+    `keep_turns` turns are also kept verbatim for quoting.
+    """
+
+    def __init__(self, keep_turns=2, merge_tokens=1500, cancel_event=None):
+        self._cancel_event = cancel_event  # The loop's /cancel event, so a merge dies with the loop
+        self.sections = dict.fromkeys(_SUMMARY_SECTIONS, "")
+        self._pending = []  # (title, text) turns not yet merged
+        self._recent = deque(maxlen=keep_turns)
+        self._merge_tokens = merge_tokens
+        self._lock = threading.Lock()  # guards sections/_pending between the loop thread and a background merge
+        self._merge_future = None
+
+    def __bool__(self):
+        return bool(self._recent)
+
+    def add(self, title, text):
+        with self._lock:
+            self._pending.append((title, text))
+            self._recent.append((title, text))
+            due = sum(len(x) for _, x in self._pending) // 4 > self._merge_tokens
+        if due and (self._merge_future is None or self._merge_future.done()):
+            self._merge_future = _bg_pool.submit(self.merge)
+
+    def _sections_text(self):
+        return "\n\n".join(f"{name}:\n{body}" for name, body in self.sections.items() if body)
+
+    def merge(self):
+        """Fold the pending turns into the sections. On failure they stay pending and are retried next time."""
+        with self._lock:
+            batch = list(self._pending)
+            current = self._sections_text()
+        if not batch:
+            return
+        new_span = "".join(f"\n\n=== {t} ===\n{x}" for t, x in batch)
+        reply = run_claude_oneshot(
+            "Update this running code-review summary with the new review turns. Keep every item that "
+            "still matters, move issues to FIXED_ISSUES once a turn fixes them, and keep file:line references. "
+            "Reply with exactly these headed sections, each a short bullet list (\"- none\" if empty):\n"
+            + "\n".join(f"{name}:" for name in _SUMMARY_SECTIONS)
+            + f"\n\nCURRENT SUMMARY:\n{current or '(empty)'}\n\nNEW TURNS:{new_span}",
+            cancel_event=self._cancel_event
+        )
+        parts = _SUMMARY_HEADER_RE.split(reply or "")
+        if len(parts) < 3:
+            print(f"[DeepReview] Summary merge failed, keeping {len(batch)} raw turn(s)", flush=True)
+            return
+        with self._lock:
+            for name, body in zip(parts[1::2], parts[2::2]):
+                self.sections[name] = body.strip()[:1500]
+            del self._pending[:len(batch)]  # turns added during the merge stay pending
+
+    def render(self, n):
+        """Summary sections plus the newest turns verbatim, within `n` chars.
+
+        Waits a bounded time for an in-flight merge; if it is still running, the turns it hasn't
+        folded in yet are rendered raw instead.
+        """
+        if self._merge_future is not None:
+            try:
+                self._merge_future.result(timeout=_SUMMARY_MERGE_WAIT)
+            except FuturesTimeoutError:
+                print("[DeepReview] Summary merge still running, rendering raw turns", flush=True)
+            except Exception as e:
+                print(f"[DeepReview] Summary merge error: {e}", flush=True)
+        with self._lock:
+            summary = self._sections_text()[:n // 2]
+            # Unmerged turns must all be shown; otherwise quote the last few for context
+            turns = self._pending if len(self._pending) >= len(self._recent) else self._recent
+            raw = "".join(f"\n\n=== {t} ===\n{x}" for t, x in turns)
+        if not summary:
+            return raw[-n:]
+        return f"{summary}\n\n---RECENT---{raw[-(n - len(summary) - 20):]}"
+
+
 def _deepreview_wait(chat_key, seconds):
-    """Sleep for `seconds` while checking deepreview cancellation every 30s."""
-    elapsed = 0
-    interval = 30
-    while elapsed < seconds:
-        state = deepreview_active.get(chat_key, {})
-        if not state.get("active", False):
-            return False
-        chunk = min(interval, seconds - elapsed)
-        time.sleep(chunk)
-        elapsed += chunk
-    return deepreview_active.get(chat_key, {}).get("active", False)
+    """Wait up to `seconds`, returning early as soon as /cancel sets the loop's cancel_event."""
+    state = deepreview_active.get(chat_key, {})
+    if not state.get("active", False):
+        return False
+    state["cancel_event"].wait(seconds)
+    return state.get("active", False)
+
+
+def backoff_sleep(chat_key, streak, wait_fn=_deepreview_wait):
+    """Sleep before retry number `streak` with jittered exponential backoff. Returns False if cancelled meanwhile."""
+    delay = min(BACKOFF_BASE * 2 ** streak + random.uniform(0, 1), BACKOFF_CAP)
+    return wait_fn(chat_key, delay)
 
 
 def run_deepreview_loop(chat_id, session):
@@ -5012,25 +5833,76 @@ def run_deepreview_loop(chat_id, session):
 
     print(f"{log_prefix} Starting deep review", flush=True)
 
-    deepreview_active[chat_key] = {
-        "active": True,
-        "paused": False,
-        "resume_event": threading.Event(),
-        "phase": "claude_self_review",
-        "step": 0,
-        "chat_id": str(chat_id),
-        "session_name": session.get("name", "unknown"),
-        "task": "Deep code review",
-        "started": time.time(),
-    }
-    deepreview_active[chat_key]["resume_event"].set()  # Not paused initially
-    _ws_broadcast_status(chat_id, "deepreview", "starting", 0, active=True, task="Deep code review", started=deepreview_active[chat_key]["started"])
+    # Local handle on the loop state — /cancel and the API mutate this same dict in place
+    state = deepreview_active[chat_key] = _new_loop_state(chat_id, session.get("name", "unknown"), "Deep code review", "claude_self_review")
+    _ws_broadcast_status(chat_id, "deepreview", "starting", 0, active=True, task="Deep code review", started=state["started"])
+    status = StatusThrottler(chat_id, state=state)  # Coalesces short step/phase status lines into one message
 
     step = 0
-    review_history = ""
-    all_review_history = ""  # Accumulates everything across all phases
+    review_history = ReviewLog()  # Phase 1↔2 exchange, fed to Codex cross-review
+    all_review_history = ReviewLog(maxlen=20)  # Rolling window of every phase's output
+    review_summary = ReviewSummary(cancel_event=state["cancel_event"])  # Anchored summary of every phase, for the Codex prompts and Claude's Phase 4 critique
     codex_fail_streak = 0
     notified_exit = False
+    phase = "claude_self_review"
+
+    def _record(title, text):
+        """Log a phase's output to both the rolling history and the anchored summary."""
+        all_review_history.append(title, text)
+        review_summary.add(title, text)
+
+    def _compact_session(prompt):
+        """Restart the Claude session with the cheapest summary that covers it; returns the prompt to send.
+
+        Soft stage: reuse the anchored review summary (no extra Claude call, nothing persisted).
+        Hard stage: only when that's empty, ask Claude to summarize the whole session.
+        """
+        status.push("📦 *Auto-compacting* session context...")
+        summary = review_summary.render(3000) if review_summary else ""
+        if len(summary) <= 50:
+            try:
+                summary_response, _, _, _, _ = run_claude_streaming(
+                    "Summarize this session for context continuity (max 500 words). Focus on files changed, issues found and fixed, and current state.",
+                    chat_id, cwd=cwd, continue_session=True,
+                    session_id=session_id, session=session
+                )
+                summary = summary_response.split("———")[0].strip() if summary_response else ""
+            except Exception:
+                summary = ""
+            if len(summary) > 50:
+                save_session_summary(chat_id, session, summary)
+        update_claude_session_id(chat_id, session, None)
+        reset_message_count(chat_id, session, "Claude")
+        status.push("🔄 Context preserved. Continuing...")
+        if len(summary) > 50:
+            return f"[Session compacted - Previous context summary:]\n{summary}\n\n[Continuing task:]\n{prompt}"
+        return prompt
+
+    def _push_in_background(text):
+        """status.push on a side thread, so a Codex call can start without waiting on Telegram.
+
+        The side thread carries this loop's WS session label; without it send_message would fall
+        back to the chat's active session. Join the returned thread before the next push.
+        """
+        session_name = getattr(_ws_session_override, 'name', None)
+
+        def _push():
+            _ws_session_override.name = session_name
+            status.push(text)
+
+        pusher = threading.Thread(target=_push, daemon=True)
+        pusher.start()
+        return pusher
+
+    def _bail_if_cancelled():
+        """Pause-aware cancellation check that sends the cancel notice once. True = stop the loop."""
+        nonlocal notified_exit
+        if _check_pause(deepreview_active, chat_key, chat_id, "deepreview", phase, step):
+            return False
+        if not notified_exit:
+            send_message(chat_id, f"⚠️ *Deep review cancelled* at step {step}.")
+            notified_exit = True
+        return True
 
     try:
         send_message(chat_id, """🔬 *Deep Review Mode Activated*
@@ -5048,26 +5920,25 @@ _Use /cancel to stop at any time._""")
         max_iterations_12 = 20
         iteration_12 = 0
         codex_satisfied = False
+        left_early = False  # Moved on to Phase 3 before Codex was satisfied (Codex failing / Claude stalled)
+        last_response_hash = None  # Fingerprint of Claude's previous Phase 1 reply
 
         while iteration_12 < max_iterations_12 and not codex_satisfied:
             iteration_12 += 1
 
             # Check cancellation/pause
-            if not _check_pause(deepreview_active, chat_key, chat_id, "deepreview", phase, step):
-                if not notified_exit:
-                    send_message(chat_id, f"⚠️ *Deep review cancelled* at step {step}.")
-                    notified_exit = True
+            if _bail_if_cancelled():
                 break
 
             # --- PHASE 1: Claude reviews and fixes (single pass) ---
             phase = "claude_self_review"
-            deepreview_active[chat_key]["phase"] = phase
+            state["phase"] = phase
             step += 1
-            deepreview_active[chat_key]["step"] = step
+            state["step"] = step
             _ws_broadcast_status(chat_id, "deepreview", phase, step)
 
             if iteration_12 == 1:
-                send_message(chat_id, f"🔍 *Step {step}* — Phase 1: Claude reviewing & fixing...")
+                status.push(f"🔍 *Step {step}* — Phase 1: Claude reviewing & fixing...")
 
                 # Build session-scoped prompt
                 session_context = ""
@@ -5093,34 +5964,21 @@ For each issue found:
 After fixing everything you find, report what you fixed and what looks clean."""
             else:
                 # Codex sent us back with feedback
-                codex_feedback = review_history.split("=== Codex cross-review")[-1][:3000] if "=== Codex cross-review" in review_history else review_history[-2000:]
-                send_message(chat_id, f"🔍 *Step {step}* — Phase 1 (iteration {iteration_12}): Claude fixing Codex's findings...")
+                codex_feedback = (review_history.last("Codex cross-review") or review_history.tail(2000))[:3000]
+                status.push(f"🔍 *Step {step}* — Phase 1 (iteration {iteration_12}): Claude fixing Codex's findings...")
                 prompt = f"""A senior engineer (Codex) reviewed your code and found these issues. Fix them ALL:
 
 {codex_feedback}
 
 After fixing, do another pass to make sure you didn't introduce regressions. Report exactly what you changed. If you disagree with any feedback, explain why."""
 
-            # Handle compaction
-            needs_compaction = increment_message_count(chat_id, session, "Claude")
-            if needs_compaction:
-                send_message(chat_id, "📦 *Auto-compacting* session context...")
-                try:
-                    summary_response, _, _, _, _ = run_claude_streaming(
-                        "Summarize this session for context continuity (max 500 words). Focus on files changed, issues found and fixed, and current state.",
-                        chat_id, cwd=cwd, continue_session=True,
-                        session_id=session_id, session=session
-                    )
-                    summary = summary_response.split("———")[0].strip() if summary_response else ""
-                except Exception:
-                    summary = ""
-                if summary and len(summary) > 50:
-                    save_session_summary(chat_id, session, summary)
-                update_claude_session_id(chat_id, session, None)
-                reset_message_count(chat_id, session, "Claude")
-                if summary and len(summary) > 50:
-                    prompt = f"[Session compacted - Previous context summary:]\n{summary}\n\n[Continuing task:]\n{prompt}"
-                send_message(chat_id, "🔄 Context preserved. Continuing...")
+            if not _quota_gate("claude", chat_id, chat_key, _deepreview_wait, "Deep review"):
+                notified_exit = True
+                break
+
+            # Handle compaction (skipped while the review history is still short)
+            if increment_message_count(chat_id, session, "Claude") and estimate_tokens(all_review_history.text()) > CTX_BUDGET_SOFT:
+                prompt = _compact_session(prompt)
 
             response, questions, _, claude_sid, context_overflow = run_claude_streaming(
                 prompt, chat_id, cwd=cwd, continue_session=True,
@@ -5129,11 +5987,10 @@ After fixing, do another pass to make sure you didn't introduce regressions. Rep
             _ws_broadcast_status(chat_id, "deepreview", phase, step)  # Re-assert after Claude exits
 
             if claude_sid:
-                update_claude_session_id(chat_id, session, claude_sid)
-                session = get_session_by_id(chat_id, session_id) or session
+                session = update_claude_session_id(chat_id, session, claude_sid) or session
 
             if context_overflow:
-                send_message(chat_id, "⚠️ Context overflow — compacting...")
+                status.push("⚠️ Context overflow — compacting...")
                 update_claude_session_id(chat_id, session, None)
                 reset_message_count(chat_id, session, "Claude")
                 response, questions, _, claude_sid, _ = run_claude_streaming(
@@ -5142,45 +5999,55 @@ After fixing, do another pass to make sure you didn't introduce regressions. Rep
                 )
                 _ws_broadcast_status(chat_id, "deepreview", phase, step)
                 if claude_sid:
-                    update_claude_session_id(chat_id, session, claude_sid)
-                    session = get_session_by_id(chat_id, session_id) or session
+                    session = update_claude_session_id(chat_id, session, claude_sid) or session
 
             if questions:
                 auto_answer = handle_justdoit_questions(questions)
-                send_message(chat_id, f"🤖 *Auto-answering:* _{auto_answer[:100]}_")
+                send_message_nowait(chat_id, f"🤖 *Auto-answering:* _{auto_answer[:100]}_")
                 response2, _, _, claude_sid2, _ = run_claude_streaming(
                     auto_answer, chat_id, cwd=cwd, continue_session=True,
                     session_id=session_id, session=session
                 )
                 if claude_sid2:
-                    update_claude_session_id(chat_id, session, claude_sid2)
-                    session = get_session_by_id(chat_id, session_id) or session
+                    session = update_claude_session_id(chat_id, session, claude_sid2) or session
                 if response2:
                     response = (response or "") + "\n\n[After auto-answer:]\n" + response2
 
             clean_response = response.split("———")[0].strip() if response else "No output"
-            review_history += f"\n\nClaude review+fix (iteration {iteration_12}):\n{clean_response[:2000]}"
-            all_review_history += f"\n\n=== Claude review+fix (iteration {iteration_12}) ===\n{clean_response[:2000]}"
+            # Same reply as last round means Claude has nothing new; Codex would just repeat itself
+            response_hash = hashlib.blake2b(clean_response.encode("utf-8", "ignore"), digest_size=8).digest()
+            if response_hash == last_response_hash:
+                print(f"{log_prefix} Step {step}: Claude's reply unchanged, skipping Codex cross-review", flush=True)
+                send_message_nowait(chat_id, "🟰 Claude's reply is unchanged from the last round. Moving to Codex's turn.")
+                left_early = True
+                break
+            last_response_hash = response_hash
+            review_history.append(f"Claude review+fix (iteration {iteration_12})", clean_response[:2000])
+            _record(f"Claude review+fix (iteration {iteration_12})", clean_response[:2000])
 
             print(f"{log_prefix} Step {step}: Claude review+fix iteration {iteration_12}, response length: {len(clean_response)}", flush=True)
 
-            time.sleep(2)
+            flush_pending_outbox(chat_id, timeout=2)  # Next phase starts once this one's notices are out
 
             # Check cancellation/pause before phase 2
-            if not _check_pause(deepreview_active, chat_key, chat_id, "deepreview", phase, step):
-                if not notified_exit:
-                    send_message(chat_id, f"⚠️ *Deep review cancelled* at step {step}.")
-                    notified_exit = True
+            if _bail_if_cancelled():
                 break
 
             # --- PHASE 2: Codex cross-reviews Claude's work ---
             phase = "codex_reviews_claude"
-            deepreview_active[chat_key]["phase"] = phase
+            state["phase"] = phase
             step += 1
-            deepreview_active[chat_key]["step"] = step
+            state["step"] = step
             _ws_broadcast_status(chat_id, "deepreview", phase, step)
 
-            send_message(chat_id, f"🧠 *Step {step}* — Phase 2 (iteration {iteration_12}): Codex cross-reviewing...")
+            if not _quota_gate("codex", chat_id, chat_key, _deepreview_wait, "Deep review"):
+                notified_exit = True
+                break
+
+            # Send the status from a side thread so Codex starts without waiting on Telegram;
+            # Codex itself stays on this thread rather than tying up a shared pool worker for minutes
+            codex_history = review_summary.render(6000)  # Older turns survive as summary sections instead of being cut off
+            pusher = _push_in_background(f"🧠 *Step {step}* — Phase 2 (iteration {iteration_12}): Codex cross-reviewing...")
 
             # Retry loop for Codex (handles timeouts/errors without re-running Claude)
             codex_retry = 0
@@ -5188,29 +6055,24 @@ After fixing, do another pass to make sure you didn't introduce regressions. Rep
             is_clean = False
             reasoning = ""
             codex_abort = False
-            while codex_retry < 3:
+            while codex_retry < CODEX_MAX_RETRIES:
                 next_prompt, is_clean, reasoning = run_codex_deepreview(
-                    clean_response, review_history, step, cwd, phase="codex_reviews_claude"
+                    clean_response, codex_history, step, cwd, "codex_reviews_claude", cancel_event=state["cancel_event"]
                 )
+                pusher.join()  # StatusThrottler isn't thread-safe; the push must land before the next one
+                if state["cancel_event"].is_set():
+                    _bail_if_cancelled()
+                    codex_abort = True
+                    break
                 print(f"{log_prefix} Step {step}: Codex cross-review iteration {iteration_12} (try {codex_retry + 1}) — clean: {is_clean}, reasoning: {reasoning[:200]}", flush=True)
 
                 # Handle quota
                 if reasoning and reasoning.startswith("QUOTA:"):
-                    parts = reasoning[6:].strip().split(" ", 1)
-                    try:
-                        wait_min = max(1, int(parts[0]))
-                    except (ValueError, IndexError):
-                        wait_min = 60
-                    details = parts[1] if len(parts) > 1 else ""
-                    wait_secs = wait_min * 60
-                    resume_time = (datetime.now() + timedelta(seconds=wait_secs)).strftime('%H:%M')
-                    send_message(chat_id, f"⏳ *Rate limited.* _{details[:200]}_\n_Waiting ~{wait_min}min... (resume ~{resume_time})_")
-                    if not _deepreview_wait(chat_key, wait_secs):
-                        send_message(chat_id, f"⚠️ *Deep review cancelled* during wait.")
+                    if not _handle_quota_wait(reasoning, chat_id, chat_key, _deepreview_wait, "Deep review"):
                         notified_exit = True
                         codex_abort = True
                         break
-                    send_message(chat_id, "🔄 *Resuming...*")
+                    status.push("🔄 *Resuming...*")
                     continue  # Retry Codex directly after quota wait
 
                 if is_clean or next_prompt is not None:
@@ -5218,36 +6080,36 @@ After fixing, do another pass to make sure you didn't introduce regressions. Rep
 
                 # Codex failed (timeout, error, no output)
                 codex_retry += 1
-                send_message(chat_id, f"⚠️ Codex failed ({reasoning[:100]}). Retry {codex_retry}/3...")
-                time.sleep(5)
+                send_message_nowait(chat_id, f"⚠️ Codex failed ({md_escape(reasoning[:100])}). Retry {codex_retry}/{CODEX_MAX_RETRIES}...")
+                if not backoff_sleep(chat_key, codex_retry) and _bail_if_cancelled():
+                    codex_abort = True
+                    break
 
             if codex_abort:
                 break
 
             if is_clean:
-                send_message(chat_id, f"✅ Codex is satisfied with Claude's work after {iteration_12} iterations.")
+                send_message_nowait(chat_id, f"✅ Codex is satisfied with Claude's work after {iteration_12} iterations.")
                 codex_satisfied = True
                 break
 
             if next_prompt is None:
-                send_message(chat_id, "⚠️ Codex failed 3 times. Moving to Codex's turn.")
+                send_message_nowait(chat_id, f"⚠️ Codex failed {CODEX_MAX_RETRIES} times. Moving to Codex's turn.")
+                left_early = True
                 break
 
-            all_review_history += f"\n\n=== Codex cross-review (iteration {iteration_12}) ===\n{next_prompt[:3000]}"
-            review_history += f"\n\n=== Codex cross-review (iteration {iteration_12}) ===\n{next_prompt[:3000]}"
+            _record(f"Codex cross-review (iteration {iteration_12})", next_prompt[:3000])
+            review_history.append(f"Codex cross-review (iteration {iteration_12})", next_prompt[:3000])
 
-            send_message(chat_id, f"📋 *Codex feedback for Claude:*\n\n{next_prompt[:3500]}")
-            send_message(chat_id, "🔄 Sending Claude back to fix...")
+            send_message_nowait(chat_id, f"📋 *Codex feedback for Claude:*\n\n{next_prompt[:3500]}\n\n🔄 _Sending Claude back to fix..._")
 
-            time.sleep(2)
+            flush_pending_outbox(chat_id, timeout=2)  # Next phase starts once this one's notices are out
 
-        if not codex_satisfied and not notified_exit:
-            send_message(chat_id, f"⚠️ Hit max Phase 1↔2 iterations ({max_iterations_12}). Moving to Codex's turn.")
+        if not codex_satisfied and not left_early and not notified_exit:
+            send_message_nowait(chat_id, f"⚠️ Hit max Phase 1↔2 iterations ({max_iterations_12}). Moving to Codex's turn.")
 
         # Check cancellation before mega-loop 2
-        if not deepreview_active.get(chat_key, {}).get("active", False):
-            if not notified_exit:
-                send_message(chat_id, f"⚠️ *Deep review cancelled* at step {step}.")
+        if _bail_if_cancelled():
             return
 
         # ============================================================
@@ -5264,97 +6126,91 @@ After fixing, do another pass to make sure you didn't introduce regressions. Rep
             iteration_34 += 1
 
             # Check cancellation/pause
-            if not _check_pause(deepreview_active, chat_key, chat_id, "deepreview", phase, step):
-                if not notified_exit:
-                    send_message(chat_id, f"⚠️ *Deep review cancelled* at step {step}.")
-                    notified_exit = True
+            if _bail_if_cancelled():
                 break
 
             # --- PHASE 3: Codex reviews and fixes (single pass) ---
             phase = "codex_self_review"
-            deepreview_active[chat_key]["phase"] = phase
+            state["phase"] = phase
             step += 1
-            deepreview_active[chat_key]["step"] = step
+            state["step"] = step
             _ws_broadcast_status(chat_id, "deepreview", phase, step)
 
             # On iteration > 1, pass Claude's feedback from Phase 4
             is_followup = iteration_34 > 1
             claude_feedback_for_codex = None
-            if is_followup and "=== Claude cross-review of Codex" in all_review_history:
-                claude_feedback_for_codex = all_review_history.split("=== Claude cross-review of Codex")[-1][:3000]
+            if is_followup:
+                claude_feedback_for_codex = all_review_history.last("Claude cross-review of Codex")
+
+            if not _quota_gate("codex", chat_id, chat_key, _deepreview_wait, "Deep review"):
+                notified_exit = True
+                break
 
             if iteration_34 == 1:
-                send_message(chat_id, f"🔨 *Step {step}* — Phase 3: Codex reviewing & fixing...")
+                status_text = f"🔨 *Step {step}* — Phase 3: Codex reviewing & fixing..."
             else:
-                send_message(chat_id, f"🔨 *Step {step}* — Phase 3 (iteration {iteration_34}): Codex fixing Claude's findings...")
-
+                status_text = f"🔨 *Step {step}* — Phase 3 (iteration {iteration_34}): Codex fixing Claude's findings..."
+            pusher = _push_in_background(status_text)
             codex_output, is_clean, reasoning = run_codex_deepreview_fix(
-                all_review_history, step, cwd,
+                review_summary.render(6000), step, cwd,
                 is_followup=is_followup,
-                claude_feedback=claude_feedback_for_codex
+                claude_feedback=claude_feedback_for_codex,
+                cancel_event=state["cancel_event"]
             )
+            pusher.join()
+            if state["cancel_event"].is_set():
+                _bail_if_cancelled()
+                break
 
             print(f"{log_prefix} Step {step}: Codex review+fix iteration {iteration_34} — clean: {is_clean}, reasoning: {reasoning[:200]}", flush=True)
 
             # Handle quota
             if reasoning and reasoning.startswith("QUOTA:"):
-                parts = reasoning[6:].strip().split(" ", 1)
-                try:
-                    wait_min = max(1, int(parts[0]))
-                except (ValueError, IndexError):
-                    wait_min = 60
-                details = parts[1] if len(parts) > 1 else ""
-                wait_secs = wait_min * 60
-                resume_time = (datetime.now() + timedelta(seconds=wait_secs)).strftime('%H:%M')
-                send_message(chat_id, f"⏳ *Rate limited.* _{details[:200]}_\n_Waiting ~{wait_min}min... (resume ~{resume_time})_")
-                if not _deepreview_wait(chat_key, wait_secs):
-                    send_message(chat_id, f"⚠️ *Deep review cancelled* during wait.")
+                if not _handle_quota_wait(reasoning, chat_id, chat_key, _deepreview_wait, "Deep review"):
                     notified_exit = True
                     break
-                send_message(chat_id, "🔄 *Resuming...*")
+                status.push("🔄 *Resuming...*")
                 iteration_34 -= 1  # Retry
                 continue
 
             if is_clean:
-                send_message(chat_id, f"✅ Codex found no issues (iteration {iteration_34}).")
+                send_message_nowait(chat_id, f"✅ Codex found no issues (iteration {iteration_34}).")
 
             if codex_output is None:
                 codex_fail_streak += 1
-                send_message(chat_id, f"⚠️ Codex failed ({reasoning[:100]}). Retry {codex_fail_streak}/3...")
-                if codex_fail_streak >= 3:
-                    send_message(chat_id, "⚠️ Codex failed 3 times. Moving to Claude cross-review.")
+                send_message_nowait(chat_id, f"⚠️ Codex failed ({md_escape(reasoning[:100])}). Retry {codex_fail_streak}/{CODEX_MAX_RETRIES}...")
+                if codex_fail_streak >= CODEX_MAX_RETRIES:
+                    send_message_nowait(chat_id, f"⚠️ Codex failed {CODEX_MAX_RETRIES} times. Moving to Claude cross-review.")
+                elif not backoff_sleep(chat_key, codex_fail_streak) and _bail_if_cancelled():
+                    break
                 else:
-                    time.sleep(5)
                     iteration_34 -= 1  # Retry Phase 3 directly
                     continue
             else:
                 codex_fail_streak = 0
                 if not is_clean:
-                    all_review_history += f"\n\n=== Codex review+fix (iteration {iteration_34}) ===\n{codex_output[:2000]}"
-                    send_message(chat_id, f"🔨 *Codex review & fixes:*\n\n{codex_output[:3500]}")
+                    _record(f"Codex review+fix (iteration {iteration_34})", codex_output[:2000])
+                    send_message_nowait(chat_id, f"🔨 *Codex review & fixes:*\n\n{codex_output[:3500]}")
 
-            time.sleep(2)
+            flush_pending_outbox(chat_id, timeout=2)  # Next phase starts once this one's notices are out
 
             # Check cancellation/pause before phase 4
-            if not _check_pause(deepreview_active, chat_key, chat_id, "deepreview", phase, step):
-                if not notified_exit:
-                    send_message(chat_id, f"⚠️ *Deep review cancelled* at step {step}.")
-                    notified_exit = True
+            if _bail_if_cancelled():
                 break
 
             # --- PHASE 4: Claude cross-reviews Codex's work ---
             phase = "claude_reviews_codex"
-            deepreview_active[chat_key]["phase"] = phase
+            state["phase"] = phase
             step += 1
-            deepreview_active[chat_key]["step"] = step
+            state["step"] = step
             _ws_broadcast_status(chat_id, "deepreview", phase, step)
 
-            send_message(chat_id, f"⚔️ *Step {step}* — Phase 4 (iteration {iteration_34}): Claude cross-reviewing Codex's work...")
+            status.push(f"⚔️ *Step {step}* — Phase 4 (iteration {iteration_34}): Claude cross-reviewing Codex's work...")
 
             critique_prompt = f"""Another AI (Codex) just did a deep code review and made direct fixes to the codebase.
 
 REVIEW HISTORY:
-{all_review_history[-4000:]}
+{review_summary.render(4000)}
 
 Your job is to cross-review Codex's work with fresh eyes:
 
@@ -5368,26 +6224,13 @@ Your job is to cross-review Codex's work with fresh eyes:
 If you find problems, fix them immediately and report what you changed.
 If Codex's work is solid and the code is clean, say exactly: ALL_CLEAN"""
 
-            # Handle compaction
-            needs_compaction = increment_message_count(chat_id, session, "Claude")
-            if needs_compaction:
-                send_message(chat_id, "📦 *Auto-compacting* session context...")
-                try:
-                    summary_response, _, _, _, _ = run_claude_streaming(
-                        "Summarize this session for context continuity (max 500 words). Focus on files changed, issues found and fixed, and current state.",
-                        chat_id, cwd=cwd, continue_session=True,
-                        session_id=session_id, session=session
-                    )
-                    summary = summary_response.split("———")[0].strip() if summary_response else ""
-                except Exception:
-                    summary = ""
-                if summary and len(summary) > 50:
-                    save_session_summary(chat_id, session, summary)
-                update_claude_session_id(chat_id, session, None)
-                reset_message_count(chat_id, session, "Claude")
-                if summary and len(summary) > 50:
-                    critique_prompt = f"[Session compacted - Previous context summary:]\n{summary}\n\n[Continuing task:]\n{critique_prompt}"
-                send_message(chat_id, "🔄 Context preserved. Continuing...")
+            if not _quota_gate("claude", chat_id, chat_key, _deepreview_wait, "Deep review"):
+                notified_exit = True
+                break
+
+            # Handle compaction (skipped while the review history is still short)
+            if increment_message_count(chat_id, session, "Claude") and estimate_tokens(all_review_history.text()) > CTX_BUDGET_SOFT:
+                critique_prompt = _compact_session(critique_prompt)
 
             response, questions, _, claude_sid, context_overflow = run_claude_streaming(
                 critique_prompt, chat_id, cwd=cwd, continue_session=True,
@@ -5395,8 +6238,7 @@ If Codex's work is solid and the code is clean, say exactly: ALL_CLEAN"""
             )
             _ws_broadcast_status(chat_id, "deepreview", phase, step)  # Re-assert after Claude exits
             if claude_sid:
-                update_claude_session_id(chat_id, session, claude_sid)
-                session = get_session_by_id(chat_id, session_id) or session
+                session = update_claude_session_id(chat_id, session, claude_sid) or session
             if context_overflow:
                 update_claude_session_id(chat_id, session, None)
                 reset_message_count(chat_id, session, "Claude")
@@ -5406,8 +6248,7 @@ If Codex's work is solid and the code is clean, say exactly: ALL_CLEAN"""
                 )
                 _ws_broadcast_status(chat_id, "deepreview", phase, step)
                 if claude_sid:
-                    update_claude_session_id(chat_id, session, claude_sid)
-                    session = get_session_by_id(chat_id, session_id) or session
+                    session = update_claude_session_id(chat_id, session, claude_sid) or session
             if questions:
                 auto_answer = handle_justdoit_questions(questions)
                 response2, _, _, sid2, _ = run_claude_streaming(
@@ -5415,27 +6256,25 @@ If Codex's work is solid and the code is clean, say exactly: ALL_CLEAN"""
                     session_id=session_id, session=session
                 )
                 if sid2:
-                    update_claude_session_id(chat_id, session, sid2)
-                    session = get_session_by_id(chat_id, session_id) or session
+                    session = update_claude_session_id(chat_id, session, sid2) or session
                 if response2:
                     response = (response or "") + "\n\n[After auto-answer:]\n" + response2
 
             clean_response = response.split("———")[0].strip() if response else "No output"
-            all_review_history += f"\n\n=== Claude cross-review of Codex (iteration {iteration_34}) ===\n{clean_response[:2000]}"
+            _record(f"Claude cross-review of Codex (iteration {iteration_34})", clean_response[:2000])
 
             print(f"{log_prefix} Step {step}: Claude critique iteration {iteration_34}, response length: {len(clean_response)}", flush=True)
 
             if "ALL_CLEAN" in clean_response.upper():
                 print(f"{log_prefix} Claude reports ALL_CLEAN on Codex's work after iteration {iteration_34}", flush=True)
-                send_message(chat_id, f"✅ Claude is satisfied with Codex's work after {iteration_34} iterations.")
+                send_message_nowait(chat_id, f"✅ Claude is satisfied with Codex's work after {iteration_34} iterations.")
                 claude_satisfied = True
                 break
 
             # Claude found issues — loop back to Phase 3
-            send_message(chat_id, f"📋 *Claude feedback for Codex:*\n\n{clean_response[:3500]}")
-            send_message(chat_id, "🔄 Sending Codex back to fix...")
+            send_message_nowait(chat_id, f"📋 *Claude feedback for Codex:*\n\n{clean_response[:3500]}\n\n🔄 _Sending Codex back to fix..._")
 
-            time.sleep(2)
+            flush_pending_outbox(chat_id, timeout=2)  # Next phase starts once this one's notices are out
 
         if not claude_satisfied and not notified_exit:
             send_message(chat_id, f"⚠️ Hit max Phase 3↔4 iterations ({max_iterations_34}). Ending review.")
@@ -5455,19 +6294,17 @@ Completed in *{step}* steps.
 _Session preserved. You can continue chatting._""")
 
     except Exception as e:
-        import traceback
         print(f"{log_prefix} EXCEPTION: {e}", flush=True)
         print(f"{log_prefix} Traceback:\n{traceback.format_exc()}", flush=True)
         try:
-            send_message(chat_id, f"❌ *Deep review error:* {str(e)[:300]}")
+            send_message(chat_id, f"❌ *Deep review error:* {md_escape(str(e)[:300])}")
         except Exception:
             pass
 
     finally:
         print(f"{log_prefix} Loop ended. Total steps: {step}", flush=True)
         try:
-            state = deepreview_active.get(chat_key, {})
-            if state.get("active", False) and not notified_exit:
+            if state["active"] and not notified_exit:
                 send_message(chat_id, f"⚠️ *Deep review stopped* at step {step}.\n_Session preserved._")
         except Exception:
             pass
@@ -5477,14 +6314,9 @@ _Session preserved. You can continue chatting._""")
         _ws_session_override.name = None
 
 
-def handle_command(chat_id, text):
-    """Handle bot commands. Returns True if handled."""
-    parts = text.split(maxsplit=1)
-    cmd = parts[0].lower()
-    args = parts[1] if len(parts) > 1 else ""
-
-    if cmd == "/start":
-        send_message(chat_id, """🤖 *Claude Bot Ready!*
+def _cmd_start(chat_id, args):
+    """/start — greeting and command overview."""
+    send_message(chat_id, """🤖 *Claude Bot Ready!*
 
 *Commands:*
 • `/new <project>` - Start new session in ~/project
@@ -5497,11 +6329,13 @@ def handle_command(chat_id, text):
 • `/help` - Show this help
 
 Send any message to chat with Claude!""")
-        return True
+    return True
+
 
-    if cmd == "/schedule":
-        if not args:
-            send_message(chat_id, """*Schedule a task:*
+def _cmd_schedule(chat_id, args):
+    """/schedule <spec> | <prompt> — schedule a recurring or one-off task in the current session's cwd."""
+    if not args:
+        send_message(chat_id, """*Schedule a task:*
 `/schedule daily HH:MM | prompt`
 `/schedule weekly DAY HH:MM | prompt`
 `/schedule hourly | prompt`
@@ -5510,109 +6344,116 @@ Send any message to chat with Claude!""")
 
 Uses the current session's working directory.
 Example: `/schedule daily 09:00 | Run tests and fix failures`""")
-            return True
+        return True
 
-        # Parse: /schedule <spec> | <prompt>
-        parts = args.split("|", 1)
-        if len(parts) < 2:
-            send_message(chat_id, "❌ Format: `/schedule <spec> | <prompt>`")
-            return True
+    # Parse: /schedule <spec> | <prompt>
+    parts = args.split("|", 1)
+    if len(parts) < 2:
+        send_message(chat_id, "❌ Format: `/schedule <spec> | <prompt>`")
+        return True
 
-        spec_raw = parts[0].strip()
-        prompt = parts[1].strip()
+    spec_raw = parts[0].strip()
+    prompt = parts[1].strip()
 
-        if not prompt:
-            send_message(chat_id, "❌ Prompt is required.")
-            return True
+    if not prompt:
+        send_message(chat_id, "❌ Prompt is required.")
+        return True
 
-        # Get cwd from current active session
-        active_session = get_active_session(chat_id)
-        task_cwd = active_session.get("cwd", os.getcwd()) if active_session else os.getcwd()
+    # Get cwd from current active session
+    active_session = get_active_session(chat_id)
+    task_cwd = active_session.get("cwd", os.getcwd()) if active_session else os.getcwd()
 
-        # Parse schedule spec
-        try:
-            spec_lower = spec_raw.lower()
-            if spec_lower.startswith("daily "):
-                hm = spec_raw[6:].strip()
-                h, m = map(int, hm.split(":"))
-                cron_expr = f"{m} {h} * * *"
-                schedule_type, run_at = "cron", None
-            elif spec_lower.startswith("weekly "):
-                rest = spec_raw[7:].strip().split()
-                day_name = rest[0].lower()[:3]
-                if day_name not in _DOW_NAMES:
-                    send_message(chat_id, f"❌ Invalid day: `{rest[0]}`. Use Mon, Tue, Wed, etc.")
-                    return True
-                hm = rest[1] if len(rest) > 1 else "09:00"
-                h, m = map(int, hm.split(":"))
-                cron_expr = f"{m} {h} * * {day_name}"
-                schedule_type, run_at = "cron", None
-            elif spec_lower == "hourly":
-                cron_expr = "0 * * * *"
-                schedule_type, run_at = "cron", None
-            elif spec_lower.startswith("cron "):
-                cron_expr = spec_raw[5:].strip()
-                schedule_type, run_at = "cron", None
-            elif spec_lower.startswith("once "):
-                run_at = spec_raw[5:].strip()
-                schedule_type, cron_expr = "once", None
-            else:
-                send_message(chat_id, f"❌ Unknown schedule spec: `{spec_raw}`\nUse `daily`, `weekly`, `hourly`, `cron`, or `once`.")
+    # Parse schedule spec
+    try:
+        spec_lower = spec_raw.lower()
+        if spec_lower.startswith("daily "):
+            hm = spec_raw[6:].strip()
+            h, m = map(int, hm.split(":"))
+            cron_expr = f"{m} {h} * * *"
+            schedule_type, run_at = "cron", None
+        elif spec_lower.startswith("weekly "):
+            rest = spec_raw[7:].strip().split()
+            day_name = rest[0].lower()[:3]
+            if day_name not in _DOW_NAMES:
+                send_message(chat_id, f"❌ Invalid day: `{rest[0]}`. Use Mon, Tue, Wed, etc.")
                 return True
+            hm = rest[1] if len(rest) > 1 else "09:00"
+            h, m = map(int, hm.split(":"))
+            cron_expr = f"{m} {h} * * {day_name}"
+            schedule_type, run_at = "cron", None
+        elif spec_lower == "hourly":
+            cron_expr = "0 * * * *"
+            schedule_type, run_at = "cron", None
+        elif spec_lower.startswith("cron "):
+            cron_expr = spec_raw[5:].strip()
+            schedule_type, run_at = "cron", None
+        elif spec_lower.startswith("once "):
+            run_at = spec_raw[5:].strip()
+            schedule_type, cron_expr = "once", None
+        else:
+            send_message(chat_id, f"❌ Unknown schedule spec: `{spec_raw}`\nUse `daily`, `weekly`, `hourly`, `cron`, or `once`.")
+            return True
 
-            task_id, task = create_scheduled_task(
-                chat_id, prompt, schedule_type,
-                cron_expr=cron_expr, run_at=run_at, cwd=task_cwd,
-            )
-            cwd_short = os.path.basename(task_cwd) or task_cwd
-            next_dt = datetime.fromtimestamp(task["next_run"]).strftime("%Y-%m-%d %H:%M") if task.get("next_run") else "?"
-            send_message(chat_id, f"✅ *Scheduled task created*\nID: `{task_id}`\nDir: `{cwd_short}`\nNext run: {next_dt}\n\nTask: _{prompt[:200]}_")
-        except ValueError as e:
-            send_message(chat_id, f"❌ {e}")
+        task_id, task = create_scheduled_task(
+            chat_id, prompt, schedule_type,
+            cron_expr=cron_expr, run_at=run_at, cwd=task_cwd,
+        )
+        cwd_short = os.path.basename(task_cwd) or task_cwd
+        next_dt = datetime.fromtimestamp(task["next_run"]).strftime("%Y-%m-%d %H:%M") if task.get("next_run") else "?"
+        send_message(chat_id, f"✅ *Scheduled task created*\nID: `{task_id}`\nDir: `{cwd_short}`\nNext run: {next_dt}\n\nTask: _{prompt[:200]}_")
+    except ValueError as e:
+        send_message(chat_id, f"❌ {e}")
+    return True
+
+
+def _cmd_schedules(chat_id, args):
+    """/schedules — list this chat's scheduled tasks."""
+    chat_key = str(chat_id)
+    with _scheduled_tasks_lock:
+        tasks = [(tid, t) for tid, t in scheduled_tasks.items()
+                 if str(t.get("chat_id")) == chat_key]
+
+    if not tasks:
+        send_message(chat_id, "No scheduled tasks. Use `/schedule` to create one.")
         return True
 
-    if cmd == "/schedules":
-        with _scheduled_tasks_lock:
-            tasks = [(tid, t) for tid, t in scheduled_tasks.items()
-                     if str(t.get("chat_id")) == str(chat_id)]
+    lines = ["*Scheduled Tasks:*\n"]
+    for tid, t in sorted(tasks, key=lambda x: x[1].get("next_run") or float("inf")):
+        status = "✅" if t["enabled"] else "⏸"
+        if t["schedule_type"] == "cron":
+            sched_desc = t.get("cron_expr", "?")
+        else:
+            sched_desc = f"once {t.get('run_at', '?')}"
+        cwd_short = os.path.basename(t.get("cwd", "")) or t.get("cwd", "?")
+        next_dt = datetime.fromtimestamp(t["next_run"]).strftime("%m/%d %H:%M") if t.get("next_run") else "—"
+        lines.append(f"{status} `{tid}`\n   {cwd_short} • {sched_desc}\n   Next: {next_dt} • Runs: {t.get('run_count', 0)}\n   _{t['prompt'][:80]}_\n")
 
-        if not tasks:
-            send_message(chat_id, "No scheduled tasks. Use `/schedule` to create one.")
-            return True
+    send_message(chat_id, "\n".join(lines))
+    return True
 
-        lines = ["*Scheduled Tasks:*\n"]
-        for tid, t in sorted(tasks, key=lambda x: x[1].get("next_run") or float("inf")):
-            status = "✅" if t["enabled"] else "⏸"
-            if t["schedule_type"] == "cron":
-                sched_desc = t.get("cron_expr", "?")
-            else:
-                sched_desc = f"once {t.get('run_at', '?')}"
-            cwd_short = os.path.basename(t.get("cwd", "")) or t.get("cwd", "?")
-            next_dt = datetime.fromtimestamp(t["next_run"]).strftime("%m/%d %H:%M") if t.get("next_run") else "—"
-            lines.append(f"{status} `{tid}`\n   {cwd_short} • {sched_desc}\n   Next: {next_dt} • Runs: {t.get('run_count', 0)}\n   _{t['prompt'][:80]}_\n")
 
-        send_message(chat_id, "\n".join(lines))
+def _cmd_unschedule(chat_id, args):
+    """/unschedule <id> — remove a scheduled task."""
+    if not args:
+        send_message(chat_id, "Usage: `/unschedule <task_id>`")
         return True
 
-    if cmd == "/unschedule":
-        if not args:
-            send_message(chat_id, "Usage: `/unschedule <task_id>`")
+    task_id = args.strip()
+    with _scheduled_tasks_lock:
+        task = scheduled_tasks.get(task_id)
+        if not task or str(task.get("chat_id")) != str(chat_id):
+            send_message(chat_id, f"❌ Task `{task_id}` not found.")
             return True
+        del scheduled_tasks[task_id]
+    save_scheduled_tasks()
+    _ws_broadcast_schedule(chat_id, "deleted", task_id, task)
+    send_message(chat_id, f"🗑 Scheduled task `{task_id}` deleted.")
+    return True
 
-        task_id = args.strip()
-        with _scheduled_tasks_lock:
-            task = scheduled_tasks.get(task_id)
-            if not task or str(task.get("chat_id")) != str(chat_id):
-                send_message(chat_id, f"❌ Task `{task_id}` not found.")
-                return True
-            del scheduled_tasks[task_id]
-        save_scheduled_tasks()
-        _ws_broadcast_schedule(chat_id, "deleted", task_id, task)
-        send_message(chat_id, f"🗑 Scheduled task `{task_id}` deleted.")
-        return True
 
-    if cmd == "/help":
-        send_message(chat_id, """*Claude Telegram Bot Help*
+def _cmd_help(chat_id, args):
+    """/help — full command reference."""
+    send_message(chat_id, """*Claude Telegram Bot Help*
 
 *Session Commands:*
 • `/new <project>` - Start a new session
@@ -5672,609 +6513,799 @@ Example: `/schedule daily 09:00 | Run tests and fix failures`""")
 You can run multiple tasks in parallel! Just `/new` or `/resume` to switch sessions while another is running. Messages to a busy session get queued.
 
 Just send a message to chat with Claude!""")
-        return True
+    return True
 
-    if cmd == "/chatid":
-        send_message(chat_id, f"Your chat ID: `{chat_id}`")
-        return True
 
-    if cmd == "/new":
-        if not args:
-            send_message(chat_id, "Usage: `/new <project_name>`\nExample: `/new lifecompanion`")
-            return True
+def _cmd_chatid(chat_id, args):
+    """/chatid — show this chat's ID."""
+    send_message(chat_id, f"Your chat ID: `{chat_id}`")
+    return True
 
-        project_name = args.strip()
-        # Resolve project directory
-        if project_name.startswith("/"):
-            cwd = project_name
-        else:
-            cwd = os.path.join(BASE_PROJECTS_DIR, project_name)
 
-        if not os.path.isdir(cwd):
-            send_message(chat_id, f"❌ Directory not found: `{cwd}`\n\nMake sure the project exists.")
-            return True
+def _cmd_new(chat_id, args):
+    """/new <project> — start a new session in a project directory."""
+    if not args:
+        send_message(chat_id, "Usage: `/new <project_name>`\nExample: `/new lifecompanion`")
+        return True
+
+    project_name = args.strip()
+    # Resolve project directory
+    if project_name.startswith("/"):
+        cwd = project_name
+    else:
+        cwd = os.path.join(BASE_PROJECTS_DIR, project_name)
 
-        session = create_session(chat_id, project_name, cwd)
-        send_message(chat_id, f"""✅ *Session Started*
+    if not os.path.isdir(cwd):
+        send_message(chat_id, f"❌ Directory not found: `{cwd}`\n\nMake sure the project exists.")
+        return True
+
+    create_session(chat_id, project_name, cwd)
+    invalidate_project_file_index(cwd)
+    send_message(chat_id, f"""✅ *Session Started*
 
 • Project: `{project_name}`
 • Directory: `{cwd}`
 
 Send a message to start working!""")
-        return True
+    return True
 
-    if cmd == "/sessions":
-        chat_key = str(chat_id)
-        user_data = user_sessions.get(chat_key, {})
-        sessions = user_data.get("sessions", [])
-        active_id = user_data.get("active")
 
-        if not sessions:
-            send_message(chat_id, "No sessions yet. Use `/new <project>` to start one.")
-            return True
+def _cmd_sessions(chat_id, args):
+    """/sessions — list recent sessions."""
+    chat_key = str(chat_id)
+    user_data = user_sessions.get(chat_key, {})
+    sessions = user_data.get("sessions", [])
+    active_id = user_data.get("active")
 
-        lines = ["*Your Sessions:*\n"]
-        for s in sessions[-10:]:  # Last 10 sessions
-            session_id = get_session_id(s)
-            is_active = session_id == active_id or s.get("cwd") == active_id
-            is_busy = session_id in active_processes
-            marker = "→ " if is_active else "  "
-            status = " 🔄" if is_busy else ""
-            lines.append(f"{marker}`{s['name']}`{status}")
-            # Show last prompt snippet
-            last_prompt = s.get("last_prompt")
-            if last_prompt:
-                snippet = last_prompt[:50] + "..." if len(last_prompt) > 50 else last_prompt
-                lines.append(f"    _{snippet}_")
-
-        lines.append("\n🔄 = running task")
-        lines.append("\nUse `/resume` to pick a session or `/switch <name>`")
-        send_message(chat_id, "\n".join(lines))
+    if not sessions:
+        send_message(chat_id, "No sessions yet. Use `/new <project>` to start one.")
         return True
 
-    if cmd == "/resume":
-        chat_key = str(chat_id)
-        user_data = user_sessions.get(chat_key, {})
-        sessions = user_data.get("sessions", [])
+    # Resolve the active session once (legacy sessions stored their cwd as the active id)
+    active = next((s for s in sessions if active_id is not None and active_id in (get_session_id(s), s.get("cwd"))), None)
+    busy_ids = set(active_processes)
+
+    lines = ["*Your Sessions:*\n"]
+    for s in sessions[-10:]:  # Last 10 sessions
+        is_active = s is active
+        is_busy = get_session_id(s) in busy_ids
+        marker = "→ " if is_active else "  "
+        status = " 🔄" if is_busy else ""
+        lines.append(f"{marker}`{s['name']}`{status}")
+        # Show last prompt snippet
+        last_prompt = s.get("last_prompt")
+        if last_prompt:
+            snippet = last_prompt[:50] + "..." if len(last_prompt) > 50 else last_prompt
+            lines.append(f"    _{snippet}_")
+
+    lines.append("\n🔄 = running task")
+    lines.append("\nUse `/resume` to pick a session or `/switch <name>`")
+    send_message(chat_id, "\n".join(lines))
+    return True
 
-        if not sessions:
-            send_message(chat_id, "No sessions yet. Use `/new <project>` to start one.")
-            return True
 
-        # Build session list with last prompt info
-        lines = ["*Pick a session to resume:*\n_🔄 = task running_\n"]
-        keyboard = []
-        for s in sessions[-8:]:  # Last 8 sessions (Telegram limit)
-            session_id = get_session_id(s)
-            is_busy = session_id in active_processes
-            label = f"🔄 {s['name']}" if is_busy else s['name']
-            # Use index as callback data
-            idx = user_data["sessions"].index(s)
-            keyboard.append([{"text": label, "callback_data": f"resume_{idx}"}])
-            # Show last prompt snippet in message
-            last_prompt = s.get("last_prompt")
-            if last_prompt:
-                snippet = last_prompt[:40] + "..." if len(last_prompt) > 40 else last_prompt
-                lines.append(f"• *{s['name']}*: _{snippet}_")
-
-        reply_markup = {"inline_keyboard": keyboard}
-        send_message(chat_id, "\n".join(lines), reply_markup=reply_markup)
+def _cmd_resume(chat_id, args):
+    """/resume — session picker."""
+    chat_key = str(chat_id)
+    user_data = user_sessions.get(chat_key, {})
+    sessions = user_data.get("sessions", [])
+
+    if not sessions:
+        send_message(chat_id, "No sessions yet. Use `/new <project>` to start one.")
         return True
 
-    if cmd == "/switch":
-        if not args:
-            send_message(chat_id, "Usage: `/switch <project_name>`")
-            return True
+    # Build session list with last prompt info
+    lines = ["*Pick a session to resume:*\n_🔄 = task running_\n"]
+    keyboard = []
+    busy_ids = set(active_processes)
+    for idx in range(max(0, len(sessions) - 8), len(sessions)):  # Last 8 sessions (Telegram limit)
+        s = sessions[idx]
+        is_busy = get_session_id(s) in busy_ids
+        label = f"🔄 {s['name']}" if is_busy else s['name']
+        # Use index as callback data
+        keyboard.append([{"text": label, "callback_data": f"resume_{idx}"}])
+        # Show last prompt snippet in message
+        last_prompt = s.get("last_prompt")
+        if last_prompt:
+            snippet = last_prompt[:40] + "..." if len(last_prompt) > 40 else last_prompt
+            lines.append(f"• *{s['name']}*: _{snippet}_")
+
+    reply_markup = {"inline_keyboard": keyboard}
+    send_message(chat_id, "\n".join(lines), reply_markup=reply_markup)
+    return True
 
-        target = args.strip().lower()
-        chat_key = str(chat_id)
-        user_data = user_sessions.get(chat_key, {})
 
-        for s in user_data.get("sessions", []):
-            if s["name"].lower() == target or s["name"].lower().startswith(target):
-                session_id = get_session_id(s)
-                set_active_session(chat_id, session_id)
-                send_message(chat_id, f"✅ Switched to `{s['name']}`")
-                _ws_broadcast(chat_id, "active_session", {"session": s["name"]})
-                return True
+def _cmd_switch(chat_id, args):
+    """/switch <name> — make a session active by (prefix of) name."""
+    if not args:
+        send_message(chat_id, "Usage: `/switch <project_name>`")
+        return True
 
-        send_message(chat_id, f"❌ Session `{target}` not found. Use `/sessions` to list.")
+    target = args.strip().lower()
+    idx = find_session_index_by_name(chat_id, target)
+    if idx is not None:
+        s = user_sessions[str(chat_id)]["sessions"][idx]
+        session_id = get_session_id(s)
+        set_active_session(chat_id, session_id)
+        send_message(chat_id, f"✅ Switched to `{s['name']}`")
+        _ws_broadcast(chat_id, "active_session", {"session": s["name"]})
         return True
 
-    if cmd == "/delete":
-        chat_key = str(chat_id)
-        user_data = user_sessions.get(chat_key, {})
-        sessions = user_data.get("sessions", [])
+    send_message(chat_id, f"❌ Session `{target}` not found. Use `/sessions` to list.")
+    return True
 
-        if not sessions:
-            send_message(chat_id, "No sessions to delete.")
-            return True
 
-        # /delete all — clear everything
-        if args.strip().lower() == "all":
-            for s in user_sessions.get(chat_key, {}).get("sessions", []):
-                sid = get_session_id(s)
-                session_locks.pop(sid, None)
-                message_queue.pop(sid, None)
-            user_sessions[chat_key] = {"sessions": [], "active": None}
-            save_sessions(force=True)
-            send_message(chat_id, "🗑️ All sessions deleted.")
-            return True
+def _cmd_delete(chat_id, args):
+    """/delete [name|all] — delete sessions, or show a picker."""
+    chat_key = str(chat_id)
+    user_data = user_sessions.get(chat_key, {})
+    sessions = user_data.get("sessions", [])
 
-        # /delete <name> — delete by name
-        if args.strip():
-            target = args.strip().lower()
-            for i, s in enumerate(sessions):
-                if s["name"].lower() == target or s["name"].lower().startswith(target):
-                    deleted_name = s["name"]
-                    sid = get_session_id(s)
-                    sessions.pop(i)
-                    if user_data.get("active") == sid:
-                        user_data["active"] = None
-                    session_locks.pop(sid, None)
-                    message_queue.pop(sid, None)
-                    save_sessions(force=True)
-                    send_message(chat_id, f"🗑️ Deleted session `{deleted_name}`")
-                    return True
-            send_message(chat_id, f"❌ Session `{target}` not found. Use `/sessions` to list.")
-            return True
+    if not sessions:
+        send_message(chat_id, "No sessions to delete.")
+        return True
 
-        # /delete (no args) — show picker
-        keyboard = []
-        for s in sessions[-8:]:
-            idx = sessions.index(s)
-            keyboard.append([{"text": f"🗑️ {s['name']}", "callback_data": f"delete_{idx}"}])
-        keyboard.append([{"text": "🗑️ Delete ALL", "callback_data": "delete_all"}])
+    # /delete all — clear everything
+    if args.strip().lower() == "all":
+        for s in user_sessions.get(chat_key, {}).get("sessions", []):
+            sid = get_session_id(s)
+            session_locks.pop(sid, None)
+            message_queue.pop(sid, None)
+            _last_queue_ack.pop(sid, None)
+            _queue_ack_locks.pop(sid, None)
+            _session_name_index.pop(chat_key, None)
+        _session_by_id.pop(chat_key, None)
+        user_sessions[chat_key] = {"sessions": [], "active": None}
+        save_sessions(soon=True)
+        send_message(chat_id, "🗑️ All sessions deleted.")
+        return True
 
-        reply_markup = {"inline_keyboard": keyboard}
-        send_message(chat_id, "*Pick a session to delete:*", reply_markup=reply_markup)
+    # /delete <name> — delete by name
+    if args.strip():
+        target = args.strip().lower()
+        i = find_session_index_by_name(chat_id, target)
+        if i is not None:
+            s = sessions.pop(i)
+            deleted_name = s["name"]
+            sid = get_session_id(s)
+            if user_data.get("active") == sid:
+                user_data["active"] = None
+            session_locks.pop(sid, None)
+            message_queue.pop(sid, None)
+            _last_queue_ack.pop(sid, None)
+            _queue_ack_locks.pop(sid, None)
+            _session_by_id.get(chat_key, {}).pop(sid, None)
+            _session_name_index.pop(chat_key, None)
+            save_sessions(soon=True)
+            send_message(chat_id, f"🗑️ Deleted session `{deleted_name}`")
+            return True
+        send_message(chat_id, f"❌ Session `{target}` not found. Use `/sessions` to list.")
         return True
 
-    if cmd == "/status":
-        session = get_active_session(chat_id)
-        if session:
-            session_id = get_session_id(session)
-            is_busy = session_id in active_processes
-
-            jdi_key = f"{chat_id}:{session_id}"
-            jdi_state = justdoit_active.get(jdi_key, {})
-            if jdi_state.get("active"):
-                jdi_phase = jdi_state.get('phase', 'implementing')
-                status = f"🚀 JustDoIt step {jdi_state.get('step', '?')} — {jdi_phase}"
-            elif is_busy:
-                status = "🔄 Running"
-            else:
-                status = "✅ Idle"
+    # /delete (no args) — show picker
+    keyboard = []
+    for idx in range(max(0, len(sessions) - 8), len(sessions)):
+        s = sessions[idx]
+        keyboard.append([{"text": f"🗑️ {s['name']}", "callback_data": f"delete_{idx}"}])
+    keyboard.append([{"text": "🗑️ Delete ALL", "callback_data": "delete_all"}])
+
+    reply_markup = {"inline_keyboard": keyboard}
+    send_message(chat_id, "*Pick a session to delete:*", reply_markup=reply_markup)
+    return True
+
 
-            default_cli = session.get("last_cli", "Claude")
-            send_message(chat_id, f"""*Current Session:*
+def _cmd_status(chat_id, args):
+    """/status — show the active session and any running loop."""
+    session = get_active_session(chat_id)
+    if session:
+        session_id = get_session_id(session)
+        proc = active_processes.get(session_id)
+        is_busy = session_id in active_processes and (not proc or proc.poll() is None)  # an exited leftover isn't "Running"
+
+        loop_mode, loop_state = get_active_loop(f"{chat_id}:{session_id}")
+        if loop_mode:
+            status = f"🚀 {_LOOP_LABELS[loop_mode]} step {loop_state.get('step', '?')} — {loop_state.get('phase') or 'starting'}"
+        elif is_busy:
+            status = "🔄 Running"
+        else:
+            status = "✅ Idle"
+
+        default_cli = session.get("last_cli", "Claude")
+        send_message(chat_id, f"""*Current Session:*
 • Project: `{session['name']}`
 • Directory: `{session['cwd']}`
 • Default CLI: `{default_cli}`
 • Status: {status}
 • Created: {session['created_at'][:16]}""")
-        else:
-            send_message(chat_id, "No active session. Use `/new <project>` to start one.")
-        return True
+    else:
+        send_message(chat_id, "No active session. Use `/new <project>` to start one.")
+    return True
+
+
+def _cmd_end(chat_id, args):
+    """/end — clear the active session (it stays in /sessions)."""
+    chat_key = str(chat_id)
+    if chat_key in user_sessions:
+        user_sessions[chat_key]["active"] = None
+        save_sessions(soon=True)
+    send_message(chat_id, "Session ended. Use `/new <project>` to start a new one.")
+    return True
 
-    if cmd == "/end":
-        chat_key = str(chat_id)
-        if chat_key in user_sessions:
-            user_sessions[chat_key]["active"] = None
-            save_sessions(force=True)
-        send_message(chat_id, "Session ended. Use `/new <project>` to start a new one.")
-        return True
 
-    if cmd == "/reset":
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
-        # Clear the Claude session ID to start fresh
-        update_claude_session_id(chat_id, session, None)
-        send_message(chat_id, f"🔄 *Session Reset*\n\nCleared conversation history for `{session['name']}`.\nNext message will start a fresh conversation.")
+def _cmd_reset(chat_id, args):
+    """/reset — drop the active session's Claude conversation so the next message starts fresh."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
+    # Clear the Claude session ID to start fresh
+    update_claude_session_id(chat_id, session, None)
+    invalidate_project_file_index(session["cwd"])
+    send_message(chat_id, f"🔄 *Session Reset*\n\nCleared conversation history for `{session['name']}`.\nNext message will start a fresh conversation.")
+    return True
 
-    if cmd == "/reload":
-        global _reload_requested
-        _reload_requested = True
-        send_message(chat_id, "🔄 *Hot reload requested.* New code will be loaded on next poll cycle.")
-        return True
 
-    if cmd == "/cancel":
-        session = get_active_session(chat_id)
+def _cmd_reload(chat_id, args):
+    """/reload — ask the loader to hot-reload bot.py."""
+    global _reload_requested
+    _reload_requested = True
+    send_message(chat_id, "🔄 *Hot reload requested.* New code will be loaded on next poll cycle.")
+    return True
 
-        # Cancel justdoit or deepreview mode if active on the current session
-        justdoit_was_active = False
-        deepreview_was_active = False
-        omni_was_active = False
-        if session:
-            session_id = get_session_id(session)
-            jdi_key = f"{chat_id}:{session_id}"
-            if justdoit_active.get(jdi_key, {}).get("active"):
-                justdoit_active[jdi_key]["active"] = False
-                justdoit_was_active = True
-                _ws_broadcast_status(chat_id, "justdoit", "", 0, active=False)
-            if deepreview_active.get(jdi_key, {}).get("active"):
-                deepreview_active[jdi_key]["active"] = False
-                deepreview_was_active = True
-                _ws_broadcast_status(chat_id, "deepreview", "", 0, active=False)
-            if omni_active.get(jdi_key, {}).get("active"):
-                omni_active[jdi_key]["active"] = False
-                omni_was_active = True
-                _ws_broadcast_status(chat_id, "omni", "", 0, active=False)
-            # Clear any queued user feedback
-            user_feedback_queue.pop(jdi_key, None)
 
-        if session:
-            session_id = get_session_id(session)
-            process = active_processes.get(session_id)
-            if process:
-                # Only mark as cancelled if there's an active process — otherwise the flag
-                # lingers and falsely marks the NEXT run as cancelled
-                cancelled_sessions.add(session_id)
+def _cmd_cancel(chat_id, args):
+    """/cancel — stop the running task and any justdoit/omni/deepreview loop."""
+    session = get_active_session(chat_id)
+
+    # Cancel justdoit or deepreview mode if active on the current session
+    stopped = set()  # loop modes this /cancel turned off
+    if session:
+        session_id = get_session_id(session)
+        jdi_key = f"{chat_id}:{session_id}"
+        for mode, loops in _loop_modes():
+            loop_state = loops.get(jdi_key)
+            if loop_state and loop_state.get("active"):
+                loop_state["active"] = False
+                _wake_loop(loop_state)
+                stopped.add(mode)
+                _ws_broadcast_status(chat_id, mode, "", 0, active=False)
+        # Clear any queued user feedback
+        user_feedback_queue.pop(jdi_key, None)
+    justdoit_was_active = "justdoit" in stopped
+    deepreview_was_active = "deepreview" in stopped
+    omni_was_active = "omni" in stopped
+
+    if session:
+        process = active_processes.get(session_id)
+        if process:
+            # Only mark as cancelled if there's an active process — otherwise the flag
+            # lingers and falsely marks the NEXT run as cancelled
+            cancelled_sessions.add(session_id)
+            try:
+                # Kill entire process group (Claude CLI + child processes) for immediate abort
+                kill_process_group(process)
+                # Close stdout pipe to unblock the reading thread and free buffers
                 try:
-                    import signal
-                    # Kill entire process group (Claude CLI + child processes) for immediate abort
-                    os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-                    # Close stdout pipe to unblock the reading thread and free buffers
-                    try:
-                        if process.stdout:
-                            process.stdout.close()
-                    except Exception:
-                        pass
-                    active_processes.pop(session_id, None)
-                    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
-                    if justdoit_was_active:
-                        send_message(chat_id, f"⚠️ *JustDoIt cancelled* for `{session['name']}`.\n_Session preserved. You can continue manually._")
-                    elif deepreview_was_active:
-                        send_message(chat_id, f"⚠️ *Deep review cancelled* for `{session['name']}`.\n_Session preserved._")
-                    elif omni_was_active:
-                        send_message(chat_id, f"⚠️ *Omni cancelled* for `{session['name']}`.\n_Session preserved._")
-                    else:
-                        send_message(chat_id, f"⚠️ Cancelled operation for `{session['name']}`.")
-                except ProcessLookupError:
-                    # Process already exited
-                    active_processes.pop(session_id, None)
-                    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
-                    send_message(chat_id, f"⚠️ Cancelled (process already finished).")
-                except Exception as e:
-                    print(f"Cancel error: {e}", flush=True)
-                    # Fallback: try regular kill
-                    try:
-                        process.kill()
-                        active_processes.pop(session_id, None)
-                        _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
-                    except Exception:
-                        pass
-                    send_message(chat_id, f"⚠️ Cancelled operation for `{session['name']}`.")
-            else:
+                    if process.stdout:
+                        process.stdout.close()
+                except Exception:
+                    pass
+                active_processes.pop(session_id, None)
+                _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
                 if justdoit_was_active:
-                    send_message(chat_id, f"⚠️ *JustDoIt cancelled* for `{session['name']}`.\n_No active subprocess was running._")
+                    send_message(chat_id, f"⚠️ *JustDoIt cancelled* for `{session['name']}`.\n_Session preserved. You can continue manually._")
                 elif deepreview_was_active:
-                    send_message(chat_id, f"⚠️ *Deep review cancelled* for `{session['name']}`.\n_No active subprocess was running._")
+                    send_message(chat_id, f"⚠️ *Deep review cancelled* for `{session['name']}`.\n_Session preserved._")
                 elif omni_was_active:
-                    send_message(chat_id, f"⚠️ *Omni cancelled* for `{session['name']}`.\n_No active subprocess was running._")
+                    send_message(chat_id, f"⚠️ *Omni cancelled* for `{session['name']}`.\n_Session preserved._")
                 else:
-                    send_message(chat_id, f"No active task for session `{session['name']}`.")
+                    send_message(chat_id, f"⚠️ Cancelled operation for `{session['name']}`.")
+            except ProcessLookupError:
+                # Process already exited
+                active_processes.pop(session_id, None)
+                _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
+                send_message(chat_id, f"⚠️ Cancelled (process already finished).")
+            except Exception as e:
+                print(f"Cancel error: {e}", flush=True)
+                # Fallback: try regular kill
+                try:
+                    process.kill()
+                    active_processes.pop(session_id, None)
+                    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": False})
+                except Exception:
+                    pass
+                send_message(chat_id, f"⚠️ Cancelled operation for `{session['name']}`.")
         else:
             if justdoit_was_active:
-                send_message(chat_id, "⚠️ JustDoIt cancelled.")
+                send_message(chat_id, f"⚠️ *JustDoIt cancelled* for `{session['name']}`.\n_No active subprocess was running._")
             elif deepreview_was_active:
-                send_message(chat_id, "⚠️ Deep review cancelled.")
+                send_message(chat_id, f"⚠️ *Deep review cancelled* for `{session['name']}`.\n_No active subprocess was running._")
             elif omni_was_active:
-                send_message(chat_id, "⚠️ Omni cancelled.")
+                send_message(chat_id, f"⚠️ *Omni cancelled* for `{session['name']}`.\n_No active subprocess was running._")
             else:
-                send_message(chat_id, "No active session. Nothing to cancel.")
+                send_message(chat_id, f"No active task for session `{session['name']}`.")
+    else:
+        if justdoit_was_active:
+            send_message(chat_id, "⚠️ JustDoIt cancelled.")
+        elif deepreview_was_active:
+            send_message(chat_id, "⚠️ Deep review cancelled.")
+        elif omni_was_active:
+            send_message(chat_id, "⚠️ Omni cancelled.")
+        else:
+            send_message(chat_id, "No active session. Nothing to cancel.")
+    return True
+
+
+def _cmd_plan(chat_id, args):
+    """/plan — ask Claude for an implementation plan to approve or reject."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
 
-    if cmd == "/plan":
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
+    send_typing(chat_id)
+    response, questions = run_claude(
+        "Enter plan mode to plan the implementation",
+        cwd=session["cwd"]
+    )
 
-        send_typing(chat_id)
-        response, questions = run_claude(
-            "Enter plan mode to plan the implementation",
-            cwd=session["cwd"]
-        )
+    if questions:
+        set_pending_questions(chat_id, questions, session)
+    elif response:
+        send_message(chat_id, response)
+    return True
 
-        if questions:
-            set_pending_questions(chat_id, questions, session)
-        elif response:
-            send_message(chat_id, response)
+
+def _cmd_approve(chat_id, args):
+    """/approve, /yes — approve the pending plan."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
+    send_typing(chat_id)
+    response, _ = run_claude("yes, approved", cwd=session["cwd"], continue_session=True)
+    send_message(chat_id, response or "✅ Approved")
+    return True
 
-    if cmd in ["/approve", "/yes"]:
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
-        send_typing(chat_id)
-        response, _ = run_claude("yes, approved", cwd=session["cwd"], continue_session=True)
-        send_message(chat_id, response or "✅ Approved")
+
+def _cmd_reject(chat_id, args):
+    """/reject, /no — reject the pending plan."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
+    send_typing(chat_id)
+    response, _ = run_claude("no, please revise", cwd=session["cwd"], continue_session=True)
+    send_message(chat_id, response or "❌ Rejected")
+    return True
 
-    if cmd in ["/reject", "/no"]:
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
-        send_typing(chat_id)
-        response, _ = run_claude("no, please revise", cwd=session["cwd"], continue_session=True)
-        send_message(chat_id, response or "❌ Rejected")
+
+def _cmd_omni(chat_id, args):
+    """/omni, /o — start an omni loop."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
+        return True
+    session_id = get_session_id(session)
+    omni_key = f"{chat_id}:{session_id}"
+    if _refuse_if_loop_running(chat_id, omni_key, "omni"):
+        return True
+    if session_id in active_processes:
+        send_message(chat_id, "⚠️ Session is busy. Wait for it to finish or `/cancel` first.")
         return True
 
-    if cmd in ("/omni", "/o"):
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
-        session_id = get_session_id(session)
-        omni_key = f"{chat_id}:{session_id}"
-        if omni_active.get(omni_key, {}).get("active"):
-            send_message(chat_id, "⚠️ Omni is already running on this session. Use `/cancel` to stop it first.")
-            return True
-        if justdoit_active.get(omni_key, {}).get("active"):
-            send_message(chat_id, "⚠️ JustDoIt is running on this session. Use `/cancel` to stop it first.")
-            return True
-        if deepreview_active.get(omni_key, {}).get("active"):
-            send_message(chat_id, "⚠️ Deep review is running on this session. Use `/cancel` to stop it first.")
-            return True
-        if session_id in active_processes:
-            send_message(chat_id, "⚠️ Session is busy. Wait for it to finish or `/cancel` first.")
-            return True
+    task = args.strip() if args else "Review the project and identify improvements"
 
-        task = args.strip() if args else "Review the project and identify improvements"
-        
-        # Run Omni in a background thread
-        thread = threading.Thread(
-            target=run_omni_loop,
-            args=(chat_id, task, session),
-            daemon=True
-        )
-        thread.start()
+    # Run Omni in a background thread
+    thread = threading.Thread(
+        target=run_omni_loop,
+        args=(chat_id, task, session),
+        daemon=True
+    )
+    thread.start()
+    return True
+
+
+def _cmd_claude(chat_id, args):
+    """/claude, /c, /cl — send a prompt straight to Claude."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
 
-    if cmd in ("/claude", "/c", "/cl"):
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
+    task = args.strip() if args else "Review the code and identify any issues, bugs, or improvements"
+    sid = get_session_id(session)
+    task, queue_pos = _claim_or_queue(sid, task)
+    if task is None:
+        send_message(chat_id, f"📋 _Message queued (#{queue_pos}) for `{session.get('name', 'default')}`. Will process after current task._")
+        return True
+    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
+    session["last_cli"] = "Claude"
+    run_claude_in_thread(chat_id, task, session=session)
+    return True
 
-        task = args.strip() if args else "Review the code and identify any issues, bugs, or improvements"
-        sid = get_session_id(session)
-        lock = get_session_lock(sid)
-        with lock:
-            if sid in active_processes:
-                if sid not in message_queue:
-                    message_queue[sid] = []
-                message_queue[sid].append(task)
-                queue_pos = len(message_queue[sid])
-                send_message(chat_id, f"📋 _Message queued (#{queue_pos}) for `{session.get('name', 'default')}`. Will process after current task._")
-                return True
-            active_processes[sid] = None
-            _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
-        session["last_cli"] = "Claude"
-        run_claude_in_thread(chat_id, task, session=session)
+
+def _cmd_codex(chat_id, args):
+    """/codex — send a prompt to Codex."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
 
-    if cmd == "/codex":
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
+    task = args.strip() if args else "Review the code and identify any issues, bugs, or improvements"
+    sid = get_session_id(session)
+    task, queue_pos = _claim_or_queue(sid, task)
+    if task is None:
+        send_message(chat_id, f"📋 _Message queued (#{queue_pos}) for `{session.get('name', 'default')}`. Will process after current task._")
+        return True
+    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
+    session["last_cli"] = "Codex"
+    run_codex_task(chat_id, task, session["cwd"], session=session)
+    return True
 
-        task = args.strip() if args else "Review the code and identify any issues, bugs, or improvements"
-        sid = get_session_id(session)
-        lock = get_session_lock(sid)
-        with lock:
-            if sid in active_processes:
-                if sid not in message_queue:
-                    message_queue[sid] = []
-                message_queue[sid].append(task)
-                queue_pos = len(message_queue[sid])
-                send_message(chat_id, f"📋 _Message queued (#{queue_pos}) for `{session.get('name', 'default')}`. Will process after current task._")
-                return True
-            active_processes[sid] = None
-            _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
-        session["last_cli"] = "Codex"
-        run_codex_task(chat_id, task, session["cwd"], session=session)
+
+def _cmd_gemini(chat_id, args):
+    """/gemini, /gem, /g — send a prompt to Gemini."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
 
-    if cmd in ("/gemini", "/gem", "/g"):
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
+    task = args.strip() if args else "Review the code and identify any issues, bugs, or improvements"
+    sid = get_session_id(session)
+    task, queue_pos = _claim_or_queue(sid, task)
+    if task is None:
+        send_message(chat_id, f"📋 _Message queued (#{queue_pos}) for `{session.get('name', 'default')}`. Will process after current task._")
+        return True
+    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
+    session["last_cli"] = "Gemini"
+    run_gemini_task(chat_id, task, session["cwd"], session=session)
+    return True
 
-        task = args.strip() if args else "Review the code and identify any issues, bugs, or improvements"
-        sid = get_session_id(session)
-        lock = get_session_lock(sid)
-        with lock:
-            if sid in active_processes:
-                if sid not in message_queue:
-                    message_queue[sid] = []
-                message_queue[sid].append(task)
-                queue_pos = len(message_queue[sid])
-                send_message(chat_id, f"📋 _Message queued (#{queue_pos}) for `{session.get('name', 'default')}`. Will process after current task._")
-                return True
-            active_processes[sid] = None
-            _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
-        session["last_cli"] = "Gemini"
-        run_gemini_task(chat_id, task, session["cwd"], session=session)
+
+def _cmd_init(chat_id, args):
+    """/init — run `claude init` in the session's cwd."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
 
-    if cmd == "/init":
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
+    cwd = session["cwd"]
 
-        cwd = session["cwd"]
+    def init_thread():
+        try:
+            send_message(chat_id, f"🔧 *Running claude init* in `{cwd}`...")
+            process = subprocess.Popen(
+                ["claude", "init"],
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            # Keep only the heads we actually show; the rest is read and dropped so memory stays bounded
+            err_head = []
 
-        def init_thread():
-            try:
-                send_message(chat_id, f"🔧 *Running claude init* in `{cwd}`...")
-                process = subprocess.Popen(
-                    ["claude", "init"],
-                    cwd=cwd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                stdout, stderr = process.communicate(timeout=120)
-                output = (stdout or "").strip()
-                error = (stderr or "").strip()
-
-                if output:
-                    # Truncate if needed
-                    if len(output) > 3800:
-                        output = output[:3800] + "\n\n... (truncated)"
-                    send_message(chat_id, f"✅ *claude init complete:*\n\n{output}")
-                elif error:
-                    send_message(chat_id, f"⚠️ *claude init:*\n\n{error[:500]}")
-                else:
-                    send_message(chat_id, "✅ *claude init* completed (no output).")
-            except subprocess.TimeoutExpired:
-                process.kill()
-                send_message(chat_id, "❌ claude init timed out.")
-            except FileNotFoundError:
-                send_message(chat_id, "❌ Claude CLI not found.")
-            except Exception as e:
-                send_message(chat_id, f"❌ claude init error: {str(e)[:200]}")
+            def _drain_stderr():
+                err_head.append(process.stderr.read(500))
+                for _ in iter(lambda: process.stderr.read(65536), ""):
+                    pass
 
-        threading.Thread(target=init_thread, daemon=True).start()
-        return True
+            stderr_reader = threading.Thread(target=_drain_stderr, daemon=True)
+            stderr_reader.start()
+            timed_out = threading.Event()
 
-    if cmd in ("/file", "/f"):
-        if not args.strip():
-            send_message(chat_id, "Usage: `/file <path>`\nExample: `/file src/main.py`\nFuzzy: `/file .../main.py`")
-            return True
-        session = get_active_session(chat_id)
-        file_path = args.strip()
-        # Fuzzy path: .../something searches recursively under session cwd
-        if file_path.startswith(".../") and session:
-            target = file_path[4:]
-            skip_dirs = {".git", "node_modules", "__pycache__", ".venv", "venv", ".next", "dist", "build", ".cache", ".tox", "vendor"}
-            matches = []
-            search_root = session["cwd"]
-            max_matches = 50
+            def _on_timeout():
+                timed_out.set()
+                process.kill()
+
+            timer = threading.Timer(120, _on_timeout)
+            timer.start()
             try:
-                for dirpath, dirnames, filenames in os.walk(search_root):
-                    # Prune junk directories in-place to avoid descending into them
-                    dirnames[:] = [d for d in dirnames if d not in skip_dirs]
-                    # Check if target matches end of any file path in this dir
-                    for fname in filenames:
-                        rel = os.path.relpath(os.path.join(dirpath, fname), search_root)
-                        if rel == target or rel.endswith(os.sep + target) or fname == target:
-                            matches.append(os.path.join(dirpath, fname))
-                            if len(matches) >= max_matches:
-                                break
-                    if len(matches) >= max_matches:
-                        break
-            except OSError:
-                pass
-            if not matches:
-                send_message(chat_id, f"❌ No files matching `{file_path[4:]}` found in project.")
-                return True
-            if len(matches) == 1:
-                file_path = matches[0]
+                stdout = process.stdout.read(3801)
+                for _ in iter(lambda: process.stdout.read(65536), ""):
+                    pass
+                process.wait()
+            finally:
+                timer.cancel()
+            stderr_reader.join(timeout=5)
+            if timed_out.is_set():
+                send_message(chat_id, "❌ claude init timed out.")
+                return
+            output = stdout.strip()
+            error = "".join(err_head).strip()
+
+            if output:
+                # Truncate if needed
+                if len(output) > 3800:
+                    output = output[:3800] + "\n\n... (truncated)"
+                send_message(chat_id, f"✅ *claude init complete:*\n\n{output}")
+            elif error:
+                send_message(chat_id, f"⚠️ *claude init:*\n\n{error[:500]}")
             else:
-                # Multiple matches — show list and let user pick
-                lines = [f"Found {len(matches)} matches:"]
-                for m in matches[:15]:
-                    rel = os.path.relpath(m, session["cwd"])
-                    lines.append(f"• `{rel}`")
-                if len(matches) > 15:
-                    lines.append(f"_...and {len(matches) - 15} more_")
-                lines.append("\nUse the full relative path: `/file <path>`")
-                send_message(chat_id, "\n".join(lines))
-                return True
-        # Resolve relative paths against session cwd
-        elif not os.path.isabs(file_path) and session:
-            file_path = os.path.join(session["cwd"], file_path)
-        if not os.path.isfile(file_path):
-            send_message(chat_id, f"❌ File not found: `{args.strip()}`")
+                send_message(chat_id, "✅ *claude init* completed (no output).")
+        except FileNotFoundError:
+            send_message(chat_id, "❌ Claude CLI not found.")
+        except Exception as e:
+            send_message(chat_id, f"❌ claude init error: {str(e)[:200]}")
+
+    threading.Thread(target=init_thread, daemon=True).start()
+    return True
+
+
+def _cmd_file(chat_id, args):
+    """/file, /f — find and send a project file."""
+    if not args.strip():
+        send_message(chat_id, "Usage: `/file <path>`\nExample: `/file src/main.py`\nFuzzy: `/file .../main.py`\nGlob: `/file src/*.py`")
+        return True
+    session = get_active_session(chat_id)
+    file_path = args.strip()
+    # Fuzzy path: .../something (or a glob like *.py) searches recursively under session cwd.
+    # A path that exists as typed is sent as-is, even if it contains glob characters ([id], [slug]).
+    fuzzy = file_path.startswith(".../")
+    literal = file_path if os.path.isabs(file_path) or not session else os.path.join(session["cwd"], file_path)
+    if (fuzzy or (_is_glob(file_path) and not os.path.isfile(literal))) and session:
+        target = file_path[4:] if fuzzy else file_path
+        # One more than we list, so we know whether to say there are more
+        matches = _find_project_files(session["cwd"], target, limit=_FILE_MATCHES_SHOWN + 1)
+        if not matches:
+            # The cached index may predate the file — rescan once before giving up
+            matches = _find_project_files(session["cwd"], target, limit=_FILE_MATCHES_SHOWN + 1, rebuild=True)
+        if not matches:
+            send_message(chat_id, f"❌ No files matching `{target}` found in project.")
             return True
-        # Check file size (Telegram limit: 50MB)
-        file_size = os.path.getsize(file_path)
-        if file_size > 50 * 1024 * 1024:
-            send_message(chat_id, f"❌ File too large ({file_size // (1024*1024)}MB). Telegram limit is 50MB.")
+        if len(matches) == 1:
+            file_path = matches[0]
+        else:
+            # Multiple matches — show list and let user pick
+            many = len(matches) > _FILE_MATCHES_SHOWN
+            lines = [f"Found {f'{_FILE_MATCHES_SHOWN}+' if many else len(matches)} matches:"]
+            for m in matches[:_FILE_MATCHES_SHOWN]:
+                rel = os.path.relpath(m, session["cwd"])
+                lines.append(f"• `{rel}`")
+            if many:
+                lines.append("_...and many more_")
+            lines.append("\nUse the full relative path: `/file <path>`")
+            send_message(chat_id, "\n".join(lines))
             return True
-        # Send as photo if it's an image, otherwise as document
-        image_exts = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"}
+    else:
+        file_path = literal
+    if not os.path.isfile(file_path):
+        send_message(chat_id, f"❌ File not found: `{args.strip()}`")
+        return True
+    # Check file size (Telegram limit: 50MB)
+    file_size = os.path.getsize(file_path)
+    if file_size > 50 * 1024 * 1024:
+        send_message(chat_id, f"❌ File too large ({file_size // (1024*1024)}MB). Telegram limit is 50MB.")
+        return True
+    # Uploads can take many seconds; don't hold up the update loop for them
+    _upload_pool.submit(_send_project_file, chat_id, file_path, file_size)
+    return True
+
+
+def _send_project_file(chat_id, file_path, file_size):
+    """Upload a /file result: as a photo if it's a small image, otherwise as a document."""
+    try:
         ext = os.path.splitext(file_path)[1].lower()
-        if ext in image_exts and file_size < 10 * 1024 * 1024:
+        if ext in _IMAGE_EXTS and file_size < 10 * 1024 * 1024:
             ok = send_photo(chat_id, file_path)
         else:
             ok = send_document(chat_id, file_path)
-        if not ok:
-            send_message(chat_id, f"❌ Failed to send file: `{os.path.basename(file_path)}`")
-        return True
+    except Exception as e:
+        print(f"[/file] upload error for {file_path}: {e}", flush=True)
+        ok = False
+    if not ok:
+        send_message(chat_id, f"❌ Failed to send file: `{os.path.basename(file_path)}`")
+
+
+_FILE_INDEX_SKIP_DIRS = {".git", "node_modules", "__pycache__", ".venv", "venv", ".next", "dist", "build", ".cache", ".tox", "vendor"}
+_FILE_INDEX_TTL = 60  # seconds before a project's /file index is refreshed in the background
+_FILE_INDEX_MAX_FILES = 200000  # stop indexing huge trees here
+_FILE_INDEX_MAX_PROJECTS = 8  # oldest project index is dropped beyond this
+_project_file_index = {}  # cwd -> (built_at, root_mtime, [relpaths], {basename: [relpaths]})
+_project_file_index_refreshing = set()  # cwds with a background rebuild in flight
+
+
+def _scan_project_files(root):
+    """Relative paths of every file under root, skipping junk dirs. Uses os.scandir so
+    DirEntry.is_dir() answers from the readdir data instead of a stat per entry."""
+    rels = []
+    stack = [""]
+    while stack and len(rels) < _FILE_INDEX_MAX_FILES:
+        rel_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, rel_dir)) as it:
+                for entry in it:
+                    rel = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in _FILE_INDEX_SKIP_DIRS:
+                                stack.append(rel)
+                        elif entry.is_file():  # follows file symlinks; skips dir symlinks, fifos, sockets
+                            rels.append(rel)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return rels
 
-    if cmd == "/deepreview":
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
 
-        session_id = get_session_id(session)
-        dr_key = f"{chat_id}:{session_id}"
+def _build_project_file_index(root):
+    try:
+        root_mtime = os.stat(root).st_mtime
+    except OSError:
+        root_mtime = 0
+    rels = _scan_project_files(root)
+    by_name = {}
+    for rel in rels:
+        by_name.setdefault(os.path.basename(rel), []).append(rel)
+    if root not in _project_file_index and len(_project_file_index) >= _FILE_INDEX_MAX_PROJECTS:
+        _project_file_index.pop(next(iter(_project_file_index)), None)
+    _project_file_index[root] = (time.time(), root_mtime, rels, by_name)
+    _project_file_index_refreshing.discard(root)
+    return _project_file_index[root]
 
-        if deepreview_active.get(dr_key, {}).get("active"):
-            send_message(chat_id, "⚠️ Deep review is already running on this session. Use `/cancel` to stop it first.")
-            return True
 
-        jdi_key = dr_key
-        if justdoit_active.get(jdi_key, {}).get("active"):
-            send_message(chat_id, "⚠️ JustDoIt is running on this session. Use `/cancel` to stop it first.")
-            return True
+_FILE_MATCHES_SHOWN = 15  # /file lists this many candidates; matching stops one past it
+_IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"})  # /file sends these as photos
 
-        if session_id in active_processes:
-            send_message(chat_id, "⚠️ Session is busy. Wait for it to finish or `/cancel` first.")
-            return True
 
-        thread = threading.Thread(
-            target=run_deepreview_loop,
-            args=(chat_id, session),
-            daemon=True
-        )
-        thread.start()
-        return True
+def _is_glob(pattern):
+    return any(c in pattern for c in "*?[")
 
-    if cmd == "/justdoit":
-        session = get_active_session(chat_id)
-        if not session:
-            send_message(chat_id, "No active session. Use `/new <project>` first.")
-            return True
 
-        session_id = get_session_id(session)
-        jdi_key = f"{chat_id}:{session_id}"
+@functools.lru_cache(maxsize=256)
+def _glob_re(pattern):
+    """Compiled fnmatch pattern, memoized so repeated /file globs skip translate+compile."""
+    return re.compile(fnmatch.translate(pattern))
 
-        if justdoit_active.get(jdi_key, {}).get("active"):
-            send_message(chat_id, "⚠️ JustDoIt is already running on this session. Use `/cancel` to stop it first.")
-            return True
 
-        if session_id in active_processes:
-            send_message(chat_id, "⚠️ Session is busy. Wait for it to finish or `/cancel` first.")
-            return True
+def invalidate_project_file_index(root):
+    """Drop root's /file index so the next lookup rescans (new session, reset, or files written)."""
+    _project_file_index.pop(root, None)
+
+
+def _find_project_files(root, target, limit=50, rebuild=False):
+    """Absolute paths under root whose relative path is `target` or ends with /`target` (the first `limit`).
+    `target` may be an fnmatch glob (`*.py`, `src/*/test_?.py`); it is only treated as one when
+    nothing matches it literally.
 
-        if args.strip():
-            task = args.strip()
+    Served from a cached per-project index; a stale index (older than _FILE_INDEX_TTL or the
+    project root changed) is still used while a rebuild runs on _bg_pool. rebuild=True rescans now.
+    """
+    cached = _project_file_index.get(root)
+    if cached is None or rebuild:
+        cached = _build_project_file_index(root)
+    else:
+        try:
+            root_mtime = os.stat(root).st_mtime
+        except OSError:
+            root_mtime = 0
+        stale = time.time() - cached[0] > _FILE_INDEX_TTL or root_mtime != cached[1]
+        if stale and root not in _project_file_index_refreshing:
+            _project_file_index_refreshing.add(root)
+            _bg_pool.submit(_build_project_file_index, root)
+    _, _, rels, by_name = cached
+    if os.sep not in target:
+        hits = by_name.get(target, [])
+    else:
+        # A path suffix still ends in an exact basename: only that name's bucket can match
+        suffix = os.sep + target
+        hits = [rel for rel in by_name.get(os.path.basename(target), ())
+                if rel == target or rel.endswith(suffix)]
+    # Names like app/[id]/page.tsx contain glob characters; a literal match wins over the pattern
+    if not hits and _is_glob(target):
+        if os.sep not in target:
+            match = _glob_re(target).match
+            hits = (rel for name in by_name if match(name) for rel in by_name[name])
         else:
-            task = "Continue with the current plan. Review what we've discussed, then implement it fully with proper tests passing and production-ready code."
+            exact, suffix = _glob_re(target).match, _glob_re("*" + os.sep + target).match
+            hits = (rel for rel in rels if exact(rel) or suffix(rel))
+    # Lazy matching: stop scanning as soon as `limit` hits are found
+    return [os.path.join(root, rel) for rel in itertools.islice(hits, limit)]
 
-        thread = threading.Thread(
-            target=run_justdoit_loop,
-            args=(chat_id, task, session),
-            daemon=True
-        )
-        thread.start()
+
+def _cmd_deepreview(chat_id, args):
+    """/deepreview — start the multi-phase review loop."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
         return True
 
-    return False
+    session_id = get_session_id(session)
+    if _refuse_if_loop_running(chat_id, f"{chat_id}:{session_id}", "deepreview"):
+        return True
+
+    if session_id in active_processes:
+        send_message(chat_id, "⚠️ Session is busy. Wait for it to finish or `/cancel` first.")
+        return True
+
+    thread = threading.Thread(
+        target=run_deepreview_loop,
+        args=(chat_id, session),
+        daemon=True
+    )
+    thread.start()
+    return True
+
+
+def _cmd_justdoit(chat_id, args):
+    """/justdoit [task] — start autonomous implementation."""
+    session = get_active_session(chat_id)
+    if not session:
+        send_message(chat_id, "No active session. Use `/new <project>` first.")
+        return True
+
+    session_id = get_session_id(session)
+    if _refuse_if_loop_running(chat_id, f"{chat_id}:{session_id}", "justdoit"):
+        return True
+
+    if session_id in active_processes:
+        send_message(chat_id, "⚠️ Session is busy. Wait for it to finish or `/cancel` first.")
+        return True
+
+    if args.strip():
+        task = args.strip()
+    else:
+        task = "Continue with the current plan. Review what we've discussed, then implement it fully with proper tests passing and production-ready code."
+
+    thread = threading.Thread(
+        target=run_justdoit_loop,
+        args=(chat_id, task, session),
+        daemon=True
+    )
+    thread.start()
+    return True
+
+
+# Command -> handler(chat_id, args). Aliases are extra keys pointing at the same handler.
+COMMAND_TABLE = {
+    "/start": _cmd_start,
+    "/schedule": _cmd_schedule,
+    "/schedules": _cmd_schedules,
+    "/unschedule": _cmd_unschedule,
+    "/help": _cmd_help,
+    "/chatid": _cmd_chatid,
+    "/new": _cmd_new,
+    "/sessions": _cmd_sessions,
+    "/resume": _cmd_resume,
+    "/switch": _cmd_switch,
+    "/delete": _cmd_delete,
+    "/status": _cmd_status,
+    "/end": _cmd_end,
+    "/reset": _cmd_reset,
+    "/reload": _cmd_reload,
+    "/cancel": _cmd_cancel,
+    "/plan": _cmd_plan,
+    "/approve": _cmd_approve,
+    "/yes": _cmd_approve,
+    "/reject": _cmd_reject,
+    "/no": _cmd_reject,
+    "/omni": _cmd_omni,
+    "/o": _cmd_omni,
+    "/claude": _cmd_claude,
+    "/c": _cmd_claude,
+    "/cl": _cmd_claude,
+    "/codex": _cmd_codex,
+    "/gemini": _cmd_gemini,
+    "/gem": _cmd_gemini,
+    "/g": _cmd_gemini,
+    "/init": _cmd_init,
+    "/file": _cmd_file,
+    "/f": _cmd_file,
+    "/deepreview": _cmd_deepreview,
+    "/justdoit": _cmd_justdoit,
+}
+
+
+def handle_command(chat_id, text):
+    """Handle bot commands. Returns True if handled."""
+    parts = text.split(maxsplit=1)
+    handler = COMMAND_TABLE.get(parts[0].lower())
+    if handler is None:
+        return False
+    handled = handler(chat_id, parts[1] if len(parts) > 1 else "")
+    flush_pending_outbox(chat_id)  # a command's replies go out together, before the next update is handled
+    return handled
 
 
 def handle_callback_query(callback_query):
@@ -6323,8 +7354,12 @@ def handle_callback_query(callback_query):
                     sid = get_session_id(s)
                     session_locks.pop(sid, None)
                     message_queue.pop(sid, None)
+                    _last_queue_ack.pop(sid, None)
+                    _queue_ack_locks.pop(sid, None)
+                    _session_name_index.pop(chat_key, None)
+                _session_by_id.pop(chat_key, None)
                 user_sessions[chat_key] = {"sessions": [], "active": None}
-                save_sessions(force=True)
+                save_sessions(soon=True)
                 send_message(chat_id, "🗑️ All sessions deleted.")
                 return
 
@@ -6341,7 +7376,11 @@ def handle_callback_query(callback_query):
                 sessions.pop(idx)
                 session_locks.pop(sid, None)
                 message_queue.pop(sid, None)
-                save_sessions(force=True)
+                _last_queue_ack.pop(sid, None)
+                _queue_ack_locks.pop(sid, None)
+                _session_by_id.get(chat_key, {}).pop(sid, None)
+                _session_name_index.pop(chat_key, None)
+                save_sessions(soon=True)
                 send_message(chat_id, f"🗑️ Deleted session `{deleted_name}`")
                 return
 
@@ -6388,27 +7427,7 @@ def handle_callback_query(callback_query):
                         send_pending_question(chat_id, pending)
                     else:
                         # All questions answered - build combined answer and send to Claude
-                        answers = pending["answers"]
-                        pending_questions.pop(chat_key, None)
-
-                        # Build answer text from all responses
-                        if len(answers) == 1:
-                            answer_text = answers[0]
-                        else:
-                            parts = []
-                            for i in range(len(answers)):
-                                q_header = questions[i].get("header", f"Q{i+1}")
-                                parts.append(f"{q_header}: {answers[i]}")
-                            answer_text = "\n".join(parts)
-
-                        # Send to Claude non-blocking with streaming
-                        if session:
-                            s_id = get_session_id(session)
-                            s_lock = get_session_lock(s_id)
-                            with s_lock:
-                                active_processes[s_id] = None
-                                _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
-                            run_claude_in_thread(chat_id, answer_text, session)
+                        _finalize_pending_answers(chat_id, pending, session)
                     return
         except (ValueError, IndexError):
             pass
@@ -6520,15 +7539,13 @@ def process_message_queue(chat_id, session=None):
         return
 
     session_id = get_session_id(session)
-    lock = get_session_lock(session_id)
-    with lock:
-        if message_queue.get(session_id):
-            queued_text = message_queue[session_id].pop(0)
-            # Mark as active under lock before launching thread
-            active_processes[session_id] = None
-            _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
-        else:
+    with get_session_lock(session_id):
+        # A new message may have claimed the session first; it drains the queue when it finishes
+        queue = message_queue.get(session_id)
+        if not queue or not _claim_session(session_id):
             return
+        queued_text = queue.popleft()
+    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
 
     # Dispatch to the appropriate CLI based on session's last_cli (sticky routing)
     last_cli = session.get("last_cli", "Claude")
@@ -6540,6 +7557,25 @@ def process_message_queue(chat_id, session=None):
         run_claude_in_thread(chat_id, queued_text, session)
 
 
+def _send_queue_ack(chat_id, session_id, session_name, queue_pos):
+    """Tell the user a message was queued. A burst of queued messages updates one notice in place
+    rather than sending one per message. Only this session's notices wait on the Telegram call."""
+    with _queue_ack_lock:
+        lock = _queue_ack_locks.setdefault(session_id, threading.Lock())
+    with lock:
+        sent_at, message_id, last_pos = _last_queue_ack.get(session_id, (0, None, 0))
+        if message_id and time.time() - sent_at < _QUEUE_ACK_COALESCE_SECS:
+            queue_pos = max(queue_pos, last_pos)  # ack threads can finish out of order
+        else:
+            message_id = None
+        text = f"📋 _Message queued (#{queue_pos}) for session `{session_name}`. Will process after current task._"
+        if message_id:
+            edit_message(chat_id, message_id, text, force=True)
+        else:
+            message_id = send_message(chat_id, text)
+        _last_queue_ack[session_id] = (time.time(), message_id, queue_pos)
+
+
 def handle_message(chat_id, text, session=None):
     """Handle a regular message. If session is provided, use it instead of the active session."""
     chat_key = str(chat_id)
@@ -6579,25 +7615,7 @@ def handle_message(chat_id, text, session=None):
             send_pending_question(chat_id, pending)
         else:
             # All questions answered - send combined answer to Claude
-            answers = pending["answers"]
-            pending_questions.pop(chat_key, None)
-
-            if len(answers) == 1:
-                answer_text = answers[0]
-            else:
-                parts = []
-                for i in range(len(answers)):
-                    q_header = questions[i].get("header", f"Q{i+1}") if i < len(questions) else f"Q{i+1}"
-                    parts.append(f"{q_header}: {answers[i]}")
-                answer_text = "\n".join(parts)
-
-            if session:
-                session_id = get_session_id(session)
-                lock = get_session_lock(session_id)
-                with lock:
-                    active_processes[session_id] = None
-                    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
-                run_claude_in_thread(chat_id, answer_text, session)
+            _finalize_pending_answers(chat_id, pending, session)
         return
 
     # Get active session (unless already provided)
@@ -6606,23 +7624,9 @@ def handle_message(chat_id, text, session=None):
     session_id = get_session_id(session) if session else str(chat_id)
     print(f"[handle_message] session={session.get('name') if session else None}, last_cli={session.get('last_cli') if session else None}, id={id(session) if session else None}", flush=True)
 
-    # Atomically check if Claude is running and either queue or launch
-    lock = get_session_lock(session_id)
-    with lock:
-        if session_id in active_processes:
-            # Queue the message for this session
-            if session_id not in message_queue:
-                message_queue[session_id] = []
-            message_queue[session_id].append(text)
-            queue_pos = len(message_queue[session_id])
-            session_name = session.get("name", "default") if session else "default"
-            # Send notification outside the lock to avoid blocking other threads on slow TG API
-            threading.Thread(target=send_message, args=(chat_id,
-                f"📋 _Message queued (#{queue_pos}) for session `{session_name}`. Will process after current task._"),
-                daemon=True).start()
-            return
-
-        # Check memory pressure before launching new Claude process
+    # Check memory pressure before launching new Claude process. Done before claiming, so a refusal
+    # never holds the session; a busy session still just queues the message.
+    if session_id not in active_processes:
         mem_ok, avail_mb = check_memory_pressure()
         if not mem_ok:
             n_active = len(active_processes)
@@ -6631,9 +7635,16 @@ def handle_message(chat_id, text, session=None):
             print(f"[MEMORY] Refused new session: {avail_mb:.0f} MB available, {n_active} active", flush=True)
             return
 
-        # Mark as active immediately under the lock to prevent races
-        active_processes[session_id] = None  # placeholder until real process starts
-        _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
+    # Atomically claim the session, or queue behind the task already running on it
+    text, queue_pos = _claim_or_queue(session_id, text)
+    if text is None:
+        session_name = session.get("name", "default") if session else "default"
+        # Send notification on its own thread to avoid blocking the poll loop on slow TG API
+        threading.Thread(target=_send_queue_ack, args=(chat_id, session_id, session_name, queue_pos),
+                         daemon=True).start()
+        return
+
+    _ws_broadcast(chat_id, "status", {"mode": "busy", "active": True})
 
     # Dispatch to the appropriate CLI runner based on session state
     last_cli = session.get("last_cli", "Claude") if session else "Claude"
@@ -6688,6 +7699,30 @@ def _reinit_api_refs():
 _reload_requested = False
 
 
+_BOT_COMMANDS = (  # Telegram menu entries, registered by startup() when they differ from what's set
+    ("new", "Start new session - /new <project>"),
+    ("resume", "Pick a session to resume"),
+    ("sessions", "List all sessions"),
+    ("status", "Show current session info"),
+    ("plan", "Enter plan mode"),
+    ("approve", "Approve current plan"),
+    ("reject", "Reject current plan"),
+    ("cancel", "Cancel current task"),
+    ("justdoit", "Autonomous implementation mode"),
+    ("omni", "Unified Engineering Task"),
+    ("claude", "Run Claude task"),
+    ("codex", "Run Codex task"),
+    ("gemini", "Run Gemini task"),
+    ("schedule", "Schedule a task"),
+    ("schedules", "List scheduled tasks"),
+    ("file", "Download a file - /file <path>"),
+    ("reset", "Clear conversation history"),
+    ("delete", "Delete a session"),
+    ("init", "Run claude init"),
+    ("help", "Show help"),
+)
+
+
 def startup():
     """Initialize the bot: load state, register commands, start API server.
 
@@ -6700,33 +7735,19 @@ def startup():
 
     # Register bot commands for the Telegram menu button
     try:
-        commands = [
-            {"command": "new", "description": "Start new session - /new <project>"},
-            {"command": "resume", "description": "Pick a session to resume"},
-            {"command": "sessions", "description": "List all sessions"},
-            {"command": "status", "description": "Show current session info"},
-            {"command": "plan", "description": "Enter plan mode"},
-            {"command": "approve", "description": "Approve current plan"},
-            {"command": "reject", "description": "Reject current plan"},
-            {"command": "cancel", "description": "Cancel current task"},
-            {"command": "justdoit", "description": "Autonomous implementation mode"},
-            {"command": "omni", "description": "Unified Engineering Task"},
-            {"command": "claude", "description": "Run Claude task"},
-            {"command": "codex", "description": "Run Codex task"},
-            {"command": "gemini", "description": "Run Gemini task"},
-            {"command": "schedule", "description": "Schedule a task"},
-            {"command": "schedules", "description": "List scheduled tasks"},
-            {"command": "file", "description": "Download a file - /file <path>"},
-            {"command": "reset", "description": "Clear conversation history"},
-            {"command": "delete", "description": "Delete a session"},
-            {"command": "init", "description": "Run claude init"},
-            {"command": "help", "description": "Show help"},
-        ]
-        resp = requests.post(f"{API_URL}/setMyCommands", json={"commands": commands}, timeout=10)
-        if resp.json().get("ok"):
-            print("Bot menu commands registered.")
+        commands = [{"command": c, "description": d} for c, d in _BOT_COMMANDS]
+        try:
+            current = _tg_session.get(f"{API_URL}/getMyCommands", timeout=10).json().get("result")
+        except Exception:
+            current = None  # couldn't compare — register anyway
+        if current == commands:
+            print("Bot menu commands unchanged.")
         else:
-            print(f"Failed to register commands: {resp.json().get('description')}")
+            resp = _tg_session.post(f"{API_URL}/setMyCommands", json={"commands": commands}, timeout=10)
+            if resp.json().get("ok"):
+                print("Bot menu commands registered.")
+            else:
+                print(f"Failed to register commands: {resp.json().get('description')}")
     except Exception as e:
         print(f"Error registering commands: {e}")
 
@@ -6736,23 +7757,28 @@ def startup():
 
     # Start memory monitor thread
     def memory_monitor():
+        try:
+            statm_fd = os.open("/proc/self/statm", os.O_RDONLY)
+            page_mb = os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+        except (OSError, ValueError, AttributeError):
+            statm_fd = None
+
         def get_rss_mb():
-            """Get current RSS in MB from /proc/self/status."""
+            """Current RSS in MB: one pread of the already-open /proc/self/statm (resident pages is field 2).
+            getrusage's ru_maxrss would be cheaper still but is a high-water mark, useless after a trim."""
+            if statm_fd is None:
+                return 0
             try:
-                with open("/proc/self/status") as f:
-                    for l in f:
-                        if l.startswith("VmRSS:"):
-                            return int(l.split()[1]) / 1024
-            except Exception:
-                pass
-            return 0
+                return int(os.pread(statm_fd, 128, 0).split()[1]) * page_mb
+            except (OSError, ValueError, IndexError):
+                return 0
 
         while True:
             try:
                 rss_mb = get_rss_mb()
                 if rss_mb > 500:
                     print(f"[MEMORY] RSS: {rss_mb:.0f} MB, active_processes: {len(active_processes)}, "
-                          f"justdoit: {len([k for k,v in justdoit_active.items() if v.get('active')])}, "
+                          f"justdoit: {sum(1 for v in justdoit_active.values() if v.get('active'))}, "
                           f"threads: {threading.active_count()}", flush=True)
                 if rss_mb > 2000:
                     print(f"[MEMORY] WARNING: RSS exceeds 2GB ({rss_mb:.0f} MB)! "
@@ -6769,9 +7795,19 @@ def startup():
                 _flush_sessions_if_dirty()
             except Exception:
                 pass
+            try:
+                _sweep_stale_state()
+            except Exception as e:
+                print(f"[Sweep] error: {e}", flush=True)
             time.sleep(30)
 
     threading.Thread(target=memory_monitor, daemon=True).start()
+    threading.Thread(target=_active_tasks_flusher, daemon=True).start()
+    atexit.register(_flush_active_tasks_if_dirty)
+    threading.Thread(target=_active_sessions_flusher, daemon=True).start()
+    atexit.register(_flush_active_sessions)
+    threading.Thread(target=_sessions_flusher, daemon=True).start()
+    atexit.register(_flush_sessions_if_dirty)
 
     # Start HTTP API + WebSocket server on Tailscale interface
     global _api_module
@@ -6811,7 +7847,6 @@ def startup():
         _api_module = api_server  # Enable WS broadcast from send_message/edit_message
     except Exception as e:
         print(f"API server failed to start: {e}", flush=True)
-        import traceback
         traceback.print_exc()
 
     # Start scheduled task checker
@@ -6824,8 +7859,10 @@ if __name__ == "__main__":
     startup()
     print("WARNING: Running bot.py directly. Use loader.py for hot-reload support.", flush=True)
 
-    signal.signal(signal.SIGTERM, lambda s, f: (save_sessions(force=True), os._exit(0)))
-    signal.signal(signal.SIGINT, lambda s, f: (save_sessions(force=True), os._exit(0)))
+    signal.signal(signal.SIGTERM, lambda s, f: (save_sessions(force=True), _flush_active_tasks_if_dirty(),
+                                                _flush_active_sessions(), os._exit(0)))
+    signal.signal(signal.SIGINT, lambda s, f: (save_sessions(force=True), _flush_active_tasks_if_dirty(),
+                                               _flush_active_sessions(), os._exit(0)))
 
     while True:
         updates = get_updates(last_update_id + 1)
@@ -6862,5 +7899,5 @@ if __name__ == "__main__":
                     continue
                 handle_message(chat_id, text)
             except Exception as e:
-                print(f"Error processing update: {e}", flush=True)
-        time.sleep(1)
+                print(f"Error processing update {update.get('update_id')}: {e}", flush=True)
+                traceback.print_exc()
@@ -12,10 +12,8 @@ Usage:
 """
 
 import importlib
-import os
 import signal
 import sys
-import time
 import traceback
 
 import bot
@@ -26,8 +24,9 @@ _STATE_KEYS = [
     # Telegram poll cursor
     "last_update_id",
     # Session and process state
-    "user_sessions", "pending_questions", "active_processes",
+    "user_sessions", "_session_by_id", "_session_name_index", "pending_questions", "active_processes",
     "message_queue", "cancelled_sessions", "user_feedback_queue",
+    "_last_queue_ack", "_queue_ack_locks", "_queue_ack_lock",
     # Autonomous task state
     "justdoit_active", "deepreview_active", "omni_active",
     # Scheduled tasks
@@ -35,8 +34,18 @@ _STATE_KEYS = [
     # Threading locks (must survive to prevent races)
     "session_locks", "session_locks_lock",
     "_sessions_file_lock", "_active_sessions_lock",
+    # Running-session crash-recovery record (the flusher thread waits on this exact Event)
+    "_active_sessions", "_active_sessions_dirty",
     # Debounce state
-    "_save_sessions_last", "_save_sessions_dirty",
+    "_save_sessions_last", "_save_sessions_dirty", "_sessions_save_due",
+    # Active-tasks write coalescing (the flusher thread waits on this exact Event)
+    "_tasks_dirty", "_active_tasks_lock",
+    # Telegram outbox (one sender thread must keep owning the same queue)
+    "_outbox", "_outbox_cond", "_outbox_pending", "_outbox_thread", "_outbox_flush_now",
+    # Stale-entry sweeper bookkeeping
+    "_stale_since",
+    # Provider rate-limit deadlines (shared across loops)
+    "_quota_until",
     # Telegram poll backoff
     "_tg_poll_failures",
     # API module reference
@@ -71,6 +80,9 @@ def _hot_reload(source="SIGHUP"):
     for key, val in state.items():
         setattr(bot, key, val)
 
+    # Derived indexes are rebuilt from the restored sessions, so a changed index layout is picked up
+    bot._rebuild_session_index()
+
     # Reload api.py and transplant new routes onto the running FastAPI app
     _reload_api()
 
@@ -163,7 +175,7 @@ def _graceful_shutdown(signum, frame):
     print(f"[Loader] Received signal {signum}, shutting down...", flush=True)
     for key, proc in list(bot.active_processes.items()):
         try:
-            os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+            bot.kill_process_group(proc, signal.SIGTERM)
             print(f"[Loader] Terminated process {proc.pid} ({key})", flush=True)
         except Exception:
             pass
@@ -274,8 +286,7 @@ def main():
             except Exception as e:
                 print(f"Error processing update {update.get('update_id')}: {e}", flush=True)
                 traceback.print_exc()
-
-        time.sleep(1)
+        # No sleep here: getUpdates long-polls (timeout=30) and backs off on errors itself
 
 
 if __name__ == "__main__":
@@ -0,0 +1,715 @@
+"""Tests for bot.py helpers behind sessions, loops and /file.
+
+Covers:
+1. find_session_index_by_name — exact match, prefix tie-break, cache invalidation
+2. Session lookup by id — per-chat index kept in sync on create and delete
+3. _claim_or_queue — claim, queue, and claim after the session went idle
+4. Answers to Claude's questions — joining, and claiming the session to send them
+5. _TAG_RE — QUOTA/PHASE/VERIFY reasoning tags
+6. _quota_reasoning / _handle_quota_wait — shared QUOTA parsing
+7. ReviewLog — memoized text, tail() and last()
+8. _find_project_files — cached per-project /file index
+9. /file — literal paths with [..] before glob matching
+10. StatusThrottler — edit the last status message or send a new one
+11. send_message_nowait — queued notices coalesce and stay ahead of send_message
+12. flush_pending_outbox — push queued notices out on demand
+13. backoff_sleep — jittered exponential backoff that /cancel cuts short
+14. _codex_exec_capture — streamed Codex output with early stop and timeout
+15. /cancel — Codex calls in justdoit and deepreview are killed
+16. _sweep_stale_state — dead entries dropped only after _STALE_STATE_SECS
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+_bot_mod = None
+
+
+def _get_bot():
+    """Lazy-load bot module."""
+    global _bot_mod
+    if _bot_mod:
+        return _bot_mod
+    import bot
+    _bot_mod = bot
+    return bot
+
+
+# ──────────────────────────────────────────────────────────
+# 1. Session name lookup
+# ──────────────────────────────────────────────────────────
+
+class TestFindSessionIndexByName(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        self.sessions = [{"name": "api-v2"}, {"name": "web"}, {"name": "API"}, {"name": "apix"}]
+        patcher = patch.dict(self.bot.user_sessions, {"42": {"sessions": self.sessions}}, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bot._session_name_index.pop("42", None)
+        self.addCleanup(self.bot._session_name_index.pop, "42", None)
+
+    def test_exact_match_beats_earlier_prefix(self):
+        self.assertEqual(self.bot.find_session_index_by_name(42, "api"), 2)
+
+    def test_case_insensitive(self):
+        self.assertEqual(self.bot.find_session_index_by_name(42, "WEB"), 1)
+
+    def test_prefix_picks_first_in_list(self):
+        self.assertEqual(self.bot.find_session_index_by_name(42, "ap"), 0)
+
+    def test_no_match(self):
+        self.assertIsNone(self.bot.find_session_index_by_name(42, "zzz"))
+        self.assertIsNone(self.bot.find_session_index_by_name(7, "api"))
+
+    def test_cache_follows_appended_session(self):
+        self.assertIsNone(self.bot.find_session_index_by_name(42, "docs"))
+        self.sessions.append({"name": "docs"})
+        self.assertEqual(self.bot.find_session_index_by_name(42, "docs"), 4)
+
+
+# ──────────────────────────────────────────────────────────
+# 2. Session lookup by id
+# ──────────────────────────────────────────────────────────
+
+class TestSessionById(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        # Legacy sessions are identified by cwd, which two chats can share
+        self.a = {"name": "a", "cwd": "/srv/app"}
+        self.b = {"name": "b", "cwd": "/srv/app"}
+        for d, value in ((self.bot.user_sessions, {
+                "1": {"sessions": [self.a], "active": None},
+                "2": {"sessions": [self.b], "active": None},
+            }), (self.bot._session_by_id, {}), (self.bot._session_name_index, {})):
+            patcher = patch.dict(d, value, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.bot._rebuild_session_index()
+
+    def test_index_is_per_chat(self):
+        self.assertIs(self.bot.get_session_by_id(1, "/srv/app"), self.a)
+        self.assertIs(self.bot.get_session_by_id(2, "/srv/app"), self.b)
+        self.assertIsNone(self.bot.get_session_by_id(3, "/srv/app"))
+
+    def test_update_cli_session_id_stays_in_chat(self):
+        with patch.object(self.bot, "save_sessions"):
+            s = self.bot.update_cli_session_id(1, self.a, "Claude", "sid-1")
+        self.assertIs(s, self.a)
+        self.assertEqual(self.a["claude_session_id"], "sid-1")
+        self.assertNotIn("claude_session_id", self.b)
+
+    def test_create_session_is_indexed(self):
+        with patch.object(self.bot, "save_sessions"):
+            s = self.bot.create_session(1, "other", "/srv/other")
+        self.assertIs(self.bot.get_session_by_id(1, s["id"]), s)
+        self.assertIsNone(self.bot.get_session_by_id(2, s["id"]))
+
+    def test_delete_drops_queue_ack_state(self):
+        with patch.dict(self.bot._last_queue_ack, {"/srv/app": (0, 5, 1)}), \
+                patch.dict(self.bot._queue_ack_locks, {"/srv/app": object()}), \
+                patch.object(self.bot, "send_message"), patch.object(self.bot, "save_sessions"):
+            self.bot.handle_command(1, "/delete a")
+            self.assertNotIn("/srv/app", self.bot._last_queue_ack)
+            self.assertNotIn("/srv/app", self.bot._queue_ack_locks)
+
+    def test_delete_leaves_other_chat_indexed(self):
+        with patch.object(self.bot, "send_message"), patch.object(self.bot, "save_sessions"):
+            self.bot.handle_command(1, "/delete a")
+        self.assertIsNone(self.bot.get_session_by_id(1, "/srv/app"))
+        self.assertIs(self.bot.get_session_by_id(2, "/srv/app"), self.b)
+
+
+# ──────────────────────────────────────────────────────────
+# 3. Session claims and the message queue
+# ──────────────────────────────────────────────────────────
+
+class TestClaimOrQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        for d in (self.bot.active_processes, self.bot.message_queue):
+            patcher = patch.dict(d, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_first_claim_runs(self):
+        self.assertEqual(self.bot._claim_or_queue("s1", "hello"), ("hello", 0))
+        self.assertIn("s1", self.bot.active_processes)
+
+    def test_second_message_queues_while_starting(self):
+        self.bot._claim_or_queue("s1", "first")
+        self.assertEqual(self.bot._claim_or_queue("s1", "second"), (None, 1))
+        self.assertEqual(self.bot._claim_or_queue("s1", "third"), (None, 2))
+        self.assertEqual(list(self.bot.message_queue["s1"]), ["second", "third"])
+
+    def test_sessions_are_independent(self):
+        self.bot._claim_or_queue("s1", "a")
+        self.assertEqual(self.bot._claim_or_queue("s2", "b"), ("b", 0))
+
+    def test_idle_session_runs_oldest_queued(self):
+        self.bot._claim_or_queue("s1", "first")
+        self.bot._claim_or_queue("s1", "second")
+        self.bot.active_processes.pop("s1")
+        # The claim succeeds on retry, so the oldest queued message runs and the new one waits
+        with patch.object(self.bot, "_claim_session", side_effect=[False, True]):
+            self.assertEqual(self.bot._claim_or_queue("s1", "third"), ("second", 0))
+        self.assertEqual(list(self.bot.message_queue["s1"]), ["third"])
+
+
+class TestHandleMessageLowMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        for d in (self.bot.active_processes, self.bot.message_queue, self.bot.pending_questions):
+            patcher = patch.dict(d, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.session = {"id": "s1", "name": "s1", "cwd": "/tmp"}
+        for name, value in (("check_memory_pressure", lambda: (False, 100)), ("send_message", None),
+                            ("_send_queue_ack", None), ("run_claude_in_thread", None)):
+            patcher = patch.object(self.bot, name, value) if value else patch.object(self.bot, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_refusal_leaves_session_unclaimed(self):
+        self.bot.handle_message(1, "hi", session=self.session)
+        self.assertNotIn("s1", self.bot.active_processes)
+        self.assertNotIn("s1", self.bot.message_queue)
+        self.bot.run_claude_in_thread.assert_not_called()
+
+    def test_busy_session_still_queues(self):
+        self.bot._claim_session("s1")
+        self.bot.handle_message(1, "later", session=self.session)
+        self.assertEqual(list(self.bot.message_queue["s1"]), ["later"])
+
+
+# ──────────────────────────────────────────────────────────
+# 4. Combined answers to Claude's questions
+# ──────────────────────────────────────────────────────────
+
+class TestJoinPendingAnswers(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+
+    def test_single_answer_is_sent_bare(self):
+        self.assertEqual(self.bot._join_pending_answers({"answers": ["yes"], "headers": ["Q"]}), "yes")
+
+    def test_headers(self):
+        pending = {"answers": ["Postgres", "no"], "headers": ["DB", "Cache"]}
+        self.assertEqual(self.bot._join_pending_answers(pending), "DB: Postgres\nCache: no")
+
+    def test_missing_header_falls_back_to_number(self):
+        pending = {"answers": ["a", "b"], "headers": ["First"]}
+        self.assertEqual(self.bot._join_pending_answers(pending), "First: a\nQ2: b")
+
+    def test_legacy_state_reads_question_headers(self):
+        pending = {"answers": ["a", "b"], "questions": [{"header": "Lang"}, {"question": "?"}]}
+        self.assertEqual(self.bot._join_pending_answers(pending), "Lang: a\nQ2: b")
+
+
+class TestFinalizePendingAnswers(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        for d in (self.bot.active_processes, self.bot.message_queue, self.bot.pending_questions):
+            patcher = patch.dict(d, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in ("run_claude_in_thread", "_send_queue_ack", "_ws_broadcast"):
+            patcher = patch.object(self.bot, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.session = {"id": "s1", "name": "s1", "cwd": "/tmp"}
+        self.pending = {"answers": ["yes"], "headers": ["Q"]}
+        self.bot.pending_questions["1"] = self.pending
+
+    def test_idle_session_runs_answer(self):
+        self.bot._finalize_pending_answers(1, self.pending, self.session)
+        self.bot.run_claude_in_thread.assert_called_once_with(1, "yes", self.session)
+        self.assertIn("s1", self.bot.active_processes)
+        self.assertNotIn("1", self.bot.pending_questions)
+
+    def test_busy_session_queues_answer(self):
+        self.bot._claim_session("s1")
+        holder = self.bot.active_processes["s1"]
+        self.bot._finalize_pending_answers(1, self.pending, self.session)
+        self.bot.run_claude_in_thread.assert_not_called()
+        self.assertIs(self.bot.active_processes["s1"], holder)
+        self.assertEqual(list(self.bot.message_queue["s1"]), ["yes"])
+
+
+# ──────────────────────────────────────────────────────────
+# 5. Codex reasoning tags
+# ──────────────────────────────────────────────────────────
+
+class TestTagRe(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+
+    def test_quota(self):
+        m = self.bot._TAG_RE.match("QUOTA:15 Codex error — usage limit")
+        self.assertEqual(m.groups(), ("QUOTA", "15", "Codex error — usage limit"))
+
+    def test_phase_and_verify(self):
+        self.assertEqual(self.bot._TAG_RE.match("PHASE:testing").group(1, 2), ("PHASE", "testing"))
+        self.assertEqual(self.bot._TAG_RE.match("VERIFY: reviewing").group(1, 2), ("VERIFY", "reviewing"))
+
+    def test_details_span_lines(self):
+        m = self.bot._TAG_RE.match("QUOTA:5 first\nsecond")
+        self.assertEqual(m.group(3), "first\nsecond")
+
+    def test_rejects_untagged(self):
+        self.assertIsNone(self.bot._TAG_RE.match("Continue implementing. PHASE:done"))
+        self.assertIsNone(self.bot._TAG_RE.match("Codex error: boom"))
+
+
+# ──────────────────────────────────────────────────────────
+# 6. QUOTA reasoning
+# ──────────────────────────────────────────────────────────
+
+class TestQuotaReasoning(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+
+    def test_minutes_and_details(self):
+        self.assertEqual(self.bot._quota_reasoning("QUOTA:30\nlimit hit"), "QUOTA:30 limit hit")
+
+    def test_defaults(self):
+        self.assertEqual(self.bot._quota_reasoning("QUOTA:soon"), "QUOTA:60 no details")
+        self.assertEqual(self.bot._quota_reasoning("QUOTA:0\nx"), "QUOTA:1 x")
+
+    def test_round_trips_through_tag_re(self):
+        m = self.bot._TAG_RE.match(self.bot._quota_reasoning("QUOTA:12\nrate limited"))
+        self.assertEqual(m.groups(), ("QUOTA", "12", "rate limited"))
+
+    def test_handle_quota_wait_records_provider_deadline(self):
+        with patch.dict(self.bot._quota_until, clear=True), patch.object(self.bot, "send_message"):
+            ok = self.bot._handle_quota_wait("QUOTA:2 Codex error — limit", 1, "1:s", lambda key, secs: True, "Test")
+            self.assertTrue(ok)
+            self.assertIn("codex", self.bot._quota_until)
+            self.assertNotIn("claude", self.bot._quota_until)
+
+
+# ──────────────────────────────────────────────────────────
+# 7. ReviewLog
+# ──────────────────────────────────────────────────────────
+
+class TestReviewLog(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        self.log = self.bot.ReviewLog()
+        self.log.append("Claude review", "a" * 50)
+        self.log.append("Codex cross-review", "b" * 50)
+
+    def test_tail_matches_text_suffix(self):
+        for n in (10, 60, 80, 1000):
+            self.assertEqual(self.log.tail(n), self.log.text()[-n:])
+
+    def test_memo_refreshes_after_append(self):
+        self.log.tail(20)
+        self.log.text()
+        self.log.append("Claude review", "c" * 5)
+        self.assertTrue(self.log.tail(20).endswith("ccccc"))
+        self.assertTrue(self.log.text().endswith("ccccc"))
+
+    def test_last(self):
+        self.log.append("Claude review", "second")
+        self.assertEqual(self.log.last("Claude"), "second")
+        self.assertIsNone(self.log.last("Gemini"))
+
+    def test_max_chars_drops_oldest(self):
+        log = self.bot.ReviewLog(max_chars=100)
+        log.append("one", "x" * 60)
+        log.append("two", "y" * 60)
+        self.assertIsNone(log.last("one"))
+        self.assertEqual(log.last("two"), "y" * 60)
+
+    def test_max_chars_keeps_newest_even_if_oversized(self):
+        log = self.bot.ReviewLog(max_chars=10)
+        log.append("big", "z" * 50)
+        self.assertEqual(log.last("big"), "z" * 50)
+
+
+# ──────────────────────────────────────────────────────────
+# 8. /file lookups
+# ──────────────────────────────────────────────────────────
+
+class TestFindProjectFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(self.bot.invalidate_project_file_index, self.root)
+        for rel in ("main.py", "src/main.py", "src/util.py", "node_modules/pkg/main.py"):
+            path = os.path.join(self.root, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+    def find(self, target, **kwargs):
+        return sorted(os.path.relpath(p, self.root) for p in self.bot._find_project_files(self.root, target, **kwargs))
+
+    def test_basename_skips_junk_dirs(self):
+        self.assertEqual(self.find("main.py"), ["main.py", "src/main.py"])
+
+    def test_path_suffix(self):
+        self.assertEqual(self.find("src/main.py"), ["src/main.py"])
+        self.assertEqual(self.find("rc/main.py"), [])
+
+    def test_glob(self):
+        self.assertEqual(self.find("*.py"), ["main.py", "src/main.py", "src/util.py"])
+        self.assertEqual(self.find("src/u*.py"), ["src/util.py"])
+
+    def test_limit(self):
+        self.assertEqual(len(self.find("*.py", limit=1)), 1)
+
+    def test_cached_index_until_rebuild(self):
+        self.assertEqual(self.find("new.py"), [])
+        open(os.path.join(self.root, "src", "new.py"), "w").close()
+        self.assertEqual(self.find("new.py", rebuild=True), ["src/new.py"])
+
+
+# ──────────────────────────────────────────────────────────
+# 9. /file paths containing glob characters
+# ──────────────────────────────────────────────────────────
+
+class TestFileLiteralPaths(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(self.bot.invalidate_project_file_index, self.root)
+        for rel in ("app/[id]/page.tsx", "app/i/page.tsx"):
+            path = os.path.join(self.root, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+    def find(self, target):
+        return [os.path.relpath(p, self.root) for p in self.bot._find_project_files(self.root, target)]
+
+    def test_literal_match_wins_over_glob(self):
+        self.assertEqual(self.find("app/[id]/page.tsx"), ["app/[id]/page.tsx"])
+        self.assertEqual(self.find("[id]/page.tsx"), ["app/[id]/page.tsx"])
+
+    def test_glob_when_nothing_matches_literally(self):
+        self.assertEqual(self.find("app/[i]/page.tsx"), ["app/i/page.tsx"])
+
+    def test_cmd_file_sends_existing_path_as_typed(self):
+        with patch.object(self.bot, "get_active_session", return_value={"cwd": self.root}), \
+                patch.object(self.bot, "send_message") as send, \
+                patch.object(self.bot._upload_pool, "submit") as submit:
+            self.bot._cmd_file(1, "app/[id]/page.tsx")
+        send.assert_not_called()
+        self.assertEqual(submit.call_args[0][2], os.path.join(self.root, "app/[id]/page.tsx"))
+
+
+# ──────────────────────────────────────────────────────────
+# 10. StatusThrottler
+# ──────────────────────────────────────────────────────────
+
+class TestStatusThrottler(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        patcher = patch.dict(self.bot._last_sent_id, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ids = iter(range(100, 200))
+
+        def fake_send(chat_id, text, **kwargs):
+            message_id = next(self.ids)
+            self.bot._last_sent_id[str(chat_id)] = message_id
+            return message_id
+
+        for name, kwargs in (("send_message", {"side_effect": fake_send}), ("edit_message", {})):
+            patcher = patch.object(self.bot, name, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_burst_edits_one_message(self):
+        status = self.bot.StatusThrottler(1)
+        self.assertEqual(status.push("one"), 100)
+        self.assertEqual(status.push("two"), 100)
+        self.bot.send_message.assert_called_once()
+        self.bot.edit_message.assert_called_once_with(1, 100, "one\n\ntwo", force=True)
+
+    def test_sends_after_window(self):
+        status = self.bot.StatusThrottler(1, window=0)
+        status.push("one")
+        self.assertEqual(status.push("two"), 101)
+        self.bot.edit_message.assert_not_called()
+
+    def test_sends_when_no_longer_newest_message(self):
+        status = self.bot.StatusThrottler(1)
+        status.push("one")
+        self.bot._last_sent_id["1"] = 555  # something else was posted in between
+        self.assertEqual(status.push("two"), 101)
+        self.bot.edit_message.assert_not_called()
+
+    def test_sends_when_edit_would_be_too_long(self):
+        status = self.bot.StatusThrottler(1)
+        status.push("x" * 3000)
+        self.assertEqual(status.push("y" * 1000), 101)
+
+    def test_dropped_after_cancel(self):
+        status = self.bot.StatusThrottler(1, state={"active": False})
+        self.assertIsNone(status.push("one"))
+        self.bot.send_message.assert_not_called()
+
+
+# ──────────────────────────────────────────────────────────
+# 11. Outbox ordering
+# ──────────────────────────────────────────────────────────
+
+def _fake_telegram(case):
+    """Patch the Telegram session and WS broadcast for `case`; returns the list of sent texts."""
+    sent = []
+
+    def post(url, json=None, **kwargs):
+        sent.append(json["text"])
+        resp = MagicMock()
+        resp.json.return_value = {"ok": True, "result": {"message_id": len(sent)}}
+        return resp
+
+    for patcher in (patch.object(case.bot, "_tg_session", MagicMock(post=post)),
+                    patch.object(case.bot, "_ws_broadcast")):
+        patcher.start()
+        case.addCleanup(patcher.stop)
+    case.addCleanup(case.bot.flush_pending_outbox, None, 5)
+    return sent
+
+
+class TestSendMessageNowait(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        self.sent = _fake_telegram(self)
+
+    def test_send_message_goes_out_after_queued_notices(self):
+        self.bot.send_message_nowait(1, "queued")
+        self.bot.send_message(1, "direct")
+        self.assertEqual(self.sent, ["queued", "direct"])
+        self.assertNotIn("1", self.bot._outbox_pending)
+
+    def test_burst_is_coalesced(self):
+        self.bot.send_message_nowait(1, "one")
+        self.bot.send_message_nowait(1, "two")
+        self.bot.send_message(1, "three")
+        self.assertEqual(self.sent, ["one\n\ntwo", "three"])
+
+    def test_ws_label_is_captured_on_the_queueing_thread(self):
+        self.bot._ws_session_override.name = "loop-session"
+        try:
+            self.bot.send_message_nowait(1, "note")
+        finally:
+            self.bot._ws_session_override.name = None
+        self.bot.flush_pending_outbox(1, timeout=5)
+        data = self.bot._ws_broadcast.call_args[0][2]
+        self.assertEqual(data["session"], "loop-session")
+
+
+# ──────────────────────────────────────────────────────────
+# 12. flush_pending_outbox
+# ──────────────────────────────────────────────────────────
+
+class TestFlushPendingOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        self.sent = _fake_telegram(self)
+
+    def test_flush_chat_sends_its_queue(self):
+        self.bot.send_message_nowait(1, "a")
+        self.bot.flush_pending_outbox(1, timeout=5)
+        self.assertEqual(self.sent, ["a"])
+        self.assertFalse(self.bot._outbox_pending)
+
+    def test_flush_all_keeps_chats_apart(self):
+        self.bot.send_message_nowait(1, "a")
+        self.bot.send_message_nowait(2, "b")
+        self.bot.flush_pending_outbox(timeout=5)
+        self.assertEqual(sorted(self.sent), ["a", "b"])
+
+    def test_flush_with_nothing_queued_returns(self):
+        self.bot.flush_pending_outbox(1, timeout=5)
+        self.assertEqual(self.sent, [])
+
+
+# ──────────────────────────────────────────────────────────
+# 13. Retry backoff
+# ──────────────────────────────────────────────────────────
+
+class TestBackoffSleep(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        self.state = self.bot._new_loop_state(1, "s", "task", "claude_self_review")
+        patcher = patch.dict(self.bot.deepreview_active, {"1:s": self.state}, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_delay_grows_and_is_capped(self):
+        waits = []
+        wait_fn = lambda key, secs: waits.append(secs) or True
+        for streak in (1, 2, 3, 50):
+            self.assertTrue(self.bot.backoff_sleep("1:s", streak, wait_fn=wait_fn))
+        self.assertLess(waits[0], waits[1])
+        self.assertLess(waits[1], waits[2])
+        self.assertLessEqual(waits[3], self.bot.BACKOFF_CAP)
+
+    def test_returns_early_on_cancel(self):
+        self.state["active"] = False
+        self.bot._wake_loop(self.state)
+        with patch.object(self.bot, "BACKOFF_BASE", 60):
+            started = time.monotonic()
+            self.assertFalse(self.bot.backoff_sleep("1:s", 1))
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_cancel_during_wait_wakes_it(self):
+        threading.Timer(0.2, lambda: (self.state.update(active=False), self.bot._wake_loop(self.state))).start()
+        with patch.object(self.bot, "BACKOFF_BASE", 60):
+            started = time.monotonic()
+            self.assertFalse(self.bot.backoff_sleep("1:s", 1))
+        self.assertLess(time.monotonic() - started, 5)
+
+
+# ──────────────────────────────────────────────────────────
+# 14. Streaming Codex capture
+# ──────────────────────────────────────────────────────────
+
+class TestCodexExecCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+
+    def capture(self, script, **kwargs):
+        with patch.object(self.bot, "_codex_exec_cmd", lambda prompt: ["sh", "-c", script]):
+            started = time.monotonic()
+            result = self.bot._codex_exec_capture("prompt", tempfile.gettempdir(), **kwargs)
+        return result, time.monotonic() - started
+
+    def test_reads_to_exit(self):
+        (out, err, timed_out), _ = self.capture("echo one; echo two; echo 'ERROR: quota' >&2")
+        self.assertEqual(out, "one\ntwo")
+        self.assertEqual(err, "ERROR: quota")
+        self.assertFalse(timed_out)
+
+    def test_clean_prefix_stops_on_first_line(self):
+        (out, _, _), elapsed = self.capture("echo; echo 'CLEAN - no issues'; sleep 30", clean_prefix="CLEAN")
+        self.assertEqual(out, "CLEAN - no issues")
+        self.assertLess(elapsed, 10)
+
+    def test_clean_prefix_ignored_after_first_line(self):
+        (out, _, _), _ = self.capture("echo 'Findings:'; echo 'CLEAN'", clean_prefix="CLEAN")
+        self.assertEqual(out, "Findings:\nCLEAN")
+
+    def test_stop_token_needs_a_bare_line(self):
+        script = "echo 'not ALL_CLEAN yet'; echo ' all_clean '; sleep 30"
+        (out, _, _), elapsed = self.capture(script, stop_token="ALL_CLEAN")
+        self.assertEqual(out, "not ALL_CLEAN yet\n all_clean")
+        self.assertLess(elapsed, 10)
+
+    def test_timeout_kills_process(self):
+        (_, _, timed_out), elapsed = self.capture("sleep 30", timeout=0.5)
+        self.assertTrue(timed_out)
+        self.assertLess(elapsed, 10)
+
+
+# ──────────────────────────────────────────────────────────
+# 15. Cancelling Codex calls
+# ──────────────────────────────────────────────────────────
+
+class TestCodexCancel(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        patcher = patch.object(self.bot, "_codex_exec_cmd", lambda prompt: ["sh", "-c", "sleep 30"])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cancel = threading.Event()
+        threading.Timer(0.3, self.cancel.set).start()
+
+    def test_exec_capture(self):
+        started = time.monotonic()
+        _, _, timed_out = self.bot._codex_exec_capture("prompt", tempfile.gettempdir(), cancel_event=self.cancel)
+        self.assertFalse(timed_out)
+        self.assertLess(time.monotonic() - started, 10)
+
+    def test_review(self):
+        started = time.monotonic()
+        result = self.bot.run_codex_review("task", "output", 1, "", tempfile.gettempdir(), cancel_event=self.cancel)
+        self.assertEqual(result, (None, False, "Cancelled"))
+        self.assertLess(time.monotonic() - started, 10)
+
+
+# ──────────────────────────────────────────────────────────
+# 16. Stale-state sweep
+# ──────────────────────────────────────────────────────────
+
+class TestSweepStaleState(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = _get_bot()
+        for d in (self.bot.active_processes, self.bot.justdoit_active, self.bot._stale_since):
+            patcher = patch.dict(d, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(self.bot, "cancelled_sessions", set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 1_000_000.0
+
+    def sweep_at(self, seconds_later):
+        with patch.object(self.bot.time, "time", return_value=self.now + seconds_later):
+            self.bot._sweep_stale_state()
+
+    def test_dead_entries_kept_for_an_hour(self):
+        exited = MagicMock(**{"poll.return_value": 0})
+        self.bot.active_processes["s1"] = exited
+        self.bot.justdoit_active["1:s1"] = {"active": False}
+        self.bot.cancelled_sessions.add("s2")
+        self.sweep_at(0)
+        self.sweep_at(self.bot._STALE_STATE_SECS)
+        self.assertIn("s1", self.bot.active_processes)
+        self.assertIn("1:s1", self.bot.justdoit_active)
+        self.assertIn("s2", self.bot.cancelled_sessions)
+        self.sweep_at(self.bot._STALE_STATE_SECS + 1)
+        self.assertNotIn("s1", self.bot.active_processes)
+        self.assertNotIn("1:s1", self.bot.justdoit_active)
+        self.assertNotIn("s2", self.bot.cancelled_sessions)
+
+    def test_live_entries_never_dropped(self):
+        running = MagicMock(**{"poll.return_value": None})
+        self.bot.active_processes["s1"] = running
+        self.bot.justdoit_active["1:s1"] = {"active": True}
+        self.sweep_at(0)
+        self.sweep_at(10 * self.bot._STALE_STATE_SECS)
+        self.assertIs(self.bot.active_processes["s1"], running)
+        self.assertIn("1:s1", self.bot.justdoit_active)
+
+    def test_clock_restarts_when_entry_comes_back_to_life(self):
+        state = {"active": False}
+        self.bot.justdoit_active["1:s1"] = state
+        self.sweep_at(0)
+        state["active"] = True
+        self.sweep_at(self.bot._STALE_STATE_SECS / 2)
+        state["active"] = False
+        self.sweep_at(self.bot._STALE_STATE_SECS)
+        self.sweep_at(self.bot._STALE_STATE_SECS + 2)
+        self.assertIn("1:s1", self.bot.justdoit_active)
+
+
+if __name__ == "__main__":
+    unittest.main()